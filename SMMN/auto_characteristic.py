@@ -1,7 +1,8 @@
-import re
 from django.http import JsonResponse
 import os
-from SMMN.auto_neutral_losses import generate_neutral_losses, calculate_neutral_loss_percentages
+import numpy as np
+from SMMN.auto_neutral_losses import generate_neutral_losses, calculate_neutral_loss_percentages, load_mgf_bundle
+from SMMN.utils.output_log import OutputLogIndex
 
 
 def show_feature(request):
@@ -9,6 +10,13 @@ def show_feature(request):
         analyze = request.POST.get('analyze')
         energy_level = request.POST.get('energyLevel')
         tolerance = float(request.POST.get('tolerance', 0.00001))
+        quorum = request.POST.get('quorum')
+        try:
+            quorum = int(quorum) if quorum else None
+        except ValueError:
+            quorum = 0
+        if quorum is not None and quorum < 1:
+            return JsonResponse({'status': 'error', 'message': 'Quorum must be a positive integer.'}, status=400)
 
         if not analyze or not energy_level:
             return JsonResponse({'status': 'error', 'message': 'Missing required parameters.'}, status=400)
@@ -22,7 +30,7 @@ def show_feature(request):
                 if selected_molecules:
                     selected_molecules = list(map(int, selected_molecules.split(' ')))
 
-            response = handle_mgf_file_analysis(request, tolerance, selected_molecules)
+            response = handle_mgf_file_analysis(request, tolerance, selected_molecules, quorum)
 
         elif energy_level in ['10eV', '20eV', '40eV']:
             selected_molecules = None
@@ -31,65 +39,40 @@ def show_feature(request):
                 if selected_molecules:
                     selected_molecules = list(map(int, selected_molecules.split(' ')))
 
-            response = handle_simulation_file_analysis(request, energy_level, tolerance, selected_molecules)
+            response = handle_simulation_file_analysis(request, energy_level, tolerance, selected_molecules, quorum)
 
         return JsonResponse({'status': 'success', 'data': response}, status=200)
 
     return JsonResponse({'status': 'error', 'message': 'Invalid request method.'}, status=405)
 
 
-def handle_simulation_file_analysis(request, energy_level, tolerance, selected_molecules=None):
+def handle_simulation_file_analysis(request, energy_level, tolerance, selected_molecules=None, quorum=None):
     user_directory = request.session.get('user_directory')
     output_file = os.path.join(user_directory, "output.log")
 
     if not os.path.exists(output_file):
         return {'status': 'error', 'message': 'Output log file not found'}
 
+    energy_markers = {'10eV': 'energy0', '20eV': 'energy1', '40eV': 'energy2'}
+    index = OutputLogIndex.load(output_file)
+
     spectrum_data = {}
-    collecting_data = False
-    current_energy = None
-    molecule_count = None
-
-    with open(output_file, 'r') as file:
-        for line in file:
-            line = line.strip()
-
-            if line.startswith("#ID="):
-                molecule_count = int(line.split("=")[-1].replace("Molecule", ""))
-                collecting_data = False
-
-                if selected_molecules and molecule_count not in selected_molecules:
-                    continue
-
-            # 解析能量层级
-            if line.startswith("energy0"):
-                current_energy = "10eV"
-            elif line.startswith("energy1"):
-                current_energy = "20eV"
-            elif line.startswith("energy2"):
-                current_energy = "40eV"
-
-            if current_energy == energy_level:
-                collecting_data = True
-            elif line.startswith("energy") and collecting_data:
-                collecting_data = False
-
-            if collecting_data and line and line[0].isdigit():
-                mz, intensity = map(float, line.split())
-                if molecule_count not in spectrum_data:
-                    spectrum_data[molecule_count] = []
-                spectrum_data[molecule_count].append([mz, intensity])
-
-            if collecting_data and (not line or not line[0].isdigit()):
-                collecting_data = False
+    for molecule in index.molecules:
+        molecule_count = int(molecule['id'].replace("Molecule", ""))
+        if selected_molecules and molecule_count not in selected_molecules:
+            continue
+
+        peaks = index.molecule_spectrum(molecule, energy_markers[energy_level])
+        if peaks:
+            spectrum_data.setdefault(molecule_count, []).extend(peaks)
 
     if not spectrum_data:
         return {'status': 'error', 'message': 'No spectrum data found for selected energy level'}
 
-    return process_spectrum_data(spectrum_data, tolerance)
+    return process_spectrum_data(spectrum_data, tolerance, quorum)
 
 
-def process_spectrum_data(spectrum_data, tolerance):
+def process_spectrum_data(spectrum_data, tolerance, quorum=None):
     nl_data = {}
     for molecule_id, data in spectrum_data.items():
         max_intensity = max([intensity for _, intensity in data])
@@ -100,38 +83,8 @@ def process_spectrum_data(spectrum_data, tolerance):
         nl_percentages = calculate_neutral_loss_percentages(neutral_losses)
         nl_data[molecule_id] = nl_percentages
 
-    mz_intensities = {}
-    nl_intensities = {}
-
-    first_molecule = list(spectrum_data.keys())[0]
-    for mz, intensity in spectrum_data[first_molecule]:
-        mz_intensities[mz] = intensity
-
-    for nl, nl_intensity in nl_data[first_molecule].items():
-        nl_intensities[nl] = nl_intensity
-
-    for molecule_id, data in spectrum_data.items():
-        if molecule_id == first_molecule:
-            continue
-
-        current_mz_intensities = {}
-        for mz_2, intensity_2 in data:
-            for mz in list(mz_intensities.keys()):
-                if abs(mz - mz_2) <= tolerance:
-                    mz_intensities[mz] += intensity_2
-                    current_mz_intensities[mz] = mz_intensities[mz]
-        mz_intensities = current_mz_intensities
-
-        current_nl_intensities = {}
-        for nl_2, nl_intensity_2 in nl_data[molecule_id].items():
-            for nl in list(nl_intensities.keys()):
-                if abs(nl - nl_2) <= tolerance:
-                    nl_intensities[nl] += nl_intensity_2
-                    current_nl_intensities[nl] = nl_intensities[nl]
-        nl_intensities = current_nl_intensities
-
-    common_mz = {mz: intensity for mz, intensity in mz_intensities.items()}
-    common_nl = {nl: intensity for nl, intensity in nl_intensities.items()}
+    molecules_to_process = list(spectrum_data.keys())
+    common_mz, common_nl = process_common_mz_nl(spectrum_data, nl_data, tolerance, molecules_to_process, quorum)
 
     return {
         'status': 'success',
@@ -190,17 +143,17 @@ def parse_mgf_for_neutral_loss(file_content, top_n):
     return molecules
 
 
-def handle_mgf_file_analysis(request, tolerance, selected_molecules=None):
-    mgf_file_content = request.session.get('mgf_file_content')
+def handle_mgf_file_analysis(request, tolerance, selected_molecules=None, quorum=None):
+    store = load_mgf_bundle(request)
     min_neutral_loss = request.session.get('minNeutralLoss')
     top_n = request.session.get('topN')
 
-    if not mgf_file_content:
+    if store is None:
         return {'status': 'error', 'message': 'MGF file not found'}
 
-    spectrum_data, nl_data = parse_mgf_file(mgf_file_content, min_neutral_loss, top_n)
+    spectrum_data, nl_data = parse_mgf_file(store, min_neutral_loss, top_n)
 
-    common_mz, common_nl = process_common_mz_nl(spectrum_data, nl_data, tolerance, selected_molecules)
+    common_mz, common_nl = process_common_mz_nl(spectrum_data, nl_data, tolerance, selected_molecules, quorum)
 
     return {
         'status': 'success',
@@ -208,21 +161,15 @@ def handle_mgf_file_analysis(request, tolerance, selected_molecules=None):
         'characteristic_nl': common_nl
     }
 
-def parse_mgf_file(mgf_file_content, min_neutral_loss, top_n):
+def parse_mgf_file(store, min_neutral_loss, top_n):
     spectrum_data = {}
     nl_data = {}
-    molecule_count = 1
 
-    lines = mgf_file_content.splitlines()
-    for line in lines:
-        line = line.strip()
-        if re.match(r'^\d+\.\d+\s+\d+', line):
-            mz, intensity = map(float, line.split())
-            if molecule_count not in spectrum_data:
-                spectrum_data[molecule_count] = []
-            spectrum_data[molecule_count].append([mz, intensity])
-        elif line.startswith("END IONS"):
-            molecule_count += 1
+    for i in range(len(store)):
+        mz_array, intensity_array = store.peaks(i)
+        if len(mz_array):
+            spectrum_data[i + 1] = [[mz, intensity] for mz, intensity in zip(mz_array.tolist(),
+                                                                             intensity_array.tolist())]
 
     for molecule_id, data in spectrum_data.items():
         max_intensity = max([intensity for _, intensity in data])
@@ -236,37 +183,97 @@ def parse_mgf_file(mgf_file_content, min_neutral_loss, top_n):
     return spectrum_data, nl_data
 
 
-def process_common_mz_nl(spectrum_data, nl_data, tolerance, selected_molecules=None):
-    mz_intensities = {}
-    nl_intensities = {}
-
+def process_common_mz_nl(spectrum_data, nl_data, tolerance, selected_molecules=None, quorum=None):
     molecules_to_process = selected_molecules if selected_molecules else list(spectrum_data.keys())
 
-    first_molecule = molecules_to_process[0]
-    for mz, intensity in spectrum_data[first_molecule]:
-        mz_intensities[mz] = intensity
-
-    for nl, nl_intensity in nl_data[first_molecule].items():
-        nl_intensities[nl] = nl_intensity
-
-    for molecule_id in molecules_to_process[1:]:
-        current_mz_intensities = {}
-        for mz_2, intensity_2 in spectrum_data[molecule_id]:
-            for mz in list(mz_intensities.keys()):
-                if abs(mz - mz_2) <= tolerance:
-                    mz_intensities[mz] += intensity_2
-                    current_mz_intensities[mz] = mz_intensities[mz]
-        mz_intensities = current_mz_intensities
-
-        current_nl_intensities = {}
-        for nl_2, nl_intensity_2 in nl_data[molecule_id].items():
-            for nl in list(nl_intensities.keys()):
-                if abs(nl - nl_2) <= tolerance:
-                    nl_intensities[nl] += nl_intensity_2
-                    current_nl_intensities[nl] = nl_intensities[nl]
-        nl_intensities = current_nl_intensities
-
-    common_mz = {mz: intensity for mz, intensity in mz_intensities.items()}
-    common_nl = {nl: intensity for nl, intensity in nl_intensities.items()}
-
-    return common_mz, common_nl
+    mz_features = [feature_arrays(spectrum_data[molecule_id]) for molecule_id in molecules_to_process]
+    nl_features = [feature_arrays(nl_data[molecule_id].items()) for molecule_id in molecules_to_process]
+
+    if quorum and quorum < len(molecules_to_process):
+        return quorum_features(mz_features, tolerance, quorum), quorum_features(nl_features, tolerance, quorum)
+    return intersect_features(mz_features, tolerance), intersect_features(nl_features, tolerance)
+
+
+def feature_arrays(pairs):
+    pairs = list(pairs)
+    values = np.array([value for value, _ in pairs], dtype=np.float64)
+    intensities = np.array([intensity for _, intensity in pairs], dtype=np.float64)
+    return values, intensities
+
+
+def intersect_features(features, tolerance):
+    # the first molecule defines the keys; a key survives a molecule if any of its peaks lies within tolerance and
+    # collects the intensity of every such peak
+    first_values, first_intensities = features[0]
+    first_features = {}
+    for value, intensity in zip(first_values.tolist(), first_intensities.tolist()):
+        first_features[value] = intensity
+    keys = np.array(list(first_features.keys()), dtype=np.float64)
+    totals = np.array(list(first_features.values()), dtype=np.float64)
+
+    margin = abs(tolerance) * 1e-6 + 1e-9
+    for values, intensities in features[1:]:
+        if len(keys) == 0:
+            break
+
+        order = np.argsort(values, kind='stable')
+        sorted_values = values[order]
+        lo = np.searchsorted(sorted_values, keys - tolerance - margin, side='left')
+        hi = np.searchsorted(sorted_values, keys + tolerance + margin, side='right')
+        counts = np.maximum(hi - lo, 0)
+
+        key_idx = np.repeat(np.arange(len(keys)), counts)
+        first = np.cumsum(counts) - counts
+        peak_idx = order[np.arange(int(counts.sum())) - np.repeat(first, counts) + np.repeat(lo, counts)]
+        valid = np.abs(keys[key_idx] - values[peak_idx]) <= tolerance
+        key_idx, peak_idx = key_idx[valid], peak_idx[valid]
+
+        # peaks are added in spectrum order on top of the running total, as the per-peak loop did
+        by_peak = np.lexsort((peak_idx, key_idx))
+        key_idx, peak_idx = key_idx[by_peak], peak_idx[by_peak]
+        weights = np.concatenate([totals, intensities[peak_idx]])
+        totals = np.bincount(np.concatenate([np.arange(len(keys)), key_idx]), weights=weights, minlength=len(keys))
+
+        # survivors are kept in the order the molecule's peaks first reached them
+        first_peak = np.full(len(keys), len(values))
+        np.minimum.at(first_peak, key_idx, peak_idx)
+        survivors = np.flatnonzero(first_peak < len(values))
+        survivors = survivors[np.lexsort((survivors, first_peak[survivors]))]
+        keys, totals = keys[survivors], totals[survivors]
+
+    return dict(zip(keys.tolist(), totals.tolist()))
+
+
+def quorum_features(features, tolerance, quorum):
+    # one sorted pass clusters every feature of every molecule; a cluster is kept when at least `quorum` molecules
+    # contribute to it and is reported under its first member in molecule order. each cluster is anchored at its
+    # smallest value, so a chain of close peaks cannot stretch it past the tolerance
+    values = np.concatenate([feature_values for feature_values, _ in features])
+    intensities = np.concatenate([feature_intensities for _, feature_intensities in features])
+    molecules = np.repeat(np.arange(len(features)), [len(feature_values) for feature_values, _ in features])
+    if len(values) == 0:
+        return {}
+
+    order = np.argsort(values, kind='stable')
+    sorted_values = values[order]
+    sorted_clusters = np.empty(len(values), dtype=np.int64)
+    start, cluster = 0, 0
+    while start < len(sorted_values):
+        stop = int(np.searchsorted(sorted_values, sorted_values[start] + tolerance, side='right'))
+        stop = max(stop, start + 1)
+        sorted_clusters[start:stop] = cluster
+        start, cluster = stop, cluster + 1
+    clusters = np.empty(len(values), dtype=np.int64)
+    clusters[order] = sorted_clusters
+
+    cluster_molecules = np.unique(clusters * len(features) + molecules) // len(features)
+    molecule_counts = np.bincount(cluster_molecules, minlength=clusters.max() + 1)
+    cluster_totals = np.bincount(clusters, weights=intensities)
+
+    positions = np.arange(len(values))
+    by_position = positions[np.lexsort((positions, clusters))]
+    representatives = by_position[np.searchsorted(clusters[by_position], np.arange(clusters.max() + 1))]
+    kept = np.flatnonzero(molecule_counts >= quorum)
+    kept = kept[np.argsort(representatives[kept], kind='stable')]
+
+    return dict(zip(values[representatives[kept]].tolist(), cluster_totals[kept].tolist()))
@@ -1,16 +1,32 @@
 from django.shortcuts import render
 from django.conf import settings
+import io
 import uuid
 import csv
-from pyteomics import mgf
 import numpy as np
 from django.http import JsonResponse, HttpResponse
 from SMMN.utils import module4net
+from SMMN.utils.pair_cache import PairScoreCache
+from SMMN.utils.spectrum_store import SpectrumStore, normalize_intensities, match_within_tolerance
 import os
-import pandas as pd
+import json
+import time
+import fcntl
 import shutil
+import socket
+import logging
+import pandas as pd
+import threading
 import zipfile
 
+logger = logging.getLogger(__name__)
+
+# downloads are written to user_directory/filter_artifacts_<uuid>/ rather than user_directory/ itself,
+# and filter_artifacts.json names the generation that is complete
+ARTIFACT_MANIFEST = 'filter_artifacts.json'
+ARTIFACT_NAMES = ['filtered_data.csv', 'filtered_spectra.mgf', 'metadata.csv']
+
+
 def show_filter(request):
     if request.method == 'POST':
         ion_match_count = int(request.POST.get('ionMatchCount', 0))
@@ -37,18 +53,10 @@ def show_filter(request):
             os.makedirs(user_directory, exist_ok=True)
 
         if mgf_file:
-            input_mgf = os.path.join(user_directory, mgf_file.name)
-            with open(input_mgf, 'wb+') as f:
-                for chunk in mgf_file.chunks():
-                    f.write(chunk)
-
-            replace_feature_id_with_title(input_mgf)
-
-            with mgf.read(input_mgf) as spectra:
-                spectra_data = list(spectra)
+            store = SpectrumStore.from_mgf_text(mgf_file.read().decode('utf-8'), mgf_file.name)
 
             filtered_spectra, metadata = process_mgf_file(
-                spectra_data,
+                store,
                 ion_match_count,
                 nl_match_count,
                 common_ions,
@@ -58,36 +66,33 @@ def show_filter(request):
                 andOrvalue
             )
 
-            output_mgf = os.path.join(user_directory, 'filtered_spectra.mgf')
-            output_metadata_csv = os.path.join(user_directory, 'metadata.csv')
-            write_filtered_spectra(filtered_spectra, output_mgf)
-            write_metadata(metadata, output_metadata_csv)
+            artifacts = [
+                ('filtered_spectra.mgf', lambda path: write_filtered_spectra(filtered_spectra, path)),
+                ('metadata.csv', lambda path: write_metadata(metadata, path)),
+            ]
 
             if filter_model == 'FBMN' and csv_file:
-                input_csv = os.path.join(user_directory, csv_file.name)
-                with open(input_csv, 'wb+') as f:
-                    for chunk in csv_file.chunks():
-                        f.write(chunk)
-
-                titles_to_keep = [spectrum['params']['title'] for spectrum in filtered_spectra if
-                                  'title' in spectrum['params']]
-                output_filtered_csv = os.path.join(user_directory, 'filtered_data.csv')
+                titles_to_keep = [title for title in filtered_spectra.title if title]
+                filtered_df = filter_csv(csv_file, titles_to_keep)
+                artifacts.append(('filtered_data.csv', lambda path: filtered_df.to_csv(path, index=False)))
 
-                filter_csv(input_csv, titles_to_keep, output_filtered_csv)
-
-            spectra_collection = module4net.load_mgf_file(output_mgf)
+            spectra_collection = filtered_spectra.nonempty()
             cosine_score_threshold = cosine_score
             peak_tolerance = tolerance
             top_k = 10
 
+            workers = getattr(settings, 'SMMN_NETWORK_WORKERS', 1)
+            pair_cache = PairScoreCache(os.path.join(settings.MEDIA_ROOT, 'pair_score_cache'),
+                                        floor=getattr(settings, 'SMMN_PAIR_CACHE_FLOOR', 0.3),
+                                        max_entries=getattr(settings, 'SMMN_PAIR_CACHE_ENTRIES', 32))
+
             all_matches = module4net.generate_all_matches(spectra_collection, peak_tolerance, cosine_score_threshold,
-                                                          top_k)
+                                                          top_k, workers=workers, quiet=True, pair_cache=pair_cache)
 
-            csv_filename = module4net.match_to_csv(all_matches)
+            match_table = module4net.match_to_dataframe(all_matches)
+            write_artifacts_in_background(user_directory, artifacts)
 
-            output_csv = os.path.join(user_directory, 'match.csv')
-            shutil.copy(csv_filename, output_csv)
-            G = module4net.draw_network(csv_filename, cosine_score, component_size=5, peak_matching_rate=0.0,
+            G = module4net.draw_network(match_table, cosine_score, component_size=5, peak_matching_rate=0.0,
                                         structure_mz=0)
             network_html = module4net.draw_interactive_network_with_communities(G, k=10)
 
@@ -99,33 +104,127 @@ def show_filter(request):
 
     return JsonResponse({'status': 'error', 'message': 'Invalid request method.'}, status=405)
 
-def filter_csv(input_csv, titles_to_keep, output_csv):
+def filter_csv(input_csv, titles_to_keep):
     df = pd.read_csv(input_csv)
     titles_to_keep = list(map(str, titles_to_keep))
     df['row ID'] = df['row ID'].astype(str)
-    filtered_df = df[df['row ID'].isin(titles_to_keep)]
-    filtered_df.to_csv(output_csv, index=False)
-
-
-def replace_feature_id_with_title(input_file):
-    temp_file = input_file + ".temp"
-    with open(input_file, 'r') as infile, open(temp_file, 'w') as outfile:
-        for line in infile:
-            outfile.write(line.replace("FEATURE_ID=", "TITLE="))
-    os.replace(temp_file, input_file)
-
-
-def process_mgf_file(spectra_data, ion_threshold, neutral_loss_threshold, common_ions, common_neutral_losses, tolerance,
+    return df[df['row ID'].isin(titles_to_keep)]
+
+
+def write_artifacts_in_background(user_directory, artifacts):
+    # each run writes a fresh generation directory; the manifest only points at it once every file is complete,
+    # so the previous generation stays downloadable meanwhile and any worker process can see the state
+    generation = f"filter_artifacts_{uuid.uuid4().hex}"
+    os.makedirs(os.path.join(user_directory, generation))
+
+    with artifact_manifest_lock(user_directory):
+        manifest = read_artifact_manifest(user_directory)
+        manifest.update({'pending': generation, 'started': time.time(), 'pid': os.getpid(),
+                         'host': socket.gethostname()})
+        write_artifact_manifest(user_directory, manifest)
+
+    # not a daemon, so a recycled worker finishes the write before the interpreter exits
+    threading.Thread(target=write_artifacts, args=(user_directory, generation, artifacts)).start()
+
+
+def write_artifacts(user_directory, generation, artifacts):
+    generation_directory = os.path.join(user_directory, generation)
+    try:
+        for name, writer in artifacts:
+            writer(os.path.join(generation_directory, name))
+    except Exception:
+        logger.exception("Error writing filter results to %s", generation_directory)
+        with artifact_manifest_lock(user_directory):
+            manifest = read_artifact_manifest(user_directory)
+            if manifest.get('pending') == generation:
+                manifest['pending'] = None
+                write_artifact_manifest(user_directory, manifest)
+        shutil.rmtree(generation_directory, ignore_errors=True)
+        return
+
+    with artifact_manifest_lock(user_directory):
+        manifest = read_artifact_manifest(user_directory)
+        if manifest.get('pending') != generation:
+            # a newer filter run has started since; its results replace these
+            shutil.rmtree(generation_directory, ignore_errors=True)
+            return
+
+        previous = manifest.get('current')
+        manifest.update({'current': generation, 'pending': None})
+        write_artifact_manifest(user_directory, manifest)
+        if previous:
+            shutil.rmtree(os.path.join(user_directory, previous), ignore_errors=True)
+
+
+class artifact_manifest_lock:
+    def __init__(self, user_directory):
+        self.path = os.path.join(user_directory, ARTIFACT_MANIFEST + '.lock')
+
+    def __enter__(self):
+        self.lock = open(self.path, 'w')
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.lock, fcntl.LOCK_UN)
+        self.lock.close()
+
+
+def read_artifact_manifest(user_directory):
+    try:
+        with open(os.path.join(user_directory, ARTIFACT_MANIFEST), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_artifact_manifest(user_directory, manifest):
+    path = os.path.join(user_directory, ARTIFACT_MANIFEST)
+    temp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, path)
+
+
+def artifacts_pending(manifest, timeout):
+    if not manifest.get('pending'):
+        return False
+    if time.time() - manifest.get('started', 0) > timeout:
+        return False
+    if manifest.get('host') == socket.gethostname():
+        # the writer died with its process, e.g. a worker killed after its graceful timeout
+        try:
+            os.kill(manifest['pid'], 0)
+        except ProcessLookupError:
+            return False
+        except (KeyError, PermissionError):
+            pass
+    return True
+
+
+def wait_for_artifacts(user_directory, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+        manifest = read_artifact_manifest(user_directory)
+        if not artifacts_pending(manifest, getattr(settings, 'SMMN_ARTIFACT_TIMEOUT', 300)):
+            return manifest, True
+        if time.monotonic() > deadline:
+            return manifest, False
+        time.sleep(0.2)
+
+
+def process_mgf_file(store, ion_threshold, neutral_loss_threshold, common_ions, common_neutral_losses, tolerance,
                      min_normalized_intensity, andOrvalue):
-    filtered_spectra = []
+    kept_indices = []
     metadata = []
 
-    for spectrum in spectra_data:
-        ion_score = calculate_ion_score(spectrum, common_ions, tolerance, min_normalized_intensity)
-        neutral_loss_score = calculate_neutral_loss_score(spectrum, common_neutral_losses, tolerance,
-                                                          min_normalized_intensity)
-        spectrum['ion_score'] = ion_score
-        spectrum['neutral_loss_score'] = neutral_loss_score
+    ion_scores = calculate_ion_scores(store, common_ions, tolerance, min_normalized_intensity)
+    neutral_loss_scores = calculate_neutral_loss_scores(store, common_neutral_losses, tolerance,
+                                                        min_normalized_intensity)
+
+    for i in range(len(store)):
+        ion_score = ion_scores[i]
+        neutral_loss_score = neutral_loss_scores[i]
 
         classification = 0
 
@@ -141,89 +240,78 @@ def process_mgf_file(spectra_data, ion_threshold, neutral_loss_threshold, common
                 classification = 2
 
         if classification > 0:
-            filtered_spectra.append(spectrum)
+            kept_indices.append(i)
             metadata.append({
-                'row ID': spectrum['params'].get('title', ''),
-                'row m/z': spectrum['params'].get('pepmass', [None])[0],
-                'row retention time': spectrum['params'].get('rtinseconds', 0) / 60,
+                'row ID': store.title[i],
+                'row m/z': float(store.pepmass[i]),
+                'row retention time': float(store.rt[i]) / 60,
                 'classification': classification
             })
 
-    return filtered_spectra, metadata
-
+    return store.subset(kept_indices), metadata
 
-def calculate_ion_score(spectrum, common_ions, tolerance, min_normalized_intensity):
-    ion_score = 0
-    intensity_array = spectrum['intensity array']
-    mz_array = spectrum['m/z array']
-    params = spectrum.get('params', {})
-    pepmass = params.get('pepmass', [0])[0]
 
-    if len(intensity_array) == 0:
-        return ion_score
+def calculate_ion_scores(store, common_ions, tolerance, min_normalized_intensity):
+    ion_scores = np.zeros(len(store), dtype=np.int64)
+    ions = np.unique(np.asarray(common_ions, dtype=np.float64))
 
-    valid_intensities = [intensity for intensity, mz in zip(intensity_array, mz_array) if abs(mz - pepmass) >= 0]
-    max_intensity = max(valid_intensities) if valid_intensities else 0
-    min_intensity = np.min(intensity_array)
+    if len(ions) == 0 or len(store.mz) == 0:
+        return ion_scores
 
-    if max_intensity == min_intensity:
-        normalized_intensity = np.zeros_like(intensity_array)
-    else:
-        normalized_intensity = (intensity_array - min_intensity) / (max_intensity - min_intensity)
+    selected = normalize_intensities(store) > min_normalized_intensity
+    spectrum_ids = store.spectrum_index()[selected]
+    peak_idx, ion_idx = match_within_tolerance(store.mz[selected], ions, tolerance)
 
-    mz_list = [fragment_ion for y, fragment_ion in enumerate(spectrum['m/z array']) if
-               normalized_intensity[y] > min_normalized_intensity]
+    matched = np.unique(spectrum_ids[peak_idx] * len(ions) + ion_idx)
+    ion_scores += np.bincount(matched // len(ions), minlength=len(store))
+    return ion_scores
 
-    matched_ions = set()
 
-    for mz in mz_list:
-        for ion in common_ions:
-            if abs(mz - ion) < tolerance and ion not in matched_ions:
-                ion_score += 1
-                matched_ions.add(ion)
+def calculate_neutral_loss_scores(store, common_neutral_losses, tolerance, min_normalized_intensity):
+    neutral_loss_scores = np.zeros(len(store), dtype=np.int64)
+    losses = np.unique(np.asarray(common_neutral_losses, dtype=np.float64))
 
-    return ion_score
+    if len(losses) == 0 or len(store.mz) == 0:
+        return neutral_loss_scores
 
+    selected = normalize_intensities(store) > min_normalized_intensity
+    spectrum_ids = store.spectrum_index()[selected]
+    selected_mz = store.mz[selected]
 
-def calculate_neutral_loss_score(spectrum, common_neutral_losses, tolerance, min_normalized_intensity):
-    neutral_loss_score = 0
-    intensity_array = spectrum['intensity array']
-    mz_array = spectrum['m/z array']
-    params = spectrum.get('params', {})
-    pepmass = params.get('pepmass', [0])[0]
+    order = np.lexsort((selected_mz, spectrum_ids))
+    sorted_mz = selected_mz[order]
+    bounds = np.searchsorted(spectrum_ids[order], np.arange(len(store) + 1))
 
-    if len(intensity_array) == 0:
-        return neutral_loss_score
+    for i in np.flatnonzero(np.diff(bounds) > 1):
+        neutral_loss_scores[i] = count_neutral_loss_matches(sorted_mz[bounds[i]:bounds[i + 1]], losses, tolerance)
 
-    valid_intensities = [intensity for intensity, mz in zip(intensity_array, mz_array) if abs(mz - pepmass) >= 0]
-    sorted_intensities = sorted(valid_intensities, reverse=True)
-    max_intensity = sorted_intensities[0] if sorted_intensities else 0
-    min_intensity = np.min(intensity_array)
+    return neutral_loss_scores
 
-    if max_intensity == min_intensity:
-        normalized_intensity = np.zeros_like(intensity_array)
-    else:
-        normalized_intensity = (intensity_array - min_intensity) / (max_intensity - min_intensity)
 
-    mz_list = [fragment_ion for y, fragment_ion in enumerate(spectrum['m/z array']) if
-               normalized_intensity[y] > min_normalized_intensity]
+def count_neutral_loss_matches(sorted_mz, losses, tolerance):
+    margin = abs(tolerance) * 1e-6 + 1e-9
+    targets = sorted_mz[:, None] + losses[None, :]
 
-    neutral_losses = [(mz1 - mz2, mz1, mz2) for i, mz1 in enumerate(mz_list) for j, mz2 in enumerate(mz_list) if
-                      i != j]
+    lo = np.searchsorted(sorted_mz, (targets - tolerance - margin).ravel(), side='left')
+    hi = np.searchsorted(sorted_mz, (targets + tolerance + margin).ravel(), side='right')
+    counts = np.maximum(hi - lo, 0)
+    total = int(counts.sum())
+    if total == 0:
+        return 0
 
-    matched_losses = set()
+    target_idx = np.repeat(np.arange(len(counts)), counts)
+    first = np.cumsum(counts) - counts
+    mz1_idx = np.arange(total) - np.repeat(first, counts) + np.repeat(lo, counts)
+    mz2_idx = target_idx // len(losses)
+    loss_idx = target_idx % len(losses)
 
-    for nl, mz1, mz2 in neutral_losses:
-        for common_nl in common_neutral_losses:
-            if abs(nl - common_nl) < tolerance and common_nl not in matched_losses:
-                neutral_loss_score += 1
-                matched_losses.add(common_nl)
-    return neutral_loss_score
+    valid = (mz1_idx != mz2_idx) & (
+            np.abs((sorted_mz[mz1_idx] - sorted_mz[mz2_idx]) - losses[loss_idx]) < tolerance)
+    return len(np.unique(loss_idx[valid]))
 
 
 def write_filtered_spectra(filtered_spectra, output_mgf):
-    with open(output_mgf, 'w') as f:
-        mgf.write(filtered_spectra, output=f)
+    filtered_spectra.write_mgf(output_mgf)
 
 
 def write_metadata(metadata, output_csv):
@@ -239,24 +327,24 @@ def download_filter_data(request):
     if not user_directory:
         return HttpResponse("User directory not found", status=404)
 
-    filtered_data_csv = os.path.join(user_directory, 'filtered_data.csv')
-    filtered_spectra_mgf = os.path.join(user_directory, 'filtered_spectra.mgf')
-    metadata_csv = os.path.join(user_directory, 'metadata.csv')
-
-    zip_filename = os.path.join(user_directory, 'filtered_data.zip')
-
-    with zipfile.ZipFile(zip_filename, 'w') as zip_file:
-        if os.path.exists(filtered_data_csv):
-            zip_file.write(filtered_data_csv, 'filtered_data.csv')
-        if os.path.exists(filtered_spectra_mgf):
-            zip_file.write(filtered_spectra_mgf, 'filtered_spectra.mgf')
-        if os.path.exists(metadata_csv):
-            zip_file.write(metadata_csv, 'metadata.csv')
-
-    if os.path.exists(zip_filename):
-        with open(zip_filename, 'rb') as f:
-            response = HttpResponse(f.read(), content_type='application/zip')
-            response['Content-Disposition'] = f'attachment; filename="filtered_data.zip"'
-            return response
-    else:
-        return HttpResponse("Error creating ZIP file", status=500)
\ No newline at end of file
+    _, finished = wait_for_artifacts(user_directory, getattr(settings, 'SMMN_ARTIFACT_WAIT', 30))
+    if not finished:
+        return HttpResponse("Filtered data is still being written, please try again shortly", status=503)
+
+    # zipping under the manifest lock keeps a newer run from removing this generation meanwhile
+    buffer = io.BytesIO()
+    with artifact_manifest_lock(user_directory):
+        manifest = read_artifact_manifest(user_directory)
+        if not manifest.get('current'):
+            return HttpResponse("Filtered data not found", status=404)
+
+        generation_directory = os.path.join(user_directory, manifest['current'])
+        with zipfile.ZipFile(buffer, 'w') as zip_file:
+            for name in ARTIFACT_NAMES:
+                path = os.path.join(generation_directory, name)
+                if os.path.exists(path):
+                    zip_file.write(path, name)
+
+    response = HttpResponse(buffer.getvalue(), content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="filtered_data.zip"'
+    return response
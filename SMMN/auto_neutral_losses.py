@@ -1,57 +1,78 @@
 import re
 import os
-from decimal import Decimal, ROUND_DOWN
+import uuid
+import shutil
+import numpy as np
+from django.conf import settings
 from django.http import JsonResponse, HttpResponse
+from SMMN.utils.spectrum_store import SpectrumStore
+from SMMN.utils.output_log import OutputLogIndex, ENERGY_LEVELS
 
-def parse_mgf_for_neutral_loss(file_content, top_n):
+def parse_mgf_for_neutral_loss(store, top_n):
     molecules = []
-    current_molecule = None
-    molecule_counter = 0
-
-    lines = file_content.splitlines()
-
-    for line in lines:
-        line = line.strip()
 
-        if line == "BEGIN IONS":
-            if current_molecule:
-                molecules.append(current_molecule)
-            molecule_counter += 1
-            current_molecule = {
-                "id": molecule_counter,
-                "pepmass": "",
-                "scans": "",
-                "rtinseconds": "",
-                "charge": "",
-                "spectrum": ""
-            }
-
-        elif line.startswith("PEPMASS="):
-            current_molecule["pepmass"] = line.split("=")[-1]
+    for i in range(len(store)):
+        current_molecule = {
+            "id": i + 1,
+            "pepmass": "",
+            "scans": "",
+            "rtinseconds": "",
+            "charge": "",
+            "spectrum": ""
+        }
 
-        elif line.startswith("SCANS="):
-            current_molecule["scans"] = line.split("=")[-1]
+        for line in store.headers[i].splitlines():
+            if line.startswith("PEPMASS="):
+                current_molecule["pepmass"] = line.split("=")[-1]
 
-        elif line.startswith("RTINSECONDS="):
-            current_molecule["rtinseconds"] = line.split("=")[-1]
+            elif line.startswith("SCANS="):
+                current_molecule["scans"] = line.split("=")[-1]
 
-        elif line.startswith("CHARGE="):
-            current_molecule["charge"] = line.split("=")[-1]
+            elif line.startswith("RTINSECONDS="):
+                current_molecule["rtinseconds"] = line.split("=")[-1]
 
-        elif line == "END IONS":
-            if current_molecule:
-                current_molecule[
-                    "spectrum"] = f"<a href='#' onclick=\"showNLSpectrum('SCANS-{current_molecule['scans']}', '0', {top_n})\">NL Spectrum</a>"
-                molecules.append(current_molecule)
-                current_molecule = None
+            elif line.startswith("CHARGE="):
+                current_molecule["charge"] = line.split("=")[-1]
 
-    if current_molecule:
         current_molecule[
             "spectrum"] = f"<a href='#' onclick=\"showNLSpectrum('SCANS-{current_molecule['scans']}', '0', {top_n})\">NL Spectrum</a>"
         molecules.append(current_molecule)
 
     return molecules
 
+
+def save_mgf_bundle(request, store):
+    # the bundle lives in the session's user directory, so it is cleaned up with the rest of that session's files
+    user_directory = request.session.get('user_directory')
+    if not user_directory or not os.path.isdir(user_directory):
+        user_directory = os.path.join(settings.MEDIA_ROOT, 'temp', str(uuid.uuid4()))
+        os.makedirs(user_directory, exist_ok=True)
+        request.session['user_directory'] = user_directory
+
+    bundle_directory = os.path.join(user_directory, 'mgf_bundle')
+    previous_bundle = request.session.get('mgf_bundle')
+    if previous_bundle and previous_bundle != bundle_directory:
+        shutil.rmtree(previous_bundle, ignore_errors=True)
+
+    temp_directory = f"{bundle_directory}.{uuid.uuid4().hex}.tmp"
+    store.save(temp_directory)
+    shutil.rmtree(bundle_directory, ignore_errors=True)
+    os.rename(temp_directory, bundle_directory)
+
+    request.session['mgf_bundle'] = bundle_directory
+    # the raw upload and its scan index from older sessions are superseded by the bundle's scan_order
+    request.session.pop('mgf_file_content', None)
+    request.session.pop('mgf_scan_index', None)
+    return bundle_directory
+
+
+def load_mgf_bundle(request):
+    bundle_directory = request.session.get('mgf_bundle')
+    if not bundle_directory or not os.path.exists(bundle_directory):
+        return None
+    return SpectrumStore.load(bundle_directory)
+
+
 def generate_neutral_loss(request):
     if request.method == 'POST':
         use_first_step_output = request.POST.get('useFirstStepOutput', False)
@@ -77,10 +98,14 @@ def generate_neutral_loss(request):
             if not uploaded_file:
                 return JsonResponse({'status': 'error', 'message': 'No file uploaded'}, status=400)
 
-            file_content = uploaded_file.read().decode('utf-8')
-            request.session['mgf_file_content'] = file_content
+            store = SpectrumStore.from_mgf_text(uploaded_file.read().decode('utf-8'), uploaded_file.name)
+            # an empty bundle has zero-length arrays, which older numpy versions refuse to memory-map
+            if len(store) == 0 or len(store.mz) == 0:
+                return JsonResponse({'status': 'error', 'message': 'No spectra found in the uploaded file.'},
+                                    status=400)
+            save_mgf_bundle(request, store)
 
-            neutral_loss_links = parse_mgf_for_neutral_loss(file_content, top_n)
+            neutral_loss_links = parse_mgf_for_neutral_loss(store, top_n)
 
         return JsonResponse({
             'status': 'success',
@@ -128,27 +153,54 @@ def parse_output_log_for_neutral_loss(file_path, top_n):
 
 def generate_neutral_losses(top_ions, min_neutral_loss, charge=1):
     neutral_losses = {}
-    for i in range(len(top_ions)):
-        mz1, intensity1 = top_ions[i]
-        for j in range(len(top_ions)):
-            if i != j:
-                mz2, intensity2 = top_ions[j]
-                neutral_loss = (Decimal(mz1) - Decimal(mz2)) * Decimal(charge)
-
-                if neutral_loss >= Decimal(min_neutral_loss):
-                    average_intensity = (Decimal(intensity1) + Decimal(intensity2)) / Decimal(2.0)
-                    found = False
-                    for nl in neutral_losses.keys():
-                        if abs(neutral_loss - nl) < Decimal('1e-5'):
-                            neutral_losses[nl].append((mz1, mz2, average_intensity))
-                            found = True
-                            break
-
-                    if not found:
-                        neutral_losses[neutral_loss] = [(mz1, mz2, average_intensity)]
+    if len(top_ions) < 2:
+        return neutral_losses
+
+    ions = np.asarray(top_ions, dtype=np.float64)
+    differences = (ions[:, 0][:, None] - ions[:, 0][None, :]) * charge
+    first, second = np.nonzero((differences >= min_neutral_loss) & ~np.eye(len(ions), dtype=bool))
+    values = differences[first, second]
+    average_intensities = ((ions[first, 1] + ions[second, 1]) / 2.0).tolist()
+    labels = cluster_within_tolerance(values, 1e-5)
+
+    keys = {}
+    for k, label in enumerate(labels.tolist()):
+        if label not in keys:
+            keys[label] = float(values[label])
+            neutral_losses[keys[label]] = []
+        neutral_losses[keys[label]].append((top_ions[first[k]][0], top_ions[second[k]][0], average_intensities[k]))
     return neutral_losses
 
 
+def cluster_within_tolerance(values, tolerance):
+    # each value joins the earliest earlier key within tolerance, otherwise it becomes a key itself
+    labels = np.arange(len(values))
+    if len(values) == 0:
+        return labels
+
+    order = np.argsort(values, kind='stable')
+    sorted_values = values[order]
+    breaks = np.flatnonzero(np.diff(sorted_values) >= tolerance) + 1
+    starts = np.concatenate([[0], breaks])
+    ends = np.concatenate([breaks, [len(values)]])
+
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        members = np.sort(order[start:end])
+        if sorted_values[end - 1] - sorted_values[start] < tolerance:
+            labels[members] = members[0]
+            continue
+
+        cluster_keys = []
+        for member in members.tolist():
+            for key in cluster_keys:
+                if abs(values[member] - values[key]) < tolerance:
+                    labels[member] = key
+                    break
+            else:
+                cluster_keys.append(member)
+    return labels
+
+
 def calculate_neutral_loss_percentages(neutral_losses):
     if not neutral_losses or all(len(nl_list) == 0 for nl_list in neutral_losses.values()):
         return {}
@@ -169,11 +221,11 @@ def show_nl_spectrum(request):
     molecule_id = request.GET.get('molecule_id')
     energy_level = request.GET.get('energy_level', None)
     user_directory = request.session.get('user_directory')
-    mgf_file_content = request.session.get('mgf_file_content')
+    mgf_bundle = request.session.get('mgf_bundle')
     top_n = request.session.get('topN')
     min_neutral_loss = request.session.get('minNeutralLoss')
 
-    if not user_directory and not mgf_file_content:
+    if not user_directory and not mgf_bundle:
         return JsonResponse({'status': 'error', 'message': 'File not found'}, status=404)
 
     session_data_key = None
@@ -182,29 +234,17 @@ def show_nl_spectrum(request):
         scan_number = molecule_id.split("-")[-1]
 
         spectrum_data = []
-        collecting_data = False
-        charge = 1
         pepmass = None
+        charge = 1
 
-        lines = mgf_file_content.splitlines()
-        for line in lines:
-            line = line.strip()
-
-            if line.startswith("PEPMASS=") and pepmass is None:
-                pepmass = float(line.split("=")[-1].split()[0])
-
-            if line.startswith(f"SCANS={scan_number}"):
-                collecting_data = True
-
-            elif collecting_data:
-                if line.startswith("CHARGE="):
-                    charge_str = line.split("=")[-1].replace('+', '').strip()
-                    charge = int(charge_str) if charge_str.isdigit() else 1
-                elif line and line[0].isdigit():
-                    mz, intensity = map(float, line.split())
-                    spectrum_data.append([mz, intensity])
-                elif line == "END IONS":
-                    break
+        store = load_mgf_bundle(request) if scan_number.isdigit() else None
+        if store is not None:
+            index = store.index_of_scan(int(scan_number))
+            if index >= 0:
+                mz_array, intensity_array = store.peaks(index)
+                spectrum_data = [[mz, intensity] for mz, intensity in zip(mz_array.tolist(), intensity_array.tolist())]
+                pepmass = float(store.pepmass[index])
+                charge = int(store.charge[index]) or 1
 
         if not spectrum_data or pepmass is None:
             return JsonResponse({'status': 'error', 'message': 'Spectrum data not found'}, status=404)
@@ -217,50 +257,15 @@ def show_nl_spectrum(request):
         nl_percentages = calculate_neutral_loss_percentages(neutral_losses)
 
     else:
-        energy_mapping = {
-            '0': '10eV',
-            '1': '20eV',
-            '2': '40eV'
-        }
-
         output_file = os.path.join(user_directory, "output.log")
         if not os.path.exists(output_file):
             return JsonResponse({'status': 'error', 'message': 'Output log file not found'}, status=404)
 
-        with open(output_file, 'r') as file:
-            content = file.read()
-
-        spectrum_data = []
-        current_energy = None
-        collecting_data = False
-        pepmass = None
-        target_energy = energy_mapping.get(energy_level)
-        for line in content.splitlines():
-            line = line.strip()
-
-            if line.startswith(f"#ID={molecule_id}"):
-                collecting_data = True
-                continue
+        index = OutputLogIndex.load(output_file)
+        molecule = index.molecule(molecule_id)
 
-            if collecting_data:
-                if line.startswith("energy0"):
-                    current_energy = "10eV"
-                elif line.startswith("energy1"):
-                    current_energy = "20eV"
-                elif line.startswith("energy2"):
-                    current_energy = "40eV"
-
-                elif line.startswith("#PMass="):
-                    pepmass = float(line.split("=")[-1])
-
-                elif current_energy == target_energy and collecting_data:
-                    if line:
-                        mz, intensity = map(float, line.split())
-                        spectrum_data.append([mz, intensity])
-                    elif line == '':
-                        break
-                elif line == "":
-                    collecting_data = False
+        spectrum_data = index.spectrum(molecule_id, ENERGY_LEVELS.get(energy_level))
+        pepmass = float(molecule['pmass']) if molecule and molecule['pmass'] else None
 
         if not spectrum_data or pepmass is None:
             return JsonResponse({'status': 'error', 'message': 'Spectrum data not found'}, status=404)
@@ -293,13 +298,9 @@ def download_neutral_loss_log(request):
     if not os.path.exists(output_log_file):
         return HttpResponse("Output log file not found", status=404)
 
-    with open(output_log_file, 'r') as file:
-        lines = file.readlines()
+    index = OutputLogIndex.load(output_log_file)
 
     output_lines = []
-    current_molecule_header = []
-    spectrum_data = {}
-    current_energy = None
 
     def process_current_molecule(header, spectrum_data):
         result = []
@@ -328,31 +329,26 @@ def download_neutral_loss_log(request):
         result.append("")
         return result
 
-    for line in lines:
-        stripped_line = line.strip()
-
-        if stripped_line.startswith("#ID="):
-            if current_molecule_header:
-                output_lines.extend(process_current_molecule(current_molecule_header, spectrum_data))
+    for molecule in index.molecules:
+        current_molecule_header = []
+        spectrum_data = {"energy0": [], "energy1": [], "energy2": []}
+        current_energy = None
 
-            current_molecule_header = []
-            spectrum_data = {"energy0": [], "energy1": [], "energy2": []}
-            current_energy = None
-            current_molecule_header.append(stripped_line)
+        for line in index.molecule_text(molecule).splitlines():
+            stripped_line = line.strip()
 
-        elif stripped_line.startswith(("#SMILES", "#InChiKey", "#Formula", "#PMass")):
-            current_molecule_header.append(stripped_line)
+            if stripped_line.startswith(("#ID=", "#SMILES", "#InChiKey", "#Formula", "#PMass")):
+                current_molecule_header.append(stripped_line)
 
-        elif stripped_line.startswith("energy"):
-            current_energy = stripped_line
-            spectrum_data[current_energy] = []
+            elif stripped_line.startswith("energy"):
+                current_energy = stripped_line
+                spectrum_data[current_energy] = []
 
-        elif re.match(r'^\d', stripped_line):
-            if current_energy:
-                mz, intensity = map(float, stripped_line.split())
-                spectrum_data[current_energy].append([mz, intensity])
+            elif re.match(r'^\d', stripped_line):
+                if current_energy:
+                    mz, intensity = map(float, stripped_line.split())
+                    spectrum_data[current_energy].append([mz, intensity])
 
-    if current_molecule_header:
         output_lines.extend(process_current_molecule(current_molecule_header, spectrum_data))
 
     response = HttpResponse("\n".join(output_lines), content_type='text/plain')
@@ -361,60 +357,44 @@ def download_neutral_loss_log(request):
 
 
 def download_neutral_loss_mgf(request):
-    mgf_file_content = request.session.get('mgf_file_content')
+    store = load_mgf_bundle(request)
     top_n = request.session.get('topN')
     min_neutral_loss = request.session.get('minNeutralLoss')
 
-    if not mgf_file_content or top_n is None or min_neutral_loss is None:
+    if store is None or top_n is None or min_neutral_loss is None:
         return HttpResponse("Missing required data in session", status=400)
 
     output_lines = []
-    molecule_count = 0
-    spectrum_data = []
-
-    lines = mgf_file_content.splitlines()
-    for i, line in enumerate(lines):
-        line = line.strip()
+    header_keys = ("TITLE", "PEPMASS", "SCANS", "RTINSECONDS", "CHARGE", "MSLEVEL", "MERGED_STATS")
 
-        if line.startswith("BEGIN IONS"):
-            molecule_count += 1
-            spectrum_data = []
-            output_lines.append(line)
+    for i in range(len(store)):
+        mz_array, intensity_array = store.peaks(i)
+        if len(mz_array) == 0:
+            print(f"No spectrum data found for molecule {i + 1}. Skipping.")
+            continue
 
-        elif line.startswith(("TITLE", "PEPMASS", "SCANS", "RTINSECONDS", "CHARGE", "MSLEVEL", "MERGED_STATS")):
-            output_lines.append(line)
+        max_intensity = float(intensity_array.max())
+        if max_intensity <= 0:
+            print(f"Error processing molecule {i + 1}: no positive intensity")
+            continue
 
-        elif re.match(r'^\d+\.\d+\s+\d+', line):
-            try:
-                mz, intensity = map(float, line.split())
-                spectrum_data.append([mz, intensity])
-            except ValueError:
-                print(f"Skipping invalid line: {line}")
+        normalized_spectrum = [[mz, (intensity / max_intensity) * 100]
+                               for mz, intensity in zip(mz_array.tolist(), intensity_array.tolist())]
+        top_ions = sorted(normalized_spectrum, key=lambda x: x[1], reverse=True)[:top_n]
 
-        elif line == "END IONS":
-            if not spectrum_data:
-                print(f"No spectrum data found for molecule {molecule_count}. Skipping.")
-                continue
-
-            try:
-                max_intensity = max([intensity for _, intensity in spectrum_data])
-                normalized_spectrum = [[mz, (intensity / max_intensity) * 100] for mz, intensity in spectrum_data]
-                top_ions = sorted(normalized_spectrum, key=lambda x: x[1], reverse=True)[:top_n]
-
-                neutral_losses = generate_neutral_losses(top_ions, min_neutral_loss)
-                nl_percentages = calculate_neutral_loss_percentages(neutral_losses)
+        neutral_losses = generate_neutral_losses(top_ions, min_neutral_loss)
+        nl_percentages = calculate_neutral_loss_percentages(neutral_losses)
 
-                sorted_nl_percentages = sorted(nl_percentages.items(), key=lambda x: x[1], reverse=True)
+        sorted_nl_percentages = sorted(nl_percentages.items(), key=lambda x: x[1], reverse=True)
 
-                output_lines.append("#neutral losses data calculated by SMMN")
-                output_lines.append(f"#top N = {top_n} Min Neutral Loss = {min_neutral_loss}")
-                for nl, intensity in sorted_nl_percentages:
-                    output_lines.append(f"{nl:.5f} {intensity:.5f}")
-                output_lines.append(line)
-                output_lines.append("")
-            except ValueError as e:
-                print(f"Error processing molecule {molecule_count}: {e}")
-                continue
+        output_lines.append("BEGIN IONS")
+        output_lines.extend(line for line in store.headers[i].splitlines() if line.startswith(header_keys))
+        output_lines.append("#neutral losses data calculated by SMMN")
+        output_lines.append(f"#top N = {top_n} Min Neutral Loss = {min_neutral_loss}")
+        for nl, intensity in sorted_nl_percentages:
+            output_lines.append(f"{nl:.5f} {intensity:.5f}")
+        output_lines.append("END IONS")
+        output_lines.append("")
 
     response = HttpResponse("\n".join(output_lines), content_type='text/plain')
     response['Content-Disposition'] = 'attachment; filename="neutral_loss.mgf"'
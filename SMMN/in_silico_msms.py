@@ -1,9 +1,12 @@
 import re
+import json
+import time
 from django.conf import settings
 import uuid
-from django.http import JsonResponse, HttpResponse, FileResponse
+from django.http import JsonResponse, HttpResponse, FileResponse, StreamingHttpResponse
 import os
-from SMMN.tasks import run_simulation_task
+from SMMN.tasks import run_simulation_task, start_simulation, shard_progress, read_task_manifest
+from SMMN.utils.output_log import OutputLogIndex, ENERGY_LEVELS, ENERGY_LABELS
 
 def simulate_data(request):
     if request.method == 'POST':
@@ -33,30 +36,21 @@ def simulate_data(request):
                 f.write(f"Molecule{idx} {smiles}\n")
 
 
-        task = run_simulation_task.delay(molecule_file_path, user_directory)
+        task = start_simulation(molecule_file_path, user_directory)
 
 
         return JsonResponse({'status': 'success', 'task_id': task.id})
 
 
 def check_task_status(request, task_id):
-    print(f"Checking task status for task_id: {task_id}")
     task_result = run_simulation_task.AsyncResult(task_id)
-    print(f"Task state: {task_result.state}")
 
     if task_result.state == 'PENDING':
-        response = {'state': task_result.state, 'status': 'Pending...'}
+        response = pending_response(task_result, read_task_manifest(task_id))
     elif task_result.state == 'SUCCESS':
         result = task_result.result
         if result['status'] == 'SUCCESS':
-            file_path = result['result']
-            print(f"Task completed. Output file path: {file_path}")
-            parsed_result = parse_output_log(file_path)
-            print(f"Parsed result: {parsed_result}")
-            response = {
-                'state': task_result.state,
-                'molecules': parsed_result
-            }
+            return task_result_response(task_id, result['result'])
         else:
             response = {
                 'state': 'FAILURE',
@@ -67,41 +61,137 @@ def check_task_status(request, task_id):
             'state': task_result.state,
             'status': str(task_result.info),
         }
+    elif task_result.state == 'PROGRESS':
+        response = progress_response(task_result)
     else:
         response = {'state': task_result.state, 'status': 'Processing...'}
 
     return JsonResponse(response)
 
+
+def pending_response(task_result, manifest):
+    if manifest is None:
+        return {'state': task_result.state, 'status': 'Pending...'}
+    info = shard_progress(manifest)
+    if info is None:
+        return {'state': task_result.state, 'status': 'Queued...'}
+    return progress_response(task_result, info)
+
+
+def progress_response(task_result, info=None):
+    info = info or task_result.info or {}
+    return {
+        'state': 'PROGRESS',
+        'status': 'Processing...',
+        'done': info.get('done', 0),
+        'total': info.get('total', 0)
+    }
+
+
+def stream_task_status(request, task_id):
+    interval = getattr(settings, 'SMMN_PROGRESS_INTERVAL', 2)
+    # celery reports unknown or expired ids as PENDING forever, so a PENDING id without a task manifest only gets a
+    # limited number of polls and no stream outlives the timeout; the keep-alive comment on quiet polls lets a
+    # disconnected client end the stream early
+    stream_timeout = getattr(settings, 'SMMN_PROGRESS_STREAM_TIMEOUT', 3600)
+    max_pending_polls = getattr(settings, 'SMMN_PROGRESS_STREAM_MAX_PENDING', 60)
+
+    def events():
+        deadline = time.monotonic() + stream_timeout
+        pending_polls = 0
+        last_event = None
+        while True:
+            task_result = run_simulation_task.AsyncResult(task_id)
+            state = task_result.state
+            known = True
+
+            if state == 'PROGRESS':
+                event = progress_response(task_result)
+            elif state == 'SUCCESS':
+                result = task_result.result
+                if result['status'] == 'SUCCESS':
+                    event = {'state': state, 'status': 'Completed'}
+                else:
+                    event = {'state': 'FAILURE', 'status': result.get('error', 'Unknown error')}
+            elif state == 'FAILURE':
+                event = {'state': state, 'status': str(task_result.info)}
+            elif state == 'PENDING':
+                manifest = read_task_manifest(task_id)
+                known = manifest is not None
+                event = pending_response(task_result, manifest)
+            else:
+                event = {'state': state, 'status': 'Processing...'}
+
+            if event != last_event:
+                yield f"data: {json.dumps(event)}\n\n"
+                last_event = event
+            else:
+                yield ": keep-alive\n\n"
+
+            if event['state'] in ('SUCCESS', 'FAILURE'):
+                break
+
+            pending_polls = 0 if known else pending_polls + 1
+            if pending_polls >= max_pending_polls:
+                yield timeout_event('Task not found.')
+                break
+            if time.monotonic() + interval > deadline:
+                yield timeout_event('Progress stream closed, check the task status again.')
+                break
+            time.sleep(interval)
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def timeout_event(status):
+    return f"event: timeout\ndata: {json.dumps({'state': 'TIMEOUT', 'status': status})}\n\n"
+
+
+def task_result_path(task_id, file_path):
+    return os.path.join(os.path.dirname(file_path), f"{task_id}.result.json")
+
+
+def task_result_response(task_id, file_path):
+    # the molecule table of a finished task never changes, so it is parsed once and served as stored JSON afterwards;
+    # a missing or unreadable file, e.g. removed while another poll replaced it, is simply rebuilt
+    try:
+        with open(task_result_path(task_id, file_path), 'rb') as f:
+            content = f.read()
+        json.loads(content)
+    except (OSError, ValueError):
+        content = write_task_result(task_id, file_path)
+    return HttpResponse(content, content_type='application/json')
+
+
+def write_task_result(task_id, file_path):
+    result_path = task_result_path(task_id, file_path)
+    content = json.dumps({'state': 'SUCCESS', 'molecules': parse_output_log(file_path)}).encode('utf-8')
+    temp_path = f"{result_path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(content)
+    os.replace(temp_path, result_path)
+    return content
+
+
 def parse_output_log(file_path):
-    with open(file_path, 'r') as file:
-        content = file.read()
+    index = OutputLogIndex.load(file_path)
 
     molecules = []
-    current_molecule = None
-
-    for line in content.splitlines():
-        line = line.strip()
-        if line.startswith("#ID="):
-            if current_molecule:
-                molecules.append(current_molecule)
-            molecule_id = line.split("=")[-1]
-            current_molecule = {
-                "id": molecule_id,
-                "formula": "",
-                "pepmass": "",
-                "spectra": {
-                    "10eV": f"<a href='#' onclick=\"showSpectrum('{molecule_id}', '0')\">Spectrum</a>",
-                    "20eV": f"<a href='#' onclick=\"showSpectrum('{molecule_id}', '1')\">Spectrum</a>",
-                    "40eV": f"<a href='#' onclick=\"showSpectrum('{molecule_id}', '2')\">Spectrum</a>"
-                }
+    for molecule in index.molecules:
+        molecule_id = molecule['id']
+        molecules.append({
+            "id": molecule_id,
+            "formula": molecule['formula'],
+            "pepmass": molecule['pmass'],
+            "spectra": {
+                "10eV": f"<a href='#' onclick=\"showSpectrum('{molecule_id}', '0')\">Spectrum</a>",
+                "20eV": f"<a href='#' onclick=\"showSpectrum('{molecule_id}', '1')\">Spectrum</a>",
+                "40eV": f"<a href='#' onclick=\"showSpectrum('{molecule_id}', '2')\">Spectrum</a>"
             }
-        elif line.startswith("#Formula="):
-            current_molecule["formula"] = line.split("=")[-1]
-        elif line.startswith("#PMass="):
-            current_molecule["pepmass"] = line.split("=")[-1]
-
-    if current_molecule:
-        molecules.append(current_molecule)
+        })
 
     return molecules
 
@@ -109,12 +199,6 @@ def show_spectrum(request):
     molecule_id = request.GET.get('molecule_id')
     energy_level = request.GET.get('energy_level')
 
-    energy_mapping = {
-        '0': '10eV',
-        '1': '20eV',
-        '2': '40eV'
-    }
-
     user_directory = request.session.get('user_directory')
     if not user_directory:
         return JsonResponse({'status': 'error', 'message': 'User directory not found'}, status=404)
@@ -124,40 +208,12 @@ def show_spectrum(request):
         return JsonResponse({'status': 'error', 'message': 'Output log file not found'}, status=404)
 
 
-    with open(output_file, 'r') as file:
-        content = file.read()
-
-    spectrum_data = []
-    current_energy = None
-    collecting_data = False
-    pepmass = None
-    target_energy = energy_mapping.get(energy_level)
-
-    for line in content.splitlines():
-        line = line.strip()
-
-        if line.startswith(f"#ID={molecule_id}"):
-            collecting_data = True
-
-        if collecting_data:
-            if line.startswith("energy0"):
-                current_energy = "10eV"
-            elif line.startswith("energy1"):
-                current_energy = "20eV"
-            elif line.startswith("energy2"):
-                current_energy = "40eV"
-
-            elif line.startswith("#PMass="):
-                pepmass = float(line.split("=")[-1])
-
-            elif current_energy == target_energy and collecting_data:
-                if line:
-                    mz, intensity = map(float, line.split())
-                    spectrum_data.append([mz, intensity])
-                elif line == '':
-                    break
-            elif line == "":
-                collecting_data = False
+    index = OutputLogIndex.load(output_file)
+    molecule = index.molecule(molecule_id)
+    target_energy = ENERGY_LABELS.get(energy_level)
+
+    spectrum_data = index.spectrum(molecule_id, ENERGY_LEVELS.get(energy_level))
+    pepmass = float(molecule['pmass']) if molecule and molecule['pmass'] else None
 
     if not spectrum_data or not pepmass:
         return JsonResponse({'status': 'error', 'message': 'Spectrum data not found'}, status=404)
@@ -19,34 +19,25 @@ def read_molecules(base_dir):
 
 
 def simulate_molecules(base_dir, smiles_list, energy_level, num_molecules, energy_level_test, num_test):
-    simulator = pridict_ms.CFMIDSimulator(base_dir)
-    simulator.simulate_fragments(smiles_list, energy_level, num_molecules, energy_level_test, num_test)
+    simulator = pridict_ms.CFMIDSimulator(base_dir, cache_dir=os.path.join(base_dir, "prediction_cache"))
+    return simulator.simulate_fragments(smiles_list, energy_level, num_molecules, energy_level_test, num_test,
+                                        write_logs=False)
 
 
-def calculate_scores(base_dir, num_molecules, energy_level, num_test):
-    common_ions_file = os.path.join(base_dir, f"{num_molecules}-{energy_level}-{num_test}-common_ions.csv")
-    common_neutral_losses_file = os.path.join(base_dir,
-                                              f"{num_molecules}-{energy_level}-{num_test}-common_neutral_losses.csv")
+def calculate_scores(common_ions, common_neutral_losses):
     target_ion = Decimal("84.08")
     target_neutral_loss = Decimal("134.04")
     tolerance = Decimal("0.02")
 
-    def read_common_file(file_path, target):
-        common_data = []
-        with open(file_path, "r") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                value = Decimal(row['ion'] if 'ion' in row else row['neutral_loss'])
-                average_intensity = Decimal(row['average_intensity'])
-                common_data.append((value, average_intensity))
-        common_data.sort(key=lambda x: x[1], reverse=True)
+    def find_rank(common_data, target):
+        # common_data is already sorted by average intensity, highest first
         for idx, (value, avg_intensity) in enumerate(common_data):
-            if abs(value - target) <= tolerance:
+            if abs(Decimal(str(float(value))) - target) <= tolerance:
                 return idx + 1
         return None
 
-    ion_rank = read_common_file(common_ions_file, target_ion)
-    neutral_loss_rank = read_common_file(common_neutral_losses_file, target_neutral_loss)
+    ion_rank = find_rank(common_ions, target_ion)
+    neutral_loss_rank = find_rank(common_neutral_losses, target_neutral_loss)
 
     def calculate_rank_score(rank):
         if rank is None:
@@ -85,18 +76,16 @@ def main():
                         previous_combinations.append(selected_molecules)
                         break
 
-                simulate_molecules(base_dir, selected_molecules, energy_level, num_molecules, energy_level,
-                                   num_test + 1)
+                fragments = simulate_molecules(base_dir, selected_molecules, energy_level, num_molecules,
+                                               energy_level, num_test + 1)
 
                 energy_level_str = f"energy{energy_level}"
                 min_neutral_loss = 50.0
 
                 analyzer = common_ion_find.CommonIonsAnalyzer(base_dir, energy_level_str, min_neutral_loss)
-                analyzer.analyze_neutral_losses_for_each_molecule(num_molecules, energy_level, num_test + 1)
-                analyzer.find_common_neutral_losses(num_molecules, energy_level, num_test + 1)
-                analyzer.find_common_ions(num_molecules, energy_level, num_test + 1)
+                _, common_neutral_losses, common_ions = analyzer.analyze_spectra(fragments)
 
-                ion_score, neutral_loss_score = calculate_scores(base_dir, num_molecules, energy_level, num_test + 1)
+                ion_score, neutral_loss_score = calculate_scores(common_ions, common_neutral_losses)
                 total_ion_score += ion_score
                 total_neutral_loss_score += neutral_loss_score
 
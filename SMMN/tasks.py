@@ -1,9 +1,140 @@
-from celery import shared_task
+from celery import shared_task, chord, group
+from celery.signals import worker_process_shutdown
 import os
+import json
+import re
+import uuid
+import time
+import threading
 import docker
 from django.conf import settings
+from SMMN.utils.output_log import OutputLogIndex, count_new_molecules, merge_output_logs, read_molecule_file
+from SMMN.utils.prediction_cache import PredictionCache
+from SMMN.utils.simulator_backends import DockerBackend, SubprocessBackend, FakeBackend
+from SMMN.utils.simulator_pool import DockerWorker, BackendWorker, WorkerSlots, shared_pool, close_shared_pool
+from SMMN.utils.simulation_batch import SimulationSpool
 
 CFM_CONFIG_DIR = os.path.join(settings.BASE_DIR, 'SMMN', 'config')
+PARAM_OUTPUT_FILE = os.path.join(CFM_CONFIG_DIR, 'param_output.log')
+PARAM_CONFIG_FILE = os.path.join(CFM_CONFIG_DIR, 'param_config.txt')
+SIMULATION_TIMEOUT = 600
+MISSES_FILE = 'molecule.misses.txt'
+MISSES_OUTPUT = 'output.misses.log'
+HITS_FILE = 'output.hits.log'
+
+_simulator_backend = None
+
+
+def prediction_cache():
+    # the options string ties cached spectra to the cfm-predict arguments and the backend that produced them
+    return PredictionCache(
+        os.path.join(settings.MEDIA_ROOT, 'prediction_cache'),
+        [PARAM_CONFIG_FILE, PARAM_OUTPUT_FILE],
+        options=f"{simulator_backend().identity} 0.001 0 0 0",
+        max_entries=getattr(settings, 'SMMN_PREDICTION_CACHE_ENTRIES', 5000)
+    )
+
+
+def simulation_spool():
+    return SimulationSpool(os.path.join(settings.MEDIA_ROOT, 'simulation_batches'),
+                           window=getattr(settings, 'SMMN_BATCH_WINDOW', 0),
+                           max_molecules=getattr(settings, 'SMMN_BATCH_MAX_MOLECULES', 50))
+
+
+def start_simulation(molecule_file_path, user_directory):
+    misses_file = os.path.join(user_directory, MISSES_FILE)
+    misses = prediction_cache().write_misses(molecule_file_path, misses_file, os.path.join(user_directory, HITS_FILE))
+
+    # the task id is chosen up front and recorded in a manifest, so a poll can tell a queued task from an unknown id;
+    # for a sharded run it is the merge task's id, so check_task_status reads the merged result like a single run
+    task_id = str(uuid.uuid4())
+    if not misses:
+        write_task_manifest(task_id, 0)
+        return run_simulation_task.apply_async((molecule_file_path, user_directory), task_id=task_id)
+
+    # with a batching window, small jobs share one cfm-predict run but keep their own task id and status
+    if getattr(settings, 'SMMN_BATCH_WINDOW', 0) and misses <= getattr(settings, 'SMMN_BATCH_MAX_MOLECULES', 50):
+        write_task_manifest(task_id, misses)
+        return run_batched_simulation_task.apply_async((molecule_file_path, user_directory), task_id=task_id)
+
+    shards = split_molecule_file(misses_file, user_directory)
+    write_task_manifest(task_id, misses, [{'task_id': shard_task_id, 'total': shard_total}
+                                          for _, _, shard_task_id, shard_total in shards])
+    if not shards:
+        return run_simulation_task.apply_async((molecule_file_path, user_directory), task_id=task_id)
+
+    header = group(run_simulation_shard.s(shard_file, shard_output).set(task_id=shard_task_id)
+                   for shard_file, shard_output, shard_task_id, _ in shards)
+    return chord(header)(merge_simulation_shards.s(molecule_file_path, user_directory).set(task_id=task_id))
+
+
+def task_manifest_path(task_id):
+    if not task_id or not re.fullmatch(r'[0-9A-Za-z-]+', task_id):
+        return None
+    return os.path.join(settings.MEDIA_ROOT, 'simulation_tasks', f"{task_id}.json")
+
+
+def write_task_manifest(task_id, total, shards=()):
+    manifest_path = task_manifest_path(task_id)
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path, 'w') as f:
+        json.dump({'total': total, 'shards': list(shards)}, f)
+
+
+def read_task_manifest(task_id):
+    manifest_path = task_manifest_path(task_id)
+    if manifest_path is None:
+        return None
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def remove_task_manifest(task_id):
+    manifest_path = task_manifest_path(task_id)
+    if manifest_path is not None and os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+
+def split_molecule_file(molecule_file_path, user_directory):
+    # every shard holds SMMN_SIMULATION_SHARD_SIZE molecules, the last one the rest; how many run at once is left to
+    # the celery worker concurrency
+    shard_size = getattr(settings, 'SMMN_SIMULATION_SHARD_SIZE', 100)
+
+    with open(molecule_file_path, 'r') as f:
+        lines = [line for line in f if line.strip()]
+
+    if len(lines) <= shard_size:
+        return []
+
+    shards = []
+    for i, start in enumerate(range(0, len(lines), shard_size)):
+        shard_lines = lines[start:start + shard_size]
+        shard_file = os.path.join(user_directory, f"molecule.shard{i}.txt")
+        with open(shard_file, 'w') as f:
+            f.writelines(shard_lines)
+        shards.append((shard_file, os.path.join(user_directory, f"output.shard{i}.log"), str(uuid.uuid4()),
+                       len(shard_lines)))
+    return shards
+
+
+def shard_progress(manifest):
+    # the merge task stays PENDING while its shards run, so progress is summed from the counters each shard
+    # reports in its own PROGRESS state
+    if not manifest or not manifest.get('shards'):
+        return None
+
+    done = 0
+    for shard in manifest['shards']:
+        shard_result = run_simulation_shard.AsyncResult(shard['task_id'])
+        if shard_result.state == 'SUCCESS':
+            done += shard['total']
+        elif shard_result.state == 'PROGRESS':
+            done += (shard_result.info or {}).get('done', 0)
+    return {'done': min(done, manifest['total']), 'total': manifest['total']}
+
 
 @shared_task(bind=True, max_retries=3, default_retry_delay=5)
 def run_simulation_task(self, molecule_file_path, user_directory):
@@ -15,31 +146,97 @@ def run_simulation_task(self, molecule_file_path, user_directory):
             print("Error: molecule.txt not found.")
             return {'status': 'FAILURE', 'error': 'molecule.txt not found.'}
 
+        cache = prediction_cache()
+        misses_file = os.path.join(absolute_user_directory, MISSES_FILE)
+        misses_output = os.path.join(absolute_user_directory, MISSES_OUTPUT)
+        if os.path.exists(misses_output):
+            os.remove(misses_output)
+
+        # only molecules without a cached spectrum go to cfm-predict
+        if cache.write_misses(absolute_molecule_file_path, misses_file,
+                              os.path.join(absolute_user_directory, HITS_FILE)):
+            run_cfm_predict(self, misses_file, misses_output)
+            if not os.path.exists(misses_output):
+                print("output.log file not found.")
+                return {'status': 'FAILURE', 'error': 'output.log not found.'}
+
+        result = finish_simulation(cache, absolute_molecule_file_path, absolute_user_directory)
+        remove_task_manifest(self.request.id)
+        return result
 
-        container = docker.from_env().containers.run(
-            image="wishartlab/cfmid",
-            command=f"cfm-predict /data/molecule.txt 0.001 /config/param_output.log /config/param_config.txt 0 /data/output.log 0 0",
-            volumes={
-                absolute_user_directory: {"bind": "/data", "mode": "rw"},
-                CFM_CONFIG_DIR: {"bind": "/config", "mode": "ro"}
-            },
-            platform="linux/amd64",
-            detach=True,
-            mem_limit="1g",
-            nano_cpus=1000000000
-        )
+    except docker.errors.ContainerError as e:
+        print(f"Error running container: {e}")
+        self.retry(exc=e)
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        self.retry(exc=e)
 
+    return None
 
-        container.wait(timeout=600)
-        logs = container.logs().decode("utf-8")
-        print("Container Logs:\n", logs)
 
-        output_file_path = os.path.join(absolute_user_directory, "output.log")
-        if os.path.exists(output_file_path):
-            return {'status': 'SUCCESS', 'result': output_file_path}
-        else:
-            print("output.log file not found.")
-            return {'status': 'FAILURE', 'error': 'output.log not found.'}
+@shared_task(bind=True, max_retries=3, default_retry_delay=5)
+def run_batched_simulation_task(self, molecule_file_path, user_directory):
+    try:
+        absolute_user_directory = os.path.abspath(user_directory)
+        absolute_molecule_file_path = os.path.abspath(molecule_file_path)
+
+        cache = prediction_cache()
+        misses_file = os.path.join(absolute_user_directory, MISSES_FILE)
+        misses_output = os.path.join(absolute_user_directory, MISSES_OUTPUT)
+        if os.path.exists(misses_output):
+            os.remove(misses_output)
+
+        misses = cache.write_misses(absolute_molecule_file_path, misses_file,
+                                    os.path.join(absolute_user_directory, HITS_FILE))
+        if misses:
+            self.update_state(state='PROGRESS', meta={'done': 0, 'total': misses})
+            spool = simulation_spool()
+            spool.submit(self.request.id, absolute_user_directory, read_molecule_file(misses_file), misses_output)
+            # molecule IDs are namespaced by task id inside the batch and restored in this job's part; the spool
+            # reports only this job's molecules, also while this task leads the batch
+            result = spool.wait(self.request.id, absolute_user_directory,
+                                lambda batch_file, batch_output, on_progress: run_cfm_predict(
+                                    self, batch_file, batch_output, on_progress),
+                                2 * SIMULATION_TIMEOUT,
+                                lambda done: self.update_state(state='PROGRESS',
+                                                               meta={'done': min(done, misses), 'total': misses}))
+            if result['status'] != 'SUCCESS':
+                raise RuntimeError(result.get('error', 'Batched simulation failed.'))
+
+        result = finish_simulation(cache, absolute_molecule_file_path, absolute_user_directory)
+        remove_task_manifest(self.request.id)
+        return result
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        self.retry(exc=e)
+
+
+def finish_simulation(cache, molecule_file_path, user_directory):
+    misses_file = os.path.join(user_directory, MISSES_FILE)
+    misses_output = os.path.join(user_directory, MISSES_OUTPUT)
+
+    hits_file = os.path.join(user_directory, HITS_FILE)
+
+    output_file_path = os.path.join(user_directory, "output.log")
+    partial_files = [misses_output] if os.path.exists(misses_output) else []
+    merge_output_logs(partial_files, read_molecule_file(molecule_file_path), output_file_path, cache, hits_file)
+    OutputLogIndex.load(output_file_path)
+
+    for path in [misses_file, hits_file] + partial_files:
+        if os.path.exists(path):
+            os.remove(path)
+    return {'status': 'SUCCESS', 'result': output_file_path}
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=5)
+def run_simulation_shard(self, shard_file_path, shard_output_path):
+    try:
+        if os.path.exists(shard_output_path):
+            os.remove(shard_output_path)
+        run_cfm_predict(self, os.path.abspath(shard_file_path), os.path.abspath(shard_output_path))
+        return shard_output_path
 
     except docker.errors.ContainerError as e:
         print(f"Error running container: {e}")
@@ -49,13 +246,119 @@ def run_simulation_task(self, molecule_file_path, user_directory):
         print(f"An error occurred: {e}")
         self.retry(exc=e)
 
+
+@shared_task(bind=True)
+def merge_simulation_shards(self, shard_outputs, molecule_file_path, user_directory):
+    output_file_path = os.path.join(os.path.abspath(user_directory), "output.log")
+
+    shard_outputs = [path for path in shard_outputs if path and os.path.exists(path)]
+    if not shard_outputs:
+        print("output.log file not found.")
+        return {'status': 'FAILURE', 'error': 'output.log not found.'}
+
+    merge_output_logs(shard_outputs, read_molecule_file(molecule_file_path), output_file_path, prediction_cache(),
+                      os.path.join(user_directory, HITS_FILE))
+    OutputLogIndex.load(output_file_path)
+
+    for path in os.listdir(user_directory):
+        if path.startswith(('molecule.shard', 'output.shard')) or path in (MISSES_FILE, HITS_FILE):
+            os.remove(os.path.join(user_directory, path))
+    remove_task_manifest(self.request.id)
+
+    return {'status': 'SUCCESS', 'result': output_file_path}
+
+
+def run_cfm_predict(task, molecule_file_path, output_file_path, on_progress=None):
+    # on_progress receives the number of molecules written so far; by default it becomes the task's progress
+    with open(molecule_file_path, 'r') as f:
+        total = sum(1 for line in f if line.strip())
+    if on_progress is None:
+        on_progress = lambda done: task.update_state(state='PROGRESS', meta={'done': done, 'total': total})
+
+    container = start_cfm_predict(molecule_file_path, output_file_path)
+    try:
+        wait_with_progress(container, output_file_path, total, on_progress)
     finally:
-        if 'container' in locals():
-            container.remove()
+        container.remove()
 
-    return None
 
+def start_cfm_predict(molecule_file_path, output_file_path):
+    # SMMN_SIMULATOR_POOL_SIZE hands the job to warm workers kept by this process instead of a new container;
+    # the size is per worker process, SMMN_SIMULATOR_POOL_LIMIT caps the warm workers of all processes on the host
+    if getattr(settings, 'SMMN_SIMULATOR_POOL_SIZE', 0):
+        return simulator_pool().submit(molecule_file_path, output_file_path)
+    return simulator_backend().start(molecule_file_path, output_file_path, PARAM_OUTPUT_FILE, PARAM_CONFIG_FILE)
+
+
+def simulator_backend():
+    # SMMN_SIMULATOR_BACKEND is 'docker', 'subprocess' or 'fake'; a bare SMMN_CFM_PREDICT_COMMAND implies 'subprocess'
+    global _simulator_backend
+    if _simulator_backend is None:
+        command = getattr(settings, 'SMMN_CFM_PREDICT_COMMAND', None)
+        name = getattr(settings, 'SMMN_SIMULATOR_BACKEND', None) or ('subprocess' if command else 'docker')
+        if name == 'docker':
+            _simulator_backend = DockerBackend(mem_limit="1g", nano_cpus=1000000000)
+        elif name == 'subprocess':
+            _simulator_backend = SubprocessBackend(command or 'cfm-predict',
+                                                   cpus=getattr(settings, 'SMMN_SIMULATOR_CPUS', None))
+        elif name == 'fake':
+            _simulator_backend = FakeBackend(delay=getattr(settings, 'SMMN_FAKE_SIMULATION_DELAY', 0))
+        else:
+            raise ValueError(f"Unknown SMMN_SIMULATOR_BACKEND: {name}")
+    return _simulator_backend
+
+
+def simulator_pool():
+    backend = simulator_backend()
+    if isinstance(backend, DockerBackend):
+        worker_factory = lambda: DockerWorker(backend, settings.MEDIA_ROOT, PARAM_OUTPUT_FILE, PARAM_CONFIG_FILE)
+    else:
+        worker_factory = lambda: BackendWorker(backend, PARAM_OUTPUT_FILE, PARAM_CONFIG_FILE)
+    limit = getattr(settings, 'SMMN_SIMULATOR_POOL_LIMIT', 0)
+    slots = WorkerSlots(os.path.join(settings.MEDIA_ROOT, 'simulator_pool'), limit) if limit else None
+    return shared_pool(worker_factory, settings.SMMN_SIMULATOR_POOL_SIZE, slots)
+
+
+@worker_process_shutdown.connect
+def stop_simulator_pool(**kwargs):
+    # prefork children do not always run atexit handlers, so the warm containers are stopped here
+    close_shared_pool()
+
+
+def follow_container_logs(container):
+    print("Container Logs:")
+    for chunk in container.logs(stream=True, follow=True):
+        print(chunk.decode("utf-8", "replace"), end='')
+
+
+def wait_with_progress(container, output_file_path, total, on_progress):
+    interval = getattr(settings, 'SMMN_PROGRESS_INTERVAL', 2)
+    # the timeout covers the run itself: a pool job waiting for a free worker restarts the clock at dispatch,
+    # and is only cancelled if it stays queued for a whole timeout
+    deadline = time.monotonic() + SIMULATION_TIMEOUT
+    dispatched = False
+
+    log_thread = threading.Thread(target=follow_container_logs, args=(container,), daemon=True)
+    log_thread.start()
 
+    done, offset = 0, 0
+    while True:
+        container.reload()
+        finished = container.status in ('exited', 'dead')
+        if not dispatched and container.status != 'created':
+            dispatched = True
+            deadline = time.monotonic() + SIMULATION_TIMEOUT
 
+        new_molecules, offset = count_new_molecules(output_file_path, offset)
+        if new_molecules or finished:
+            done += new_molecules
+            on_progress(min(done, total))
 
+        if finished:
+            break
+        if time.monotonic() > deadline:
+            container.kill()
+            raise TimeoutError(f"cfm-predict did not finish within {SIMULATION_TIMEOUT} seconds")
+        time.sleep(interval)
 
+    log_thread.join(timeout=interval)
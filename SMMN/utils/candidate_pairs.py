@@ -0,0 +1,160 @@
+import numpy as np
+from scipy import sparse
+
+
+class CandidatePairIndex:
+    def __init__(self, store, tolerance, chunk_peaks=200000):
+        self.size = len(store)
+        self.chunk_peaks = chunk_peaks
+        self.offsets = store.offsets
+        self.bin_width = (tolerance + 0.000001) * (1 + 1e-9)
+
+        self.spectrum_ids = store.spectrum_index()
+        totals = np.bincount(self.spectrum_ids, weights=store.intensity, minlength=self.size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.weights = store.intensity / totals[self.spectrum_ids]
+
+        fragment_bins = np.floor(store.mz / self.bin_width).astype(np.int64)
+        loss_bins = np.floor((store.pepmass[self.spectrum_ids] - store.mz) / self.bin_width).astype(np.int64)
+        self.postings = [self._build_postings(fragment_bins), self._build_postings(loss_bins)]
+
+        self.total_pairs = self.size * (self.size - 1) // 2
+        self.pruned_pairs = 0
+
+    def _build_postings(self, bins):
+        order = np.argsort(bins, kind='stable')
+        return bins, bins[order], self.spectrum_ids[order]
+
+    def shared_weights(self):
+        left_parts, right_parts, weight_parts = [], [], []
+
+        start = 0
+        while start < self.size:
+            stop = int(np.searchsorted(self.offsets, self.offsets[start] + self.chunk_peaks, side='right'))
+            stop = min(max(stop - 1, start + 1), self.size)
+            left, right, weight = self._shared_weights_for(start, stop)
+            left_parts.append(left)
+            right_parts.append(right)
+            weight_parts.append(weight)
+            start = stop
+
+        if not left_parts:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, np.zeros(0)
+        return np.concatenate(left_parts), np.concatenate(right_parts), np.concatenate(weight_parts)
+
+    def _shared_weights_for(self, start, stop):
+        peaks = np.arange(self.offsets[start], self.offsets[stop])
+        peak_parts, spectrum_parts = [], []
+
+        for bins, sorted_bins, posting_spectra in self.postings:
+            lo = np.searchsorted(sorted_bins, bins[peaks] - 1, side='left')
+            hi = np.searchsorted(sorted_bins, bins[peaks] + 1, side='right')
+            counts = hi - lo
+            first = np.cumsum(counts) - counts
+            posting_idx = np.arange(int(counts.sum())) - np.repeat(first, counts) + np.repeat(lo, counts)
+            peak_parts.append(np.repeat(peaks, counts))
+            spectrum_parts.append(posting_spectra[posting_idx])
+
+        peak_idx = np.concatenate(peak_parts)
+        neighbour = np.concatenate(spectrum_parts)
+        keep = neighbour != self.spectrum_ids[peak_idx]
+
+        # a peak contributes its weight once per neighbouring spectrum, however many peaks it hits there
+        peak_keys = np.unique(peak_idx[keep] * self.size + neighbour[keep])
+        peak_idx = peak_keys // self.size
+        neighbour = peak_keys % self.size
+
+        pair_keys, inverse = np.unique(self.spectrum_ids[peak_idx] * self.size + neighbour, return_inverse=True)
+        pair_weights = np.bincount(inverse, weights=self.weights[peak_idx], minlength=len(pair_keys))
+        return pair_keys // self.size, pair_keys % self.size, pair_weights
+
+    def candidate_pairs(self, cosine_score_threshold):
+        # returns the i < j pairs sorted by i, or None when no pair can be pruned and every pair is a candidate
+        if cosine_score_threshold <= 0:
+            self.pruned_pairs = 0
+            return None
+
+        left, right, weights = self.shared_weights()
+        keys = left * self.size + right
+        reverse_keys = right * self.size + left
+        position = np.minimum(np.searchsorted(keys, reverse_keys), max(len(keys) - 1, 0))
+        found = keys[position] == reverse_keys if len(keys) else np.zeros(0, dtype=bool)
+        reverse_weights = np.where(found, weights[position] if len(keys) else 0.0, 0.0)
+
+        # Cauchy-Schwarz over the peaks that have any partner bounds the modified cosine
+        bound = np.minimum(np.sqrt(weights * reverse_weights), 1.0)
+        keep = (bound >= cosine_score_threshold - 1e-9) & (left < right)
+
+        self.pruned_pairs = self.total_pairs - int(keep.sum())
+        return left[keep], right[keep]
+
+
+class SparseCosinePrefilter:
+    def __init__(self, store, tolerance, chunk_nnz=4000000):
+        self.size = len(store)
+        self.chunk_nnz = chunk_nnz
+        self.bin_width = (tolerance + 0.000001) * (1 + 1e-9)
+
+        spectrum_ids = store.spectrum_index()
+        totals = np.bincount(spectrum_ids, weights=store.intensity, minlength=self.size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = np.sqrt(store.intensity) / np.sqrt(totals[spectrum_ids])
+
+        fragment_bins = np.floor(store.mz / self.bin_width).astype(np.int64)
+        loss_bins = np.floor((store.pepmass[spectrum_ids] - store.mz) / self.bin_width).astype(np.int64)
+        fragment_bins -= fragment_bins.min(initial=0) - 1
+        loss_bins += fragment_bins.max(initial=0) + 3 - loss_bins.min(initial=0)
+        columns = int(loss_bins.max(initial=0)) + 2
+
+        rows = np.concatenate([spectrum_ids, spectrum_ids])
+        bins = np.concatenate([fragment_bins, loss_bins])
+        weights = np.concatenate([values, values])
+        self.binned = sparse.csr_matrix((weights, (rows, bins)), shape=(self.size, columns))
+
+        # every peak is spread over its neighbour bins so peaks within tolerance always meet in the product
+        spread_rows = np.tile(rows, 3)
+        spread_bins = np.concatenate([bins - 1, bins, bins + 1])
+        spread_weights = np.tile(weights, 3)
+        self.spread = sparse.csr_matrix((spread_weights, (spread_rows, spread_bins)), shape=(self.size, columns))
+
+        self.total_pairs = self.size * (self.size - 1) // 2
+        self.pruned_pairs = 0
+
+    def candidate_pairs(self, cosine_score_threshold):
+        # same contract as CandidatePairIndex.candidate_pairs
+        if cosine_score_threshold <= 0:
+            self.pruned_pairs = 0
+            return None
+
+        spread_t = self.spread.T.tocsc()
+        left_parts, right_parts = [], []
+        for start, stop in self.row_chunks():
+            bound = (self.binned[start:stop] @ spread_t).tocoo()
+            keep = (np.minimum(bound.data, 1.0) >= cosine_score_threshold - 1e-9) & (bound.row + start != bound.col)
+            left_parts.append(bound.row[keep].astype(np.int64) + start)
+            right_parts.append(bound.col[keep].astype(np.int64))
+
+        left = np.concatenate(left_parts) if left_parts else np.zeros(0, dtype=np.int64)
+        right = np.concatenate(right_parts) if right_parts else np.zeros(0, dtype=np.int64)
+
+        keys = np.unique(np.minimum(left, right) * self.size + np.maximum(left, right))
+        self.pruned_pairs = self.total_pairs - len(keys)
+        return keys // self.size, keys % self.size
+
+    def row_chunks(self):
+        # a row's products are bounded by the spread entries in its bins (and by the spectrum count), so chunks
+        # are cut where that running bound reaches chunk_nnz rather than after a fixed number of rows
+        bin_counts = np.bincount(self.spread.indices, minlength=self.spread.shape[1])
+        rows = np.repeat(np.arange(self.size), np.diff(self.binned.indptr))
+        row_bound = np.minimum(np.bincount(rows, weights=bin_counts[self.binned.indices], minlength=self.size),
+                               self.size).astype(np.int64)
+        cumulative = np.cumsum(row_bound)
+
+        start = 0
+        while start < self.size:
+            stop = int(np.searchsorted(cumulative, cumulative[start] - row_bound[start] + self.chunk_nnz,
+                                       side='right'))
+            stop = min(max(stop, start + 1), self.size)
+            yield start, stop
+            start = stop
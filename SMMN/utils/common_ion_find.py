@@ -1,5 +1,6 @@
 import os
 import csv
+import numpy as np
 from decimal import Decimal, getcontext, ROUND_DOWN
 
 getcontext().prec = 10
@@ -19,7 +20,7 @@ class CommonIonsAnalyzer:
                     f.startswith(f"{num_molecules}-{energy_level}-{num_test}-Molecule") and f.endswith(".log")]
 
     def extract_top_ions(self, file_path, top_n=30):
-        ions = []
+        fragments = []
         with open(file_path, 'r') as f:
             lines = f.readlines()
             start_collecting = False
@@ -30,11 +31,21 @@ class CommonIonsAnalyzer:
                 if start_collecting:
                     if not line.strip():
                         break
-                    parts = line.split()
-                    if len(parts) >= 2:
-                        mz = float(parts[0])
-                        intensity = float(parts[1])
-                        ions.append((mz, intensity))
+                    fragments.append(line)
+        return self.top_ions_from_fragments(fragments, top_n)
+
+    @staticmethod
+    def parse_fragments(fragments):
+        # fragments are "mass intensity" strings as returned by CFMIDSimulator, or (mass, intensity) pairs
+        peaks = []
+        for fragment in fragments:
+            parts = fragment.split() if isinstance(fragment, str) else fragment
+            if len(parts) >= 2:
+                peaks.append((parts[0], parts[1]))
+        return peaks
+
+    def top_ions_from_fragments(self, fragments, top_n=30):
+        ions = [(float(mz), float(intensity)) for mz, intensity in self.parse_fragments(fragments)]
         ions.sort(key=lambda x: x[1], reverse=True)
         return ions[:top_n]
 
@@ -63,25 +74,30 @@ class CommonIonsAnalyzer:
                             neutral_losses[neutral_loss] = [(mz1, mz2, average_intensity)]
         return neutral_losses
 
-    def write_neutral_losses_to_csv(self, neutral_losses, file_name):
-        csv_file_path = os.path.join(self.base_dir, file_name)
-
+    def normalize_neutral_losses(self, neutral_losses):
         total_intensities = {}
         for nl, mz_pairs in neutral_losses.items():
             intensities = [pair[2] for pair in mz_pairs]
             total_intensities[nl] = sum(intensities)
 
+        if not total_intensities:
+            return []
         max_total_intensity = max(total_intensities.values())
 
+        return [(nl, (total_intensities[nl] / max_total_intensity) * 100, mz_pairs)
+                for nl, mz_pairs in neutral_losses.items()]
+
+    def write_neutral_losses_to_csv(self, neutral_losses, file_name):
+        self.write_normalized_losses_to_csv(self.normalize_neutral_losses(neutral_losses), file_name)
+
+    def write_normalized_losses_to_csv(self, normalized_losses, file_name):
+        csv_file_path = os.path.join(self.base_dir, file_name)
+
         with open(csv_file_path, mode='w', newline='', encoding='utf-8') as csv_file:
             writer = csv.writer(csv_file)
             writer.writerow(['neutral_loss', 'Intensity', 'm1', 'm2'])
 
-            for nl, mz_pairs in neutral_losses.items():
-                total_intensity = total_intensities[nl]
-
-                normalized_intensity = (total_intensity / max_total_intensity) * 100
-
+            for nl, normalized_intensity, mz_pairs in normalized_losses:
                 row = [nl, normalized_intensity]
                 for mz1, mz2, _ in mz_pairs:
                     row.extend([mz1, mz2])
@@ -96,6 +112,58 @@ class CommonIonsAnalyzer:
             file_name = os.path.basename(file).replace('.log', '_neutral_losses.csv')
             self.write_neutral_losses_to_csv(neutral_losses, file_name)
 
+    def analyze_spectra(self, spectra, num_molecules=None, energy_level=None, num_test=None, write_files=False):
+        molecule_losses = {}
+        molecule_ions = []
+        for molecule, fragments in spectra.items():
+            top_ions = self.top_ions_from_fragments(fragments)
+            molecule_losses[molecule] = self.normalize_neutral_losses(self.generate_neutral_losses(top_ions))
+            molecule_ions.append([(Decimal(str(mz)), Decimal(str(intensity)))
+                                  for mz, intensity in self.parse_fragments(fragments)])
+
+        common_neutral_losses = self.common_values(
+            [[(nl, intensity) for nl, intensity, _ in losses] for losses in molecule_losses.values()])
+        common_ions = self.common_values(molecule_ions)
+
+        if write_files:
+            prefix = self.file_prefix(num_molecules, energy_level, num_test)
+            for molecule, losses in molecule_losses.items():
+                self.write_normalized_losses_to_csv(losses, f"{prefix}{molecule}_neutral_losses.csv")
+            self.write_common_csv(f"{prefix}common_neutral_losses.csv", 'neutral_loss', common_neutral_losses)
+            self.write_common_csv(f"{prefix}common_ions.csv", 'ion', common_ions)
+
+        return molecule_losses, common_neutral_losses, common_ions
+
+    @staticmethod
+    def file_prefix(num_molecules=None, energy_level=None, num_test=None):
+        if num_molecules is None or energy_level is None or num_test is None:
+            return ""
+        return f"{num_molecules}-{energy_level}-{num_test}-"
+
+    @staticmethod
+    def common_values(values_per_molecule, tolerance=Decimal('1e-5')):
+        # values are quantized once onto a grid one tolerance wide and grouped by grid key; a group is common when
+        # it holds as many values as there are molecules, and is reported by its earliest value
+        values = [value for values in values_per_molecule for value, _ in values]
+        if not values:
+            return []
+        intensities = np.array([float(intensity) for values in values_per_molecule for _, intensity in values])
+        keys = np.round(np.array([float(value) for value in values]) / float(tolerance)).astype(np.int64)
+
+        _, first, inverse, counts = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+        averages = np.bincount(inverse, weights=intensities) / counts
+
+        common = np.flatnonzero(counts == len(values_per_molecule))
+        common = common[np.lexsort((first[common], -averages[common]))]
+        return [(values[first[group]], Decimal(str(averages[group]))) for group in common.tolist()]
+
+    def write_common_csv(self, file_name, column, common_sorted):
+        with open(os.path.join(self.base_dir, file_name), mode='w', newline='', encoding='utf-8') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow([column, 'average_intensity'])
+            for value, avg_intensity in common_sorted:
+                writer.writerow([float(value), float(avg_intensity)])
+
     def find_common_neutral_losses(self, num_molecules=None, energy_level=None, num_test=None):
         if num_molecules is None or energy_level is None or num_test is None:
             neutral_loss_files = [f for f in os.listdir(self.base_dir)
@@ -104,44 +172,17 @@ class CommonIonsAnalyzer:
             neutral_loss_files = [f for f in os.listdir(self.base_dir)
                                   if f.startswith(f"{num_molecules}-{energy_level}-{num_test}-Molecule") and f.endswith(
                     ".csv")]
-        all_neutral_losses = {}
+        losses_per_file = []
 
         for file in neutral_loss_files:
             file_path = os.path.join(self.base_dir, file)
             with open(file_path, 'r') as csvfile:
                 reader = csv.DictReader(csvfile)
-                for row in reader:
-                    neutral_loss = Decimal(row['neutral_loss'])
-                    average_intensity = Decimal(row['average_intensity'])
-                    found = False
-                    for nl in all_neutral_losses.keys():
-                        if abs(neutral_loss - nl) < Decimal('1e-5'):
-                            all_neutral_losses[nl].append(average_intensity)
-                            found = True
-                            break
-                    if not found:
-                        all_neutral_losses[neutral_loss] = [average_intensity]
-
-        common_neutral_losses = {nl: intensities for nl, intensities in all_neutral_losses.items() if
-                                 len(intensities) == len(neutral_loss_files)}
-
-        common_neutral_losses_avg = {nl: sum(intensities) / len(intensities) for nl, intensities in
-                                     common_neutral_losses.items()}
-
-        if num_molecules is None or energy_level is None or num_test is None:
-            common_csv_path = os.path.join(self.base_dir, "common_neutral_losses.csv")
-        else:
-            common_csv_path = os.path.join(self.base_dir,
-                                           f"{num_molecules}-{energy_level}-{num_test}-common_neutral_losses.csv"
-                                           )
-
-        common_neutral_losses_sorted = sorted(common_neutral_losses_avg.items(), key=lambda x: x[1], reverse=True)
+                losses_per_file.append([(Decimal(row['neutral_loss']), Decimal(row['Intensity'])) for row in reader])
 
-        with open(common_csv_path, mode='w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(['neutral_loss', 'average_intensity'])
-            for nl, avg_intensity in common_neutral_losses_sorted:
-                writer.writerow([float(nl), float(avg_intensity)])
+        common_neutral_losses_sorted = self.common_values(losses_per_file)
+        self.write_common_csv(f"{self.file_prefix(num_molecules, energy_level, num_test)}common_neutral_losses.csv",
+                              'neutral_loss', common_neutral_losses_sorted)
 
     def find_common_ions(self, num_molecules=None, energy_level=None, num_test=None):
         if num_molecules is None or energy_level is None or num_test is None:
@@ -151,51 +192,27 @@ class CommonIonsAnalyzer:
                               f.startswith(f"{num_molecules}-{energy_level}-{num_test}-Molecule") and f.endswith(
                                   ".log")]
 
-        all_ions = {}
+        ions_per_file = []
 
         for file in molecule_files:
             file_path = os.path.join(self.base_dir, file)
             with open(file_path, 'r') as logfile:
                 lines = logfile.readlines()
                 energy_section = False
+                fragments = []
                 for line in lines:
                     line = line.strip()
                     if line.startswith("energy"):
                         energy_section = True
                         continue
-                    if energy_section:
-                        if line:
-                            parts = line.split()
-                            if len(parts) >= 2:
-                                ion = Decimal(parts[0])
-                                intensity = Decimal(parts[1])
-                                found = False
-                                for i in all_ions.keys():
-                                    if abs(ion - i) < Decimal('1e-5'):
-                                        all_ions[i].append(intensity)
-                                        found = True
-                                        break
-                                if not found:
-                                    all_ions[ion] = [intensity]
-
-        common_ions = {ion: intensities for ion, intensities in all_ions.items() if
-                       len(intensities) == len(molecule_files)}
-
-        common_ions_avg = {ion: sum(intensities) / len(intensities) for ion, intensities in common_ions.items()}
-
-        if num_molecules is None or energy_level is None or num_test is None:
-            common_csv_path = os.path.join(self.base_dir, "common_ions.csv")
-        else:
-            common_csv_path = os.path.join(self.base_dir,
-                                           f"{num_molecules}-{energy_level}-{num_test}-common_ions.csv")
-
-        common_ions_sorted = sorted(common_ions_avg.items(), key=lambda x: x[1], reverse=True)
-
-        with open(common_csv_path, mode='w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(['ion', 'average_intensity'])
-            for ion, avg_intensity in common_ions_sorted:
-                writer.writerow([float(ion), float(avg_intensity)])
+                    if energy_section and line:
+                        fragments.append(line)
+                ions_per_file.append([(Decimal(ion), Decimal(intensity))
+                                      for ion, intensity in self.parse_fragments(fragments)])
+
+        common_ions_sorted = self.common_values(ions_per_file)
+        self.write_common_csv(f"{self.file_prefix(num_molecules, energy_level, num_test)}common_ions.csv", 'ion',
+                              common_ions_sorted)
 
 
 def main():
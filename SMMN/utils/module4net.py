@@ -1,11 +1,16 @@
 import pandas as pd
-import math
 import networkx as nx
 from pyvis.network import Network
-import bisect
-import re
-from collections import namedtuple
+import heapq
+import itertools
 import os
+import numpy as np
+from SMMN.utils.spectrum_store import SpectrumStore
+from SMMN.utils.candidate_pairs import CandidatePairIndex, SparseCosinePrefilter
+from SMMN.utils import parallel_scoring
+from SMMN.utils.spectral_alignment import (Match, Peak, Alignment, prepare_spectrum, calculate_alignment,
+                                           align_normalized_spectra, sqrt_normalize_spectrum,
+                                           find_match_peaks_efficient, alignment_to_match, convert_to_peaks)
 
 
 class Spectrum:
@@ -20,203 +25,198 @@ class Spectrum:
         self.some_other_param = some_other_param
 
 
-Match = namedtuple('Match', ['peak1', 'peak2', 'score'])
-Peak = namedtuple('Peak', ['mz', 'intensity'])
-Alignment = namedtuple('Alignment', ['peak1', 'peak2'])
-
-
 def generate_spectrum_network(mgf_file, cosine_score, peak_tolerance, top_k=10, component_size=5,
                               peak_matching_rate=0, structure_mz=0, k=10.0):
     spectra_collection = load_mgf_file(mgf_file)
 
     all_matches = generate_all_matches(spectra_collection, peak_tolerance, cosine_score, top_k)
 
-    csv_filename = match_to_csv(all_matches)
+    match_table = match_to_dataframe(all_matches)
 
-    G = draw_network(csv_filename, component_size, peak_matching_rate, structure_mz)
+    G = draw_network(match_table, cosine_score, component_size, peak_matching_rate, structure_mz)
 
     network_html = draw_interactive_network_with_communities(G, k)
 
     return network_html
 
 
-
-
 def load_mgf_file(filename):
-    spectra = []
-    current_spectrum = None
-
-    with open(filename, 'r') as f:
-        for line in f:
-            line = line.strip()
-
-            if line == 'BEGIN IONS':
-                current_spectrum = {
-                    'peaks': [],
-                    'mz': 0,
-                    'charge': 0,
-                    'rt': 0,
-                    'scan': 0,
-                    'filename': filename  # 保存当前文件名
-                }
-
-            elif line == 'END IONS':
-                if current_spectrum and len(current_spectrum['peaks']) > 0:
-                    spectra.append(current_spectrum)
-
-            elif line.startswith('PEPMASS='):
-                current_spectrum['mz'] = float(line.split('=')[1])
-
-            elif line.startswith('CHARGE='):
-                charge_str = line.split('=')[1].replace('+', '').replace('-', '')
-                current_spectrum['charge'] = int(charge_str)
-
-            elif line.startswith('RTINSECONDS='):
-                current_spectrum['rt'] = float(line.split('=')[1])
-
-            elif line.startswith('SCANS='):
-                current_spectrum['scan'] = int(line.split('=')[1])
-
-            elif re.match(r'\d+\.\d+ \d+', line):
-                mz, intensity = map(float, line.split())
-                current_spectrum['peaks'].append((mz, intensity))
-
-    return spectra
-
-def generate_all_matches(spectra_collection, peak_tolerance, cosine_score_threshold, top_k):
+    return SpectrumStore.from_mgf_file(filename).nonempty()
+
+class TopKMatches:
+    def __init__(self, size, top_k):
+        self.top_k = top_k
+        self.heaps = [[] for _ in range(size)]
+
+    def push(self, i, j, cosine_score, matched_peaks, swapped=False):
+        if self.top_k <= 0:
+            return
+        heap = self.heaps[i]
+        entry = (cosine_score, -j, matched_peaks, swapped)
+        if len(heap) < self.top_k:
+            heapq.heappush(heap, entry)
+        elif entry[:2] > heap[0][:2]:
+            heapq.heapreplace(heap, entry)
+
+    def matches(self, i):
+        for cosine_score, negative_j, matched_peaks, swapped in sorted(self.heaps[i], key=lambda e: (-e[0], e[1])):
+            if swapped:
+                matched_peaks = [Match(m.peak2, m.peak1, m.score) for m in matched_peaks]
+            yield -negative_j, cosine_score, matched_peaks
+
+
+def generate_all_matches(spectra_collection, peak_tolerance, cosine_score_threshold, top_k, prefilter='index',
+                         workers=1, quiet=False, pair_cache=None):
     all_matches = []
-
-    for i, base_spectrum in enumerate(spectra_collection):
-        print('base_spectrum', base_spectrum)
+    filename = spectra_collection.filename
+    top_matches = TopKMatches(len(spectra_collection), top_k)
+
+    if pair_cache is not None and cosine_score_threshold >= pair_cache.floor:
+        # the cache holds every pair above its floor, so a new threshold is only a filter over it
+        scored_pairs = pair_cache.scored_pairs(
+            spectra_collection, peak_tolerance,
+            lambda: score_all_pairs(spectra_collection, peak_tolerance, pair_cache.floor, prefilter, workers, quiet))
+        for i, j, cosine_score, matched_peaks in scored_pairs:
+            if cosine_score >= cosine_score_threshold:
+                top_matches.push(i, j, cosine_score, matched_peaks)
+                top_matches.push(j, i, cosine_score, matched_peaks, swapped=True)
+    elif workers > 1:
+        candidates = find_candidate_pairs(spectra_collection, peak_tolerance, cosine_score_threshold, prefilter, quiet)
+        left, right = upper_candidate_pairs(candidates)
+        for i, j, cosine_score, matched_peaks in parallel_scoring.score_pairs_parallel(
+                spectra_collection, left, right, peak_tolerance, cosine_score_threshold, top_k, workers):
+            top_matches.push(i, j, cosine_score, matched_peaks)
+    else:
+        for i, j, cosine_score, matched_peaks in score_all_pairs(spectra_collection, peak_tolerance,
+                                                                 cosine_score_threshold, prefilter, workers, quiet):
+            top_matches.push(i, j, cosine_score, matched_peaks)
+            top_matches.push(j, i, cosine_score, matched_peaks, swapped=True)
+
+    for i in range(len(spectra_collection)):
+        base_mz, base_intensity = spectra_collection.peaks(i)
+        if not quiet:
+            print('base_spectrum', spectra_collection.scan[i], list(zip(base_mz.tolist(), base_intensity.tolist())))
         match_list = []
 
-        for j, spectrum in enumerate(spectra_collection):
-            if i != j:
-                cosine_score, matched_peaks = score_alignment(base_spectrum, spectrum, peak_tolerance)
-                if cosine_score >= cosine_score_threshold:
-                    match_obj = {}
-                    match_obj["filename"] = base_spectrum['filename']
-                    match_obj["scan"] = base_spectrum['scan']
-                    match_obj["queryfilename"] = spectrum['filename']
-                    match_obj["queryscan"] = spectrum['scan']
-                    match_obj["mz1"] = spectrum['mz']
-                    match_obj["rt1"] = spectrum['rt']
-                    match_obj["mz2"] = base_spectrum['mz']
-                    match_obj["rt2"] = base_spectrum['rt']
-                    match_obj["cosine"] = cosine_score
-                    match_obj["matchedpeaks"] = matched_peaks
-                    match_obj["mzerror"] = abs(base_spectrum['mz'] - spectrum['mz'])
-                    match_obj['intensity'] = sum(peak[1] for peak in spectrum['peaks'])
-                    match_obj['source'] = "classical_molecular"
-                    match_obj["Peak-matching Rate"] = None
-                    match_list.append(match_obj)
+        for j, cosine_score, matched_peaks in top_matches.matches(i):
+            match_obj = {}
+            match_obj["filename"] = filename
+            match_obj["scan"] = int(spectra_collection.scan[i])
+            match_obj["queryfilename"] = filename
+            match_obj["queryscan"] = int(spectra_collection.scan[j])
+            match_obj["mz1"] = float(spectra_collection.pepmass[j])
+            match_obj["rt1"] = float(spectra_collection.rt[j])
+            match_obj["mz2"] = float(spectra_collection.pepmass[i])
+            match_obj["rt2"] = float(spectra_collection.rt[i])
+            match_obj["cosine"] = cosine_score
+            match_obj["matchedpeaks"] = matched_peaks
+            match_obj["mzerror"] = abs(float(spectra_collection.pepmass[i] - spectra_collection.pepmass[j]))
+            match_obj['intensity'] = float(spectra_collection.peaks(j)[1].sum())
+            match_obj['source'] = "classical_molecular"
+            match_obj["Peak-matching Rate"] = None
+            match_list.append(match_obj)
 
         if len(match_list) == 0:
             default_match = {
                 "filename": None,
                 "scan": None,
-                "queryfilename": base_spectrum['filename'],
-                "queryscan": base_spectrum['scan'],
-                "mz1": base_spectrum['mz'],
-                "rt1": base_spectrum['rt'],
+                "queryfilename": filename,
+                "queryscan": int(spectra_collection.scan[i]),
+                "mz1": float(spectra_collection.pepmass[i]),
+                "rt1": float(spectra_collection.rt[i]),
                 "mz2": None,
                 "rt2": None,
                 "cosine": 0,
                 "matchedpeaks": 0,
                 "mzerror": None,
-                "intensity": sum(peak[1] for peak in base_spectrum['peaks']),
+                "intensity": float(base_intensity.sum()),
                 "source": "classical_molecular",
                 "Peak-matching Rate": None
             }
             match_list.append(default_match)
 
-        match_list = sorted(match_list, key=lambda x: x['cosine'], reverse=True)[:top_k]
-        all_matches.extend(match_list)
+        all_matches.extend(match_list[:top_k])
 
     return all_matches
 
-def score_alignment(spectrum1, spectrum2, tolerance):
-    spec1_peaks = convert_to_peaks(spectrum1['peaks'])
-    spec2_peaks = convert_to_peaks(spectrum2['peaks'])
-    pm1 = spectrum1['mz']
-    pm2 = spectrum2['mz']
+def score_all_pairs(spectra_collection, peak_tolerance, cosine_score_threshold, prefilter='index', workers=1,
+                    quiet=False):
+    candidates = find_candidate_pairs(spectra_collection, peak_tolerance, cosine_score_threshold, prefilter, quiet)
+    if workers > 1:
+        left, right = upper_candidate_pairs(candidates)
+        return parallel_scoring.score_pairs_parallel(spectra_collection, left, right, peak_tolerance,
+                                                     cosine_score_threshold, None, workers)
+    return score_candidate_pairs(spectra_collection, candidates, peak_tolerance, cosine_score_threshold)
+
+
+def upper_candidate_pairs(candidates):
+    counts = np.fromiter((len(neighbours) for neighbours in candidates), dtype=np.int64, count=len(candidates))
+    left = np.repeat(np.arange(len(candidates), dtype=np.int64), counts)
+    right = np.fromiter(itertools.chain.from_iterable(candidates), dtype=np.int64, count=int(counts.sum()))
+    return left, right
+
+
+def find_candidate_pairs(spectra_collection, peak_tolerance, cosine_score_threshold, prefilter='index', quiet=False):
+    # candidates[i] holds the j > i worth aligning with i; unpruned rows stay lazy ranges
+    size = len(spectra_collection)
+    if prefilter is None:
+        return [range(i + 1, size) for i in range(size)]
+
+    if prefilter == 'index':
+        index = CandidatePairIndex(spectra_collection, peak_tolerance)
+        pairs = index.candidate_pairs(cosine_score_threshold)
+        if not quiet:
+            print(f"Candidate index pruned {index.pruned_pairs} of {index.total_pairs} spectrum pairs")
+    elif prefilter == 'sparse':
+        prefilter_matrix = SparseCosinePrefilter(spectra_collection, peak_tolerance)
+        pairs = prefilter_matrix.candidate_pairs(cosine_score_threshold)
+        if not quiet:
+            print(f"Sparse cosine prefilter pruned {prefilter_matrix.pruned_pairs} of "
+                  f"{prefilter_matrix.total_pairs} spectrum pairs")
+    else:
+        raise ValueError(f"Unknown prefilter: {prefilter}")
+
+    if pairs is None:
+        return [range(i + 1, size) for i in range(size)]
+    left, right = pairs
+    bounds = np.searchsorted(left, np.arange(size + 1))
+    return [right[bounds[i]:bounds[i + 1]].tolist() for i in range(size)]
+
+def prepare_spectra(spectra_collection):
+    prepared = []
+    for i in range(len(spectra_collection)):
+        mz, intensity = spectra_collection.peaks(i)
+        prepared.append(prepare_spectrum(mz.tolist(), intensity.tolist(), spectra_collection.pepmass[i]))
+    return prepared
+
+def score_candidate_pairs(spectra_collection, candidates, peak_tolerance, cosine_score_threshold):
+    prepared = prepare_spectra(spectra_collection)
+
+    for i, neighbours in enumerate(candidates):
+        spec1_n, _, pm1 = prepared[i]
+        for j in neighbours:
+            if j <= i:
+                continue
+            spec2_n, spec2_mass_list, pm2 = prepared[j]
+            cosine_score, matched_peaks = align_normalized_spectra(spec1_n, spec2_n, pm1, pm2, peak_tolerance,
+                                                                   spec2_mass_list=spec2_mass_list)
+            if cosine_score >= cosine_score_threshold:
+                yield i, j, cosine_score, matched_peaks
+
+def score_alignment(spectra_collection, i, j, tolerance):
+    spec1_peaks = convert_to_peaks(zip(*(array.tolist() for array in spectra_collection.peaks(i))))
+    spec2_peaks = convert_to_peaks(zip(*(array.tolist() for array in spectra_collection.peaks(j))))
+    pm1 = float(spectra_collection.pepmass[i])
+    pm2 = float(spectra_collection.pepmass[j])
 
     return calculate_alignment(spec1_peaks, spec2_peaks, pm1, pm2, tolerance)
 
-def calculate_alignment(spec1, spec2, pm1, pm2, tolerance, max_charge_consideration=1):
-    if len(spec1) == 0 or len(spec2) == 0:
-        return 0.0, []
-
-    spec1_n = sqrt_normalize_spectrum(spec1)
-    spec2_n = sqrt_normalize_spectrum(spec2)
-
-    shift = pm1 - pm2
-    zero_shift_alignments = find_match_peaks_efficient(spec1_n, spec2_n, 0, tolerance)
-    real_shift_alignments = find_match_peaks_efficient(spec1_n, spec2_n, shift, tolerance) if abs(
-        shift) > tolerance else []
-
-    if max_charge_consideration > 1:
-        for charge_considered in range(2, max_charge_consideration + 1):
-            real_shift_alignments += find_match_peaks_efficient(spec1_n, spec2_n, shift / charge_considered, tolerance)
-
-    real_shift_alignments = list(set(real_shift_alignments))
-
-    zero_shift_match = [alignment_to_match(spec1_n, spec2_n, alignment) for alignment in zero_shift_alignments]
-    real_shift_match = [alignment_to_match(spec1_n, spec2_n, alignment) for alignment in real_shift_alignments]
-
-    all_possible_match_scores = zero_shift_match + real_shift_match
-    all_possible_match_scores.sort(key=lambda x: x.score, reverse=True)
-
-    total_score = 0.0
-    reported_alignments = []
-    spec1_peak_used = set()
-    spec2_peak_used = set()
+MATCH_FIELDS = ["filename", "scan", "queryfilename", "queryscan", "mz1", "rt1", "mz2", "rt2", "cosine",
+                "matchedpeaks", "mzerror", "intensity", "source", "Peak-matching Rate"]
 
-    for match in all_possible_match_scores:
-        if match.peak1 not in spec1_peak_used and match.peak2 not in spec2_peak_used:
-            spec1_peak_used.add(match.peak1)
-            spec2_peak_used.add(match.peak2)
-            reported_alignments.append(match)
-            total_score += match.score
 
-    return total_score, reported_alignments
-
-
-def sqrt_normalize_spectrum(spectrum):
-    acc_norm = sum([s.intensity for s in spectrum])
-    normed_value = math.sqrt(acc_norm)
-    return [Peak(s.mz, math.sqrt(s.intensity) / normed_value) for s in spectrum]
-
-
-def find_match_peaks_efficient(spec1, spec2, shift, tolerance):
-    adj_tolerance = tolerance + 0.000001
-    spec2_mass_list = [peak.mz for peak in spec2]
-    alignment_mapping = []
-
-    for i, peak in enumerate(spec1):
-        left_bound = peak.mz - shift - adj_tolerance
-        right_bound = peak.mz - shift + adj_tolerance
-        left_index = bisect.bisect_left(spec2_mass_list, left_bound)
-        right_index = bisect.bisect_right(spec2_mass_list, right_bound)
-
-        for j in range(left_index, right_index):
-            alignment_mapping.append(Alignment(i, j))
-
-    return alignment_mapping
-
-
-def alignment_to_match(spec1_n, spec2_n, alignment):
-    s1_peak = spec1_n[alignment.peak1].intensity
-    s2_peak = spec2_n[alignment.peak2].intensity
-    match_score = s1_peak * s2_peak
-    return Match(alignment.peak1, alignment.peak2, match_score)
-
-def convert_to_peaks(peak_tuples):
-    return [Peak(*p) for p in peak_tuples]
-
-def match_to_csv(all_matches):
-    csv_filename = 'match.csv'
-    df = pd.DataFrame(all_matches)
+def match_to_dataframe(all_matches):
+    df = pd.DataFrame(all_matches, columns=MATCH_FIELDS)
     df.columns = ['Filename', 'CLUSTERID2', 'Query Filename', 'CLUSTERID1', "mz1", "rt1", "mz2", "rt2", 'Cosine',
                   'Matched Peaks',
                   'DeltaMZ',
@@ -224,64 +224,91 @@ def match_to_csv(all_matches):
     df_selected = df[
         ['CLUSTERID1', 'CLUSTERID2', 'Cosine', "mz1", "rt1", "mz2", "rt2", 'DeltaMZ', 'explained_intensity', 'source',
          "Peak-matching Rate"]]
-    df_selected.to_csv(csv_filename, index=False)
+    return df_selected
+
+
+def match_to_csv(all_matches):
+    csv_filename = 'match.csv'
+    match_to_dataframe(all_matches).to_csv(csv_filename, index=False)
     return csv_filename
 
 
 # 绘制网络图
-def draw_network(csv_filename, cosine_threshold, component_size=5, peak_matching_rate=0.0, structure_mz=0):
-    df = pd.read_csv(csv_filename)
+def draw_network(matches, cosine_threshold, component_size=5, peak_matching_rate=0.0, structure_mz=0):
+    df = pd.read_csv(matches) if isinstance(matches, str) else matches.reset_index(drop=True)
 
     G = nx.MultiGraph()
 
-    for i in range(len(df)):
-        node1 = standardize_node(df["CLUSTERID1"].iloc[i])
-        node2 = standardize_node(df["CLUSTERID2"].iloc[i])
-        source = df["source"].iloc[i]
-
-        # 根据来源设置颜色
-        color = "#87CEFA" if source == "classical_molecular" else "#CD5C5C"
-        edge_color = "#87CEFA" if source == "classical_molecular" else "#CD5C5C"
-        edge_style = "solid" if source == "classical_molecular" else "dashed"
-        EdgeType = "classical_molecular" if source == "classical_molecular" else "csmn"
-
-        valid_node1 = is_valid_node(node1)
-        valid_node2 = is_valid_node(node2)
-
-        mass_difference = df["DeltaMZ"].iloc[i]
-        retention_time1 = df["rt1"].iloc[i]
-        mz1 = df["mz1"].iloc[i]
-        retention_time2 = df["rt2"].iloc[i]
-        mz2 = df["mz2"].iloc[i]
-
-        cosine_score = float(df["Cosine"].iloc[i] or 0)
-
-        # 添加节点和边，根据来源设置属性
-        if valid_node1:
-            if not G.has_node(node1):
-                color = "#CD5C5C" if float(mz1) > structure_mz else color
-                G.add_node(node1, retention_time=retention_time1, mz=mz1, color=color, shape="dot")
-
-        if valid_node2:
-            if not G.has_node(node2):
-                color = "#CD5C5C" if float(mz2) > structure_mz else color
-                G.add_node(node2, retention_time=retention_time2, mz=mz2, color=color, shape="dot")
-
-        if valid_node1 and valid_node2:
-            if cosine_score >= cosine_threshold:
-                if not G.has_edge(node1, node2) and not G.has_edge(node2, node1):
-                    G.add_edge(node1, node2, mass_difference=mass_difference, cosine_score=cosine_score,
-                               component=-1, EdgeType=EdgeType, EdgeScore=cosine_score, style=edge_style, color=edge_color)
-
-    connected_components = list(nx.connected_components(G))
-    for component in connected_components:
-        if len(component) > component_size:
-            edges_to_remove = [(u, v) for u, v, d in G.edges(component, data=True) if 'cosine_score' in d]
-            edges_to_remove.sort(key=lambda x: x[2]['cosine_score'])
-            while len(component) > component_size and edges_to_remove:
-                edge_with_lowest_score = edges_to_remove.pop(0)
-                G.remove_edge(edge_with_lowest_score[0], edge_with_lowest_score[1])
-                component = max(nx.connected_components(G), key=len)
+    node1 = node_column(df["CLUSTERID1"])
+    node2 = node_column(df["CLUSTERID2"])
+    valid_node1 = node1.notna().to_numpy()
+    valid_node2 = node2.notna().to_numpy()
+    classical = (df["source"] == "classical_molecular").to_numpy()
+    mz1 = pd.to_numeric(df["mz1"], errors='coerce').to_numpy(dtype=float)
+    mz2 = pd.to_numeric(df["mz2"], errors='coerce').to_numpy(dtype=float)
+
+    # 根据来源设置颜色
+    base_color = np.where(classical, "#87CEFA", "#CD5C5C")
+
+    # nodes keep the attributes of the row that first mentions them, node1 before node2
+    rows = len(df)
+    occurrences = pd.DataFrame({
+        'node': np.concatenate([node1.to_numpy(dtype=object), node2.to_numpy(dtype=object)]),
+        'position': np.concatenate([np.arange(rows) * 2, np.arange(rows) * 2 + 1]),
+        'valid': np.concatenate([valid_node1, valid_node2]),
+    })
+    occurrences = occurrences[occurrences['valid']].sort_values('position', kind='stable')
+    first_positions = occurrences.drop_duplicates('node')['position'].to_numpy()
+    is_first = np.zeros(rows * 2, dtype=bool)
+    is_first[first_positions] = True
+    new_node1 = is_first[0::2]
+
+    node1_color = np.where(mz1 > structure_mz, "#CD5C5C", base_color)
+    node2_color = np.where(mz2 > structure_mz, "#CD5C5C", np.where(new_node1, node1_color, base_color)).tolist()
+    node1_color = node1_color.tolist()
+
+    retention_time1 = df["rt1"].tolist()
+    retention_time2 = df["rt2"].tolist()
+    mz1_values = df["mz1"].tolist()
+    mz2_values = df["mz2"].tolist()
+    node1_values = node1.tolist()
+    node2_values = node2.tolist()
+
+    # 添加节点和边，根据来源设置属性
+    nodes = []
+    for position in first_positions.tolist():
+        row = position // 2
+        if position % 2 == 0:
+            nodes.append((node1_values[row], dict(retention_time=retention_time1[row], mz=mz1_values[row],
+                                                  color=node1_color[row], shape="dot")))
+        else:
+            nodes.append((node2_values[row], dict(retention_time=retention_time2[row], mz=mz2_values[row],
+                                                  color=node2_color[row], shape="dot")))
+    G.add_nodes_from(nodes)
+
+    cosine_scores = pd.to_numeric(df["Cosine"], errors='coerce').to_numpy(dtype=float)
+    edge_rows = valid_node1 & valid_node2 & (cosine_scores >= cosine_threshold)
+
+    edges = pd.DataFrame({
+        'row': np.flatnonzero(edge_rows),
+        'node1': node1[edge_rows].to_numpy(dtype=object),
+        'node2': node2[edge_rows].to_numpy(dtype=object),
+    })
+    edges['low'] = np.where(edges['node1'] <= edges['node2'], edges['node1'], edges['node2'])
+    edges['high'] = np.where(edges['node1'] <= edges['node2'], edges['node2'], edges['node1'])
+    edges = edges.drop_duplicates(['low', 'high'])
+
+    mass_differences = df["DeltaMZ"].tolist()
+    edge_colors = base_color.tolist()
+    G.add_edges_from(
+        (u, v, dict(mass_difference=mass_differences[row], cosine_score=float(cosine_scores[row]), component=-1,
+                    EdgeType="classical_molecular" if classical[row] else "csmn",
+                    EdgeScore=float(cosine_scores[row]), style="solid" if classical[row] else "dashed",
+                    color=edge_colors[row]))
+        for row, u, v in zip(edges['row'].tolist(), edges['node1'].tolist(), edges['node2'].tolist())
+    )
+
+    prune_components(G, component_size)
 
     # 保存图形
     nx.write_graphml(G, "ClassicalNetwork.graphml")
@@ -289,23 +316,39 @@ def draw_network(csv_filename, cosine_threshold, component_size=5, peak_matching
 
 
 
-def is_valid_node(node):
-    if pd.isna(node) or node == "":
-        return False
-    try:
-        float(node)
-        return True
-    except ValueError:
-        return False
-
-
+def prune_components(G, component_size):
+    # GNPS-style pruning: edges are visited once from the highest cosine down and an edge is dropped
+    # whenever it would join two clusters into one larger than component_size
+    parent = {node: node for node in G.nodes}
+    size = {node: 1 for node in G.nodes}
 
-def standardize_node(node):
-    try:
-        return str(int(float(node)))
-    except ValueError:
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
         return node
 
+    edges = sorted(G.edges(keys=True, data='cosine_score'), key=lambda edge: edge[3], reverse=True)
+    for u, v, key, _ in edges:
+        root_u, root_v = find(u), find(v)
+        if root_u == root_v:
+            continue
+        if size[root_u] + size[root_v] > component_size:
+            G.remove_edge(u, v, key=key)
+            continue
+        if size[root_u] < size[root_v]:
+            root_u, root_v = root_v, root_u
+        parent[root_v] = root_u
+        size[root_u] += size[root_v]
+
+
+def node_column(column):
+    numeric = pd.to_numeric(column, errors='coerce')
+    valid = numeric.notna() & np.isfinite(numeric)
+    nodes = pd.Series(None, index=column.index, dtype=object)
+    nodes[valid] = numeric[valid].astype(np.int64).astype(str)
+    return nodes
+
 
 # 绘制交互式网络
 def draw_interactive_network_with_communities(G, k):
@@ -0,0 +1,220 @@
+import os
+import json
+import uuid
+import hashlib
+
+ENERGY_LEVELS = {'0': 'energy0', '1': 'energy1', '2': 'energy2'}
+ENERGY_LABELS = {'0': '10eV', '1': '20eV', '2': '40eV'}
+DIGEST_BYTES = 4096
+
+
+class OutputLogIndex:
+    def __init__(self, output_file, molecules):
+        self.output_file = output_file
+        self.molecules = molecules
+        self._by_id = {}
+        for molecule in molecules:
+            self._by_id.setdefault(molecule['id'], molecule)
+
+    @staticmethod
+    def index_path(output_file):
+        return output_file + '.index.json'
+
+    @classmethod
+    def load(cls, output_file):
+        stat = os.stat(output_file)
+        try:
+            with open(cls.index_path(output_file), 'r') as f:
+                sidecar = json.load(f)
+            # a rewrite within the mtime granularity keeps size and mtime_ns, so the ends of the file are compared too
+            if (sidecar['size'] == stat.st_size and sidecar['mtime_ns'] == stat.st_mtime_ns
+                    and sidecar['digest'] == cls.digest(output_file, stat.st_size)):
+                return cls(output_file, sidecar['molecules'])
+        except (OSError, ValueError, KeyError):
+            pass
+
+        index = cls.build(output_file)
+        index.save(stat)
+        return index
+
+    @classmethod
+    def build(cls, output_file):
+        # a molecule runs from the first '#' line of the header run holding its #ID= up to the next such run;
+        # each energyN range covers only the peak lines under that marker
+        molecules = []
+        current = None
+        energy = None
+        header_start = None
+        offset = 0
+
+        with open(output_file, 'rb') as f:
+            for raw_line in f:
+                line_start = offset
+                offset += len(raw_line)
+                line = raw_line.decode('utf-8', 'replace').strip()
+
+                if line.startswith('#'):
+                    if header_start is None:
+                        header_start = line_start
+                    if energy is not None:
+                        current['energies'][energy][1] = line_start
+                        energy = None
+
+                    if line.startswith('#ID='):
+                        if current is not None:
+                            current['end'] = header_start
+                        current = {'id': line.split('=')[-1], 'start': header_start, 'end': None, 'formula': '',
+                                   'pmass': '', 'energies': {}}
+                        molecules.append(current)
+                    elif current is not None and line.startswith('#Formula='):
+                        current['formula'] = line.split('=')[-1]
+                    elif current is not None and line.startswith('#PMass='):
+                        current['pmass'] = line.split('=')[-1]
+                    continue
+
+                header_start = None
+                if current is None:
+                    continue
+
+                if line.startswith('energy'):
+                    if energy is not None:
+                        current['energies'][energy][1] = line_start
+                    energy = line if line not in current['energies'] else None
+                    if energy is not None:
+                        current['energies'][energy] = [offset, None]
+                elif not line and energy is not None:
+                    current['energies'][energy][1] = line_start
+                    energy = None
+
+        if energy is not None:
+            current['energies'][energy][1] = offset
+        if current is not None:
+            current['end'] = offset
+        return cls(output_file, molecules)
+
+    @staticmethod
+    def digest(output_file, size):
+        digest = hashlib.sha256()
+        with open(output_file, 'rb') as f:
+            digest.update(f.read(DIGEST_BYTES))
+            if size > DIGEST_BYTES:
+                f.seek(max(size - DIGEST_BYTES, DIGEST_BYTES))
+                digest.update(f.read(DIGEST_BYTES))
+        return digest.hexdigest()
+
+    def save(self, stat=None):
+        stat = stat or os.stat(self.output_file)
+        temp_path = f"{self.index_path(self.output_file)}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                       'digest': self.digest(self.output_file, stat.st_size), 'molecules': self.molecules}, f)
+        os.replace(temp_path, self.index_path(self.output_file))
+
+    def molecule(self, molecule_id):
+        return self._by_id.get(molecule_id)
+
+    def read(self, start, end):
+        with open(self.output_file, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start).decode('utf-8', 'replace')
+
+    def molecule_text(self, molecule):
+        return self.read(molecule['start'], molecule['end'])
+
+    def spectrum(self, molecule_id, energy):
+        molecule = self.molecule(molecule_id)
+        return self.molecule_spectrum(molecule, energy) if molecule is not None else []
+
+    def molecule_spectrum(self, molecule, energy):
+        if energy not in molecule['energies']:
+            return []
+
+        start, end = molecule['energies'][energy]
+        spectrum_data = []
+        for line in self.read(start, end).splitlines():
+            parts = line.split()
+            if len(parts) >= 2:
+                spectrum_data.append([float(parts[0]), float(parts[1])])
+        return spectrum_data
+
+
+def count_new_molecules(output_file, offset=0):
+    # counts the #ID= lines written since offset; a trailing partial line is left for the next call
+    if not os.path.exists(output_file):
+        return 0, offset
+
+    with open(output_file, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+
+    end = data.rfind(b'\n') + 1
+    count = sum(1 for line in data[:end].splitlines() if line.strip().startswith(b'#ID='))
+    return count, offset + end
+
+
+def rename_molecule(text, molecule_id):
+    return ''.join(f"#ID={molecule_id}\n" if line.startswith('#ID=') else line
+                   for line in text.splitlines(keepends=True))
+
+
+def split_preamble(text):
+    # the '#' lines ahead of #ID= ('#In-silico ...', '#PREDICTED BY ...') describe the run, not the molecule
+    lines = text.splitlines(keepends=True)
+    for i, line in enumerate(lines):
+        if line.startswith('#ID='):
+            return ''.join(lines[:i]), ''.join(lines[i:])
+    return '', text
+
+
+def read_molecule_file(molecule_file):
+    molecules = []
+    with open(molecule_file, 'r') as f:
+        for line in f:
+            parts = line.split(None, 1)
+            if len(parts) == 2:
+                molecules.append((parts[0], parts[1].strip()))
+    return molecules
+
+
+def merge_output_logs(partial_files, molecules, output_file, cache=None, hits_file=None):
+    # writes every molecule block in molecule.txt order; fresh blocks are stored in the cache and the others are
+    # taken from hits_file, the cached blocks copied when the misses were computed, while molecules cfm-predict
+    # skipped stay absent. every part starts with its own run preamble, so only the first one is kept, at the top
+    indexes = [OutputLogIndex.build(partial_file) for partial_file in partial_files]
+    hits = OutputLogIndex.build(hits_file) if hits_file and os.path.exists(hits_file) else None
+
+    preamble = ''
+    for index in indexes:
+        if index.molecules:
+            preamble = split_preamble(index.molecule_text(index.molecules[0]))[0]
+            break
+    if not preamble and cache is not None:
+        preamble = cache.preamble()
+
+    written = 0
+    temp_path = f"{output_file}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'w') as out:
+        out.write(preamble)
+        for molecule_id, smiles in molecules:
+            text = None
+            for index in indexes:
+                molecule = index.molecule(molecule_id)
+                if molecule is not None:
+                    text = index.molecule_text(molecule)
+                    if cache is not None:
+                        cache.put(smiles, text)
+                    break
+
+            if text is None and hits is not None:
+                molecule = hits.molecule(molecule_id)
+                if molecule is not None:
+                    text = hits.molecule_text(molecule)
+            if text is not None:
+                text = split_preamble(text)[1]
+                out.write(text if text.endswith('\n') else text + '\n')
+                written += 1
+    os.replace(temp_path, output_file)
+
+    if cache is not None:
+        cache.evict()
+    return written
@@ -0,0 +1,112 @@
+import os
+import glob
+import uuid
+import hashlib
+import logging
+import numpy as np
+from SMMN.utils.spectral_alignment import Match
+
+logger = logging.getLogger(__name__)
+
+
+class PairScoreCache:
+    def __init__(self, cache_dir, floor=0.3, max_entries=32):
+        self.cache_dir = cache_dir
+        self.floor = floor
+        self.max_entries = max_entries
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, spectra_collection, peak_tolerance):
+        digest = hashlib.sha256()
+        for array in (spectra_collection.offsets, spectra_collection.mz, spectra_collection.intensity,
+                      spectra_collection.pepmass):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        digest.update(repr((float(peak_tolerance), float(self.floor))).encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def scored_pairs(self, spectra_collection, peak_tolerance, compute):
+        key = self.key(spectra_collection, peak_tolerance)
+        scored = self.load(key)
+        if scored is None:
+            scored = list(compute())
+            self.save(key, scored)
+        return scored
+
+    def load(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with np.load(path) as data:
+                left = data['left'].tolist()
+                right = data['right'].tolist()
+                scores = data['score'].tolist()
+                offsets = data['match_offsets'].tolist()
+                peak1 = data['match_peak1'].tolist()
+                peak2 = data['match_peak2'].tolist()
+                match_scores = data['match_score'].tolist()
+        except (OSError, KeyError, ValueError) as e:
+            logger.warning("Discarding unreadable pair cache %s: %s", path, e)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return [(left[k], right[k], scores[k],
+                 [Match(*m) for m in zip(peak1[offsets[k]:offsets[k + 1]], peak2[offsets[k]:offsets[k + 1]],
+                                         match_scores[offsets[k]:offsets[k + 1]])])
+                for k in range(len(left))]
+
+    def save(self, key, scored):
+        matched = [m for _, _, _, matched_peaks in scored for m in matched_peaks]
+        offsets = np.zeros(len(scored) + 1, dtype=np.int64)
+        np.cumsum([len(matched_peaks) for _, _, _, matched_peaks in scored], out=offsets[1:])
+
+        # a unique temp name outside the *.npz glob, so concurrent writers and evict() never touch it
+        temp_path = f"{self.path(key)}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                np.savez(
+                    f,
+                    left=np.array([pair[0] for pair in scored], dtype=np.int32),
+                    right=np.array([pair[1] for pair in scored], dtype=np.int32),
+                    score=np.array([pair[2] for pair in scored], dtype=np.float64),
+                    match_offsets=offsets,
+                    match_peak1=np.array([m[0] for m in matched], dtype=np.int32),
+                    match_peak2=np.array([m[1] for m in matched], dtype=np.int32),
+                    match_score=np.array([m[2] for m in matched], dtype=np.float64),
+                )
+            os.replace(temp_path, self.path(key))
+        except OSError as e:
+            # the scores were computed already; a cache that cannot be written only costs the next request
+            logger.warning("Could not store pair cache %s: %s", self.path(key), e)
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*.npz')):
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except FileNotFoundError:
+                continue
+
+        entries.sort(reverse=True)
+        for _, path in entries[self.max_entries:]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
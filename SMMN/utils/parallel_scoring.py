@@ -0,0 +1,163 @@
+import heapq
+import math
+import atexit
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory, util
+import numpy as np
+from SMMN.utils.spectral_alignment import Match, prepare_spectrum, align_normalized_spectra
+
+_pool = None
+_pool_workers = None
+_pool_lock = threading.Lock()
+
+_worker_arrays = {}
+_worker_blocks = []
+_worker_prepared = {}
+_worker_specs = None
+
+
+def score_pairs_parallel(spectra_collection, left, right, peak_tolerance, cosine_score_threshold, top_k, workers,
+                         blocks_per_worker=4):
+    arrays = {
+        'mz': spectra_collection.mz,
+        'intensity': spectra_collection.intensity,
+        'offsets': spectra_collection.offsets,
+        'pepmass': spectra_collection.pepmass,
+        'left': np.asarray(left, dtype=np.int64),
+        'right': np.asarray(right, dtype=np.int64),
+    }
+    blocks = {}
+    try:
+        for name, array in arrays.items():
+            blocks[name] = _share_array(array)
+        specs = {name: (block.name, array.shape, array.dtype.str) for (name, block), array in
+                 zip(blocks.items(), arrays.values())}
+
+        pair_count = len(arrays['left'])
+        block_size = max(1, math.ceil(pair_count / (workers * blocks_per_worker)))
+        ranges = [(start, min(start + block_size, pair_count)) for start in range(0, pair_count, block_size)]
+
+        merged = {}
+        scored_pairs = []
+        pool = process_pool(workers)
+        try:
+            results = list(pool.map(_score_block, [specs] * len(ranges), ranges, [peak_tolerance] * len(ranges),
+                                    [cosine_score_threshold] * len(ranges), [top_k] * len(ranges)))
+        except BrokenProcessPool:
+            shutdown_process_pool()
+            raise
+
+        for block_matches in results:
+            if top_k is None:
+                scored_pairs.extend(block_matches)
+                continue
+            for i, matches in block_matches.items():
+                merged.setdefault(i, []).extend(matches)
+    finally:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+
+    # without top_k every scored pair is returned once, in the order it was given
+    for i, j, cosine_score, matched_peaks in scored_pairs:
+        yield i, j, cosine_score, [Match(*m) for m in matched_peaks]
+
+    for i, matches in merged.items():
+        for j, cosine_score, matched_peaks in select_top_k(matches, top_k):
+            yield i, j, cosine_score, [Match(*m) for m in matched_peaks]
+
+
+def select_top_k(matches, top_k):
+    return heapq.nsmallest(max(top_k, 0), matches, key=lambda match: (-match[1], match[0]))
+
+
+def process_pool(workers):
+    # one executor per process, rebuilt only when the worker count changes; each call sends the names of its
+    # shared blocks along with the work
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown()
+            else:
+                atexit.register(shutdown_process_pool)
+            _pool = ProcessPoolExecutor(max_workers=workers)
+            _pool_workers = workers
+        return _pool
+
+
+def shutdown_process_pool():
+    global _pool, _pool_workers
+    with _pool_lock:
+        pool, _pool, _pool_workers = _pool, None, None
+    if pool is not None:
+        pool.shutdown()
+
+
+def _share_array(array):
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block
+
+
+def _attach_shared_arrays(specs):
+    # a worker keeps the blocks of the last call mapped; they are closed when the next call brings new ones
+    # and, through the multiprocessing finalizer registered on first use, when the worker exits
+    global _worker_specs
+    if specs == _worker_specs:
+        return
+    if _worker_specs is None:
+        util.Finalize(None, _detach_shared_arrays, exitpriority=10)
+
+    _detach_shared_arrays()
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _worker_blocks.append(block)
+        _worker_arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    _worker_specs = specs
+
+
+def _detach_shared_arrays():
+    global _worker_specs
+    _worker_arrays.clear()
+    _worker_prepared.clear()
+    while _worker_blocks:
+        _worker_blocks.pop().close()
+    _worker_specs = None
+
+
+def _prepared_spectrum(i):
+    if i not in _worker_prepared:
+        offsets = _worker_arrays['offsets']
+        start, end = offsets[i], offsets[i + 1]
+        _worker_prepared[i] = prepare_spectrum(_worker_arrays['mz'][start:end].tolist(),
+                                               _worker_arrays['intensity'][start:end].tolist(),
+                                               _worker_arrays['pepmass'][i])
+    return _worker_prepared[i]
+
+
+def _score_block(specs, pair_range, peak_tolerance, cosine_score_threshold, top_k):
+    _attach_shared_arrays(specs)
+    start, stop = pair_range
+    left = _worker_arrays['left'][start:stop].tolist()
+    right = _worker_arrays['right'][start:stop].tolist()
+    block_matches = {}
+    scored_pairs = []
+
+    for i, j in zip(left, right):
+        spec1_n, _, pm1 = _prepared_spectrum(i)
+        spec2_n, spec2_mass_list, pm2 = _prepared_spectrum(j)
+        cosine_score, matched_peaks = align_normalized_spectra(spec1_n, spec2_n, pm1, pm2, peak_tolerance,
+                                                               spec2_mass_list=spec2_mass_list)
+        if cosine_score >= cosine_score_threshold and top_k is None:
+            scored_pairs.append((i, j, cosine_score, [tuple(m) for m in matched_peaks]))
+        elif cosine_score >= cosine_score_threshold:
+            block_matches.setdefault(i, []).append((j, cosine_score, [tuple(m) for m in matched_peaks]))
+            block_matches.setdefault(j, []).append((i, cosine_score, [(m.peak2, m.peak1, m.score)
+                                                                      for m in matched_peaks]))
+
+    if top_k is None:
+        return scored_pairs
+    return {i: select_top_k(matches, top_k) for i, matches in block_matches.items()}
@@ -0,0 +1,116 @@
+import os
+import glob
+import uuid
+import hashlib
+from SMMN.utils.output_log import read_molecule_file, rename_molecule, split_preamble
+
+_param_digests = {}
+
+
+def param_digest(path):
+    # param_output.log holds the trained model, so its digest is kept per (path, size, mtime) within a process
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return 'missing'
+
+    stamp = (path, stat.st_size, stat.st_mtime_ns)
+    if stamp not in _param_digests:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        _param_digests[stamp] = digest.hexdigest()
+    return _param_digests[stamp]
+
+
+class PredictionCache:
+    def __init__(self, cache_dir, param_files, options='', max_entries=5000):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        digest = hashlib.sha256(options.encode())
+        for path in param_files:
+            digest.update(param_digest(path).encode())
+        self.params = digest.hexdigest()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def normalize_smiles(smiles):
+        return ''.join(smiles.split())
+
+    def key(self, smiles):
+        return hashlib.sha256(f"{self.params}\n{self.normalize_smiles(smiles)}".encode()).hexdigest()
+
+    def path(self, smiles):
+        return os.path.join(self.cache_dir, f"{self.key(smiles)}.log")
+
+    def get(self, smiles, molecule_id):
+        path = self.path(smiles)
+        try:
+            with open(path, 'r') as f:
+                text = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        # the block was predicted under another job's molecule ID
+        return rename_molecule(text, molecule_id)
+
+    def preamble_path(self):
+        return os.path.join(self.cache_dir, f"{self.params}.preamble")
+
+    def preamble(self):
+        try:
+            with open(self.preamble_path(), 'r') as f:
+                return f.read()
+        except FileNotFoundError:
+            return ''
+
+    def put(self, smiles, text):
+        # only the molecule block is kept per SMILES; the run preamble is the same for every run with these
+        # parameters, so it is kept once for outputs that are assembled from cached blocks alone
+        preamble, block = split_preamble(text)
+        self.write(self.path(smiles), block)
+        if preamble and not os.path.exists(self.preamble_path()):
+            self.write(self.preamble_path(), preamble)
+
+    @staticmethod
+    def write(path, text):
+        temp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(text)
+        os.replace(temp_path, path)
+
+    def write_misses(self, molecule_file, misses_file, hits_file=None):
+        # hits are copied into hits_file right away, so an eviction before the merge cannot drop them
+        misses = []
+        hits = []
+        for molecule_id, smiles in read_molecule_file(molecule_file):
+            text = self.get(smiles, molecule_id)
+            if text is None:
+                misses.append((molecule_id, smiles))
+            else:
+                hits.append(text if text.endswith('\n') else text + '\n')
+
+        if hits_file is not None:
+            if hits:
+                with open(hits_file, 'w') as f:
+                    f.writelines(hits)
+            elif os.path.exists(hits_file):
+                os.remove(hits_file)
+
+        if misses:
+            with open(misses_file, 'w') as f:
+                for molecule_id, smiles in misses:
+                    f.write(f"{molecule_id} {smiles}\n")
+        elif os.path.exists(misses_file):
+            os.remove(misses_file)
+        return len(misses)
+
+    def evict(self):
+        entries = sorted(glob.glob(os.path.join(self.cache_dir, '*.log')), key=os.path.getmtime, reverse=True)
+        for path in entries[self.max_entries:]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -1,5 +1,8 @@
 import docker
 import os
+from SMMN.utils.output_log import merge_output_logs, read_molecule_file
+from SMMN.utils.prediction_cache import PredictionCache
+from SMMN.utils.simulator_backends import DockerBackend
 
 class CFMIDSimulator:
     ENERGY_LEVELS = {
@@ -8,36 +11,32 @@ class CFMIDSimulator:
         2: "energy2"
     }
 
-    def __init__(self, base_dir):
+    def __init__(self, base_dir, cache_dir=None, cache_entries=5000, backend=None):
         self.base_dir = base_dir
-        self.client = docker.from_env()
+        self.backend = backend or DockerBackend()
         self.molecule_file = os.path.join(base_dir, "molecule.txt")
         self.param_output_file = os.path.join(base_dir, "param_output.log")
         self.param_config_file = os.path.join(base_dir, "param_config.txt")
         self.output_file = os.path.join(base_dir, "output.log")
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = PredictionCache(cache_dir, [self.param_config_file, self.param_output_file],
+                                         options=f"{self.backend.identity} 0.001 1 0 0", max_entries=cache_entries)
 
     def write_molecules_to_file(self, molecules):
         with open(self.molecule_file, "w") as f:
             for idx, smiles in enumerate(molecules):
                 f.write(f"Molecule{idx+1} {smiles}\n")
 
-    def run_simulation(self):
+    def run_simulation(self, molecule_file=None, output_file=None):
         try:
-            container = self.client.containers.run(
-                image="wishartlab/cfmid",
-                command=f"cfm-predict /data/molecule.txt 0.001 /data/param_output.log /data/param_config.txt 1 /data/output.log 0 0",
-                volumes={
-                    self.base_dir: {"bind": "/data", "mode": "rw"}
-                },
-                platform="linux/amd64",
-                detach=True
-            )
+            container = self.backend.start(molecule_file or self.molecule_file, output_file or self.output_file,
+                                           self.param_output_file, self.param_config_file, annotate=1)
 
+            for chunk in container.logs(stream=True, follow=True):
+                print(chunk.decode("utf-8", "replace"), end='')
             container.wait()
 
-            logs = container.logs().decode("utf-8")
-            print(logs)
-
         except docker.errors.ContainerError as e:
             print(f"Error running container: {e}")
         except Exception as e:
@@ -46,7 +45,24 @@ class CFMIDSimulator:
             if 'container' in locals():
                 container.remove()
 
-    def read_and_filter_output_file(self, energy_level, num_molecules=None, energy_level_test=None, num_test=None):
+    def run_cached_simulation(self):
+        misses_file = os.path.join(self.base_dir, "molecule.misses.txt")
+        misses_output = os.path.join(self.base_dir, "output.misses.log")
+        hits_file = os.path.join(self.base_dir, "output.hits.log")
+        if os.path.exists(misses_output):
+            os.remove(misses_output)
+
+        if self.cache.write_misses(self.molecule_file, misses_file, hits_file):
+            self.run_simulation(misses_file, misses_output)
+
+        partial_files = [misses_output] if os.path.exists(misses_output) else []
+        merge_output_logs(partial_files, read_molecule_file(self.molecule_file), self.output_file, self.cache,
+                          hits_file)
+        if os.path.exists(hits_file):
+            os.remove(hits_file)
+
+    def read_and_filter_output_file(self, energy_level, num_molecules=None, energy_level_test=None, num_test=None,
+                                    write_logs=True):
         fragments = {}
         current_molecule_info = {}
         current_molecule = None
@@ -81,7 +97,7 @@ class CFMIDSimulator:
                             fragments[current_molecule].append(f"{mass} {intensity}")
 
             # Write each molecule's data to its own file
-            for molecule, fragment_list in fragments.items():
+            for molecule, fragment_list in (fragments.items() if write_logs else []):
                 if num_molecules is not None and energy_level_test is not None and num_test is not None:
                     log_file_name = f"{num_molecules}-{energy_level_test}-{num_test}-{molecule}.log"
                 else:
@@ -99,10 +115,14 @@ class CFMIDSimulator:
 
         return fragments
 
-    def simulate_fragments(self, smiles_list, energy_level, num_molecules=None, energy_level_test=None, num_test=None):
+    def simulate_fragments(self, smiles_list, energy_level, num_molecules=None, energy_level_test=None, num_test=None,
+                           write_logs=True):
         self.write_molecules_to_file(smiles_list)
-        self.run_simulation()
-        self.read_and_filter_output_file(energy_level, num_molecules, energy_level_test, num_test)
+        if self.cache is None:
+            self.run_simulation()
+        else:
+            self.run_cached_simulation()
+        return self.read_and_filter_output_file(energy_level, num_molecules, energy_level_test, num_test, write_logs)
 
 
 
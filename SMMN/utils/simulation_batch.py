@@ -0,0 +1,186 @@
+import os
+import glob
+import json
+import time
+import uuid
+import fcntl
+import shutil
+from SMMN.utils.output_log import OutputLogIndex, rename_molecule
+
+RESULT_FILE = 'batch.json'
+RUNNING_FILE = 'batch.running.json'
+
+
+class SimulationSpool:
+    # small jobs are spooled as json entries; whichever waiting job holds the leader lock sleeps for the window,
+    # claims a batch of entries, runs them as one molecule.txt and writes each job's part back to its directory
+    def __init__(self, root, window=2.0, max_molecules=50):
+        self.root = root
+        self.spool_dir = os.path.join(root, 'spool')
+        self.window = window
+        self.max_molecules = max_molecules
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+    def entry_path(self, job_id):
+        return os.path.join(self.spool_dir, f"{job_id}.json")
+
+    @staticmethod
+    def result_path(user_directory):
+        return os.path.join(user_directory, RESULT_FILE)
+
+    def submit(self, job_id, user_directory, molecules, output_file):
+        result_path = self.result_path(user_directory)
+        if os.path.exists(result_path):
+            os.remove(result_path)
+
+        write_json(self.entry_path(job_id), {'job_id': job_id, 'user_directory': user_directory,
+                                             'molecules': molecules, 'output_file': output_file})
+
+    def wait(self, job_id, user_directory, run, timeout, on_progress=None):
+        # run(molecule_file, output_file, on_batch_progress) is only called while this job leads a batch; every
+        # job, the leader included, reports its own molecule count read from the batch output, never batch totals
+        deadline = time.monotonic() + timeout
+        result_path = self.result_path(user_directory)
+        done = None
+
+        def report(*_):
+            nonlocal done
+            if on_progress is None:
+                return
+            progress = self.progress(job_id, user_directory)
+            if progress is not None and progress != done:
+                done = progress
+                on_progress(done)
+
+        while True:
+            if os.path.exists(result_path):
+                with open(result_path, 'r') as f:
+                    result = json.load(f)
+                os.remove(result_path)
+                return result
+
+            if os.path.exists(self.entry_path(job_id)):
+                self.lead(lambda molecule_file, output_file: run(molecule_file, output_file, report))
+
+            report()
+
+            if time.monotonic() > deadline:
+                self.withdraw(job_id)
+                raise TimeoutError(f"Batched simulation did not finish within {timeout} seconds")
+            time.sleep(min(self.window, 0.5) or 0.1)
+
+    def progress(self, job_id, user_directory):
+        try:
+            with open(os.path.join(user_directory, RUNNING_FILE), 'r') as f:
+                output_file = json.load(f)['output_file']
+            with open(output_file, 'rb') as f:
+                return f.read().count(f"#ID={job_id}__".encode())
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def withdraw(self, job_id):
+        try:
+            os.remove(self.entry_path(job_id))
+        except FileNotFoundError:
+            pass
+
+    def lead(self, run):
+        # the lock is released when its holder exits, so a crashed leader never blocks the spool
+        with open(os.path.join(self.root, 'leader.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+
+            try:
+                time.sleep(self.window)
+                batch_directory = os.path.join(self.root, str(uuid.uuid4()))
+                os.makedirs(batch_directory)
+                try:
+                    entries = self.claim(batch_directory)
+                    if entries:
+                        self.run_batch(entries, batch_directory, run)
+                finally:
+                    shutil.rmtree(batch_directory, ignore_errors=True)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return True
+
+    def claim(self, batch_directory):
+        # oldest entries first; a job is never split across batches, but the first one is always taken
+        entries = []
+        molecule_count = 0
+        for path in self.pending_entries():
+            claimed_path = os.path.join(batch_directory, os.path.basename(path))
+            try:
+                with open(path, 'r') as f:
+                    entry = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+
+            if entries and molecule_count + len(entry['molecules']) > self.max_molecules:
+                break
+            try:
+                os.rename(path, claimed_path)
+            except FileNotFoundError:
+                continue
+            entries.append(entry)
+            molecule_count += len(entry['molecules'])
+        return entries
+
+    def pending_entries(self):
+        # entries withdrawn while the spool is listed are skipped rather than failing the sort
+        stamped = []
+        for path in glob.glob(os.path.join(self.spool_dir, '*.json')):
+            try:
+                stamped.append((os.path.getmtime(path), path))
+            except FileNotFoundError:
+                continue
+        return [path for _, path in sorted(stamped)]
+
+    def run_batch(self, entries, batch_directory, run):
+        molecule_file = os.path.join(batch_directory, 'molecule.txt')
+        output_file = os.path.join(batch_directory, 'output.log')
+        with open(molecule_file, 'w') as f:
+            for entry in entries:
+                for molecule_id, smiles in entry['molecules']:
+                    f.write(f"{entry['job_id']}__{molecule_id} {smiles}\n")
+        for entry in entries:
+            self.write_running(entry, output_file)
+
+        try:
+            run(molecule_file, output_file)
+            if not os.path.exists(output_file):
+                raise FileNotFoundError('output.log not found.')
+            index = OutputLogIndex.build(output_file)
+        except Exception as e:
+            print(f"Batched simulation failed: {e}")
+            for entry in entries:
+                self.write_result(entry, {'status': 'FAILURE', 'error': str(e)})
+            return
+
+        for entry in entries:
+            with open(entry['output_file'], 'w') as out:
+                for molecule_id, _ in entry['molecules']:
+                    molecule = index.molecule(f"{entry['job_id']}__{molecule_id}")
+                    if molecule is not None:
+                        text = rename_molecule(index.molecule_text(molecule), molecule_id)
+                        out.write(text if text.endswith('\n') else text + '\n')
+            self.write_result(entry, {'status': 'SUCCESS', 'batch_jobs': len(entries)})
+
+    def write_running(self, entry, output_file):
+        write_json(os.path.join(entry['user_directory'], RUNNING_FILE), {'output_file': output_file})
+
+    def write_result(self, entry, result):
+        write_json(self.result_path(entry['user_directory']), result)
+        try:
+            os.remove(os.path.join(entry['user_directory'], RUNNING_FILE))
+        except FileNotFoundError:
+            pass
+
+
+def write_json(path, data):
+    temp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
@@ -0,0 +1,169 @@
+import os
+import queue
+import shlex
+import random
+import hashlib
+import itertools
+import threading
+import subprocess
+import docker
+
+# every backend returns a handle with the part of the docker container interface the callers use:
+# reload(), status, logs(stream=True, follow=True), wait(timeout), kill() and remove()
+
+
+def predict_arguments(molecule_file_path, output_file_path, param_output_file, param_config_file, annotate=0):
+    return [molecule_file_path, '0.001', param_output_file, param_config_file, str(annotate), output_file_path,
+            '0', '0']
+
+
+class DockerBackend:
+    def __init__(self, image="wishartlab/cfmid", mem_limit=None, nano_cpus=None):
+        self.image = image
+        self.identity = image
+        self.limits = {}
+        if mem_limit:
+            self.limits['mem_limit'] = mem_limit
+        if nano_cpus:
+            self.limits['nano_cpus'] = nano_cpus
+
+    def start(self, molecule_file_path, output_file_path, param_output_file, param_config_file, annotate=0):
+        # the output is written next to the molecule file; the parameter files are mounted read-only
+        data_directory = os.path.dirname(os.path.abspath(molecule_file_path))
+        config_directory = os.path.dirname(os.path.abspath(param_output_file))
+        arguments = predict_arguments(f"/data/{os.path.basename(molecule_file_path)}",
+                                      f"/data/{os.path.basename(output_file_path)}",
+                                      f"/config/{os.path.basename(param_output_file)}",
+                                      f"/config/{os.path.basename(param_config_file)}", annotate)
+        return docker.from_env().containers.run(
+            image=self.image,
+            command="cfm-predict " + " ".join(arguments),
+            volumes={
+                data_directory: {"bind": "/data", "mode": "rw"},
+                config_directory: {"bind": "/config", "mode": "ro"}
+            },
+            platform="linux/amd64",
+            detach=True,
+            **self.limits
+        )
+
+
+class ProcessHandle:
+    def __init__(self, args, cpu=None):
+        # the child pins itself between fork and exec, so cfm-predict never starts on another core
+        pin = None
+        if cpu is not None and hasattr(os, 'sched_setaffinity'):
+            pin = lambda: os.sched_setaffinity(0, {cpu})
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, preexec_fn=pin)
+        self.status = 'running'
+
+    def reload(self):
+        if self.process.poll() is not None:
+            self.status = 'exited'
+
+    def logs(self, stream=True, follow=True):
+        return iter(self.process.stdout.readline, b'')
+
+    def wait(self, timeout=None):
+        self.process.wait(timeout)
+        self.status = 'exited'
+        return {'StatusCode': self.process.returncode}
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+        self.status = 'exited'
+
+    def remove(self):
+        if self.process.poll() is None:
+            self.kill()
+        self.process.stdout.close()
+
+
+class SubprocessBackend:
+    # runs cfm-predict natively; with cpus each job is pinned to the next core in turn
+    def __init__(self, command='cfm-predict', cpus=None):
+        self.args = shlex.split(command) if isinstance(command, str) else list(command)
+        self.identity = ' '.join(self.args)
+        self._cpus = None
+        if cpus:
+            cpus = list(cpus)
+            # prefork workers each build their own backend, so start the rotation at a per-process offset
+            start = os.getpid() % len(cpus)
+            self._cpus = itertools.cycle(cpus[start:] + cpus[:start])
+        self._lock = threading.Lock()
+
+    def start(self, molecule_file_path, output_file_path, param_output_file, param_config_file, annotate=0):
+        cpu = None
+        if self._cpus is not None:
+            with self._lock:
+                cpu = next(self._cpus)
+        arguments = predict_arguments(molecule_file_path, output_file_path, param_output_file, param_config_file,
+                                      annotate)
+        return ProcessHandle(self.args + arguments, cpu)
+
+
+class FakeHandle:
+    def __init__(self, molecule_file_path, output_file_path, delay):
+        self.status = 'running'
+        self._output = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, args=(molecule_file_path, output_file_path, delay),
+                                        daemon=True)
+        self._thread.start()
+
+    def run(self, molecule_file_path, output_file_path, delay):
+        with open(molecule_file_path, 'r') as f:
+            molecules = [line.split(None, 1) for line in f if line.strip()]
+
+        with open(output_file_path, 'w') as out:
+            for parts in molecules:
+                if self._stop.wait(delay):
+                    break
+                if len(parts) == 2:
+                    out.write(FakeBackend.spectrum_text(parts[0], parts[1].strip()))
+                    out.flush()
+                    self._output.put(f"Predicted {parts[0]}\n".encode())
+
+        self.status = 'exited'
+        self._output.put(None)
+
+    def reload(self):
+        pass
+
+    def logs(self, stream=True, follow=True):
+        return iter(self._output.get, None)
+
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+        return {'StatusCode': 0}
+
+    def kill(self):
+        self._stop.set()
+        self._thread.join()
+
+    def remove(self):
+        self.kill()
+
+
+class FakeBackend:
+    # writes deterministic CFM-ID style spectra in-process, for load testing the pipeline without containers
+    identity = 'fake'
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    def start(self, molecule_file_path, output_file_path, param_output_file, param_config_file, annotate=0):
+        return FakeHandle(molecule_file_path, output_file_path, self.delay)
+
+    @staticmethod
+    def spectrum_text(molecule_id, smiles):
+        rng = random.Random(hashlib.sha256(smiles.encode()).hexdigest())
+        precursor_mass = round(rng.uniform(150, 900), 5)
+        lines = ["#In-silico ESI-MS/MS [M+H]+ Spectra", "#PREDICTED BY FAKE SIMULATOR", f"#ID={molecule_id}",
+                 f"#SMILES={smiles}", "#InChiKey=", "#Formula=", f"#PMass={precursor_mass}"]
+        for energy in range(3):
+            lines.append(f"energy{energy}")
+            peaks = sorted(round(rng.uniform(50, precursor_mass), 5) for _ in range(rng.randint(3, 20)))
+            lines += [f"{peak} {round(rng.uniform(0.5, 100), 3)}" for peak in peaks]
+        return "\n".join(lines) + "\n\n"
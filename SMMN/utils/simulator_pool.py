@@ -0,0 +1,278 @@
+import os
+import fcntl
+import queue
+import shlex
+import atexit
+import threading
+import docker
+from SMMN.utils.simulator_backends import predict_arguments
+
+
+PID_FILE = '/tmp/cfm-predict.pid'
+
+
+class DockerWorker:
+    # one long-lived container of the docker backend's image; every job is a cfm-predict exec inside it,
+    # so no container starts per job
+    def __init__(self, backend, data_root, param_output_file, param_config_file):
+        self.data_root = os.path.abspath(data_root)
+        self.param_output_file = os.path.basename(param_output_file)
+        self.param_config_file = os.path.basename(param_config_file)
+        self.container = docker.from_env().containers.run(
+            image=backend.image,
+            command="sleep infinity",
+            volumes={
+                self.data_root: {"bind": "/data", "mode": "rw"},
+                os.path.dirname(os.path.abspath(param_output_file)): {"bind": "/config", "mode": "ro"}
+            },
+            platform="linux/amd64",
+            detach=True,
+            **backend.limits
+        )
+
+    def container_path(self, path):
+        relative_path = os.path.relpath(os.path.abspath(path), self.data_root)
+        if relative_path.startswith('..'):
+            raise ValueError(f"{path} is outside the simulator data directory {self.data_root}")
+        return '/data/' + relative_path.replace(os.sep, '/')
+
+    def healthy(self):
+        try:
+            self.container.reload()
+        except docker.errors.APIError:
+            return False
+        return self.container.status == 'running'
+
+    def run(self, molecule_file_path, output_file_path, on_output):
+        command = ['cfm-predict'] + predict_arguments(self.container_path(molecule_file_path),
+                                                      self.container_path(output_file_path),
+                                                      f"/config/{self.param_output_file}",
+                                                      f"/config/{self.param_config_file}")
+        # the exec records its pid so a cancelled job can be killed without taking the warm container down
+        result = self.container.exec_run(['sh', '-c', f"echo $$ > {PID_FILE}; exec {shlex.join(command)}"],
+                                         stream=True)
+        for chunk in result.output:
+            on_output(chunk)
+
+    def kill(self):
+        try:
+            self.container.exec_run(['sh', '-c', f"kill -9 $(cat {PID_FILE})"])
+        except docker.errors.APIError:
+            pass
+
+    def close(self):
+        try:
+            self.container.remove(force=True)
+        except docker.errors.APIError:
+            pass
+
+
+class BackendWorker:
+    # runs each job through a subprocess or fake backend; used when there is no container to keep warm
+    def __init__(self, backend, param_output_file, param_config_file):
+        self.backend = backend
+        self.param_output_file = param_output_file
+        self.param_config_file = param_config_file
+        self.handle = None
+
+    def healthy(self):
+        return True
+
+    def run(self, molecule_file_path, output_file_path, on_output):
+        self.handle = self.backend.start(molecule_file_path, output_file_path, self.param_output_file,
+                                         self.param_config_file)
+        try:
+            for chunk in self.handle.logs(stream=True, follow=True):
+                on_output(chunk)
+            self.handle.wait()
+        finally:
+            self.handle.remove()
+            self.handle = None
+
+    def kill(self):
+        handle = self.handle
+        if handle is not None:
+            handle.kill()
+
+    def close(self):
+        self.kill()
+
+
+class PoolJob:
+    # exposes the part of the docker container interface that tasks.wait_with_progress uses; the status stays
+    # 'created' while the job is queued
+    def __init__(self, molecule_file_path, output_file_path):
+        self.molecule_file_path = molecule_file_path
+        self.output_file_path = output_file_path
+        self.status = 'created'
+        self.worker = None
+        self.cancelled = False
+        self._output = queue.Queue()
+        self._lock = threading.Lock()
+
+    def reload(self):
+        pass
+
+    def logs(self, stream=True, follow=True):
+        return iter(self._output.get, None)
+
+    def kill(self):
+        with self._lock:
+            self.cancelled = True
+            if self.worker is not None and self.status == 'running':
+                self.worker.kill()
+
+    def remove(self):
+        with self._lock:
+            self.cancelled = True
+
+    def start(self, worker):
+        with self._lock:
+            if self.cancelled:
+                return False
+            self.worker = worker
+            self.status = 'running'
+            return True
+
+    def finish(self):
+        self.status = 'exited'
+        self._output.put(None)
+
+
+class WorkerSlots:
+    # a host-wide cap on warm workers: each one holds a flock on one of limit slot files, which the kernel
+    # releases if its process dies
+    def __init__(self, directory, limit, poll_interval=1.0):
+        self.directory = directory
+        self.limit = limit
+        self.poll_interval = poll_interval
+        os.makedirs(directory, exist_ok=True)
+
+    def acquire(self, stop):
+        while not stop.is_set():
+            for i in range(self.limit):
+                slot = open(os.path.join(self.directory, f"slot{i}.lock"), 'w')
+                try:
+                    fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return slot
+                except BlockingIOError:
+                    slot.close()
+            stop.wait(self.poll_interval)
+        return None
+
+    @staticmethod
+    def release(slot):
+        if slot is not None:
+            fcntl.flock(slot, fcntl.LOCK_UN)
+            slot.close()
+
+
+class SimulatorPool:
+    # size is the number of warm workers of this process; with slots, workers are only started while a host-wide
+    # slot is free and idle ones give theirs back after health_interval
+    def __init__(self, worker_factory, size=2, health_interval=30, slots=None):
+        self.worker_factory = worker_factory
+        self.size = size
+        self.health_interval = health_interval
+        self.slots = slots
+        self.jobs = queue.Queue()
+        self.workers = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.threads = [threading.Thread(target=self.serve, daemon=True) for _ in range(size)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, molecule_file_path, output_file_path):
+        job = PoolJob(molecule_file_path, output_file_path)
+        self.jobs.put(job)
+        return job
+
+    def serve(self):
+        # each thread owns one warm worker; it is started on demand and dropped when a health check fails
+        worker = None
+        while True:
+            try:
+                job = self.jobs.get(timeout=self.health_interval)
+            except queue.Empty:
+                if worker is not None and (self.slots is not None or not worker.healthy()):
+                    worker = self.replace(worker, start=False)
+                continue
+
+            if job is None:
+                break
+
+            try:
+                if worker is None or not worker.healthy():
+                    worker = self.replace(worker)
+                if worker is not None and job.start(worker):
+                    worker.run(job.molecule_file_path, job.output_file_path, job._output.put)
+            except Exception as e:
+                job._output.put(f"Simulator worker failed: {e}\n".encode())
+                worker = self.replace(worker, start=False)
+            finally:
+                job.finish()
+
+        if worker is not None:
+            self.replace(worker, start=False)
+
+    def replace(self, worker, start=True):
+        if worker is not None:
+            with self._lock:
+                slot = self.workers.pop(worker, None)
+            worker.close()
+            if self.slots is not None:
+                self.slots.release(slot)
+        if not start:
+            return None
+
+        slot = self.slots.acquire(self._stop) if self.slots is not None else None
+        if self.slots is not None and slot is None:
+            return None
+        try:
+            worker = self.worker_factory()
+        except Exception:
+            if self.slots is not None:
+                self.slots.release(slot)
+            raise
+        with self._lock:
+            self.workers[worker] = slot
+        return worker
+
+    def close(self):
+        # busy threads only see the sentinel after their job, so the workers they hold are closed here as well
+        self._stop.set()
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join(timeout=1)
+        with self._lock:
+            workers = list(self.workers.items())
+            self.workers.clear()
+        for worker, slot in workers:
+            worker.close()
+            if self.slots is not None:
+                self.slots.release(slot)
+
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+
+def shared_pool(worker_factory, size, slots=None):
+    # one pool per process; celery prefork children each build their own after the fork, so size is per process
+    # and slots bounds the total across them
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = SimulatorPool(worker_factory, size, slots=slots)
+            atexit.register(close_shared_pool)
+        return _shared_pool
+
+
+def close_shared_pool():
+    global _shared_pool
+    with _shared_pool_lock:
+        pool, _shared_pool = _shared_pool, None
+    if pool is not None:
+        pool.close()
@@ -0,0 +1,98 @@
+import math
+import bisect
+from collections import namedtuple
+
+# the cosine alignment kernel shared by module4net and the parallel_scoring workers
+
+Match = namedtuple('Match', ['peak1', 'peak2', 'score'])
+Peak = namedtuple('Peak', ['mz', 'intensity'])
+Alignment = namedtuple('Alignment', ['peak1', 'peak2'])
+
+
+def prepare_spectrum(mz, intensity, pepmass):
+    peaks = convert_to_peaks(zip(mz, intensity))
+    peaks_n = sqrt_normalize_spectrum(peaks) if peaks else []
+    return peaks_n, list(mz), float(pepmass)
+
+
+def calculate_alignment(spec1, spec2, pm1, pm2, tolerance, max_charge_consideration=1):
+    if len(spec1) == 0 or len(spec2) == 0:
+        return 0.0, []
+
+    spec1_n = sqrt_normalize_spectrum(spec1)
+    spec2_n = sqrt_normalize_spectrum(spec2)
+
+    return align_normalized_spectra(spec1_n, spec2_n, pm1, pm2, tolerance, max_charge_consideration)
+
+def align_normalized_spectra(spec1_n, spec2_n, pm1, pm2, tolerance, max_charge_consideration=1, spec2_mass_list=None):
+    if len(spec1_n) == 0 or len(spec2_n) == 0:
+        return 0.0, []
+
+    if spec2_mass_list is None:
+        spec2_mass_list = [peak.mz for peak in spec2_n]
+
+    shift = pm1 - pm2
+    zero_shift_alignments = find_match_peaks_efficient(spec1_n, spec2_n, 0, tolerance, spec2_mass_list)
+    real_shift_alignments = find_match_peaks_efficient(spec1_n, spec2_n, shift, tolerance, spec2_mass_list) if abs(
+        shift) > tolerance else []
+
+    if max_charge_consideration > 1:
+        for charge_considered in range(2, max_charge_consideration + 1):
+            real_shift_alignments += find_match_peaks_efficient(spec1_n, spec2_n, shift / charge_considered, tolerance,
+                                                                spec2_mass_list)
+
+    real_shift_alignments = list(set(real_shift_alignments))
+
+    zero_shift_match = [alignment_to_match(spec1_n, spec2_n, alignment) for alignment in zero_shift_alignments]
+    real_shift_match = [alignment_to_match(spec1_n, spec2_n, alignment) for alignment in real_shift_alignments]
+
+    all_possible_match_scores = zero_shift_match + real_shift_match
+    all_possible_match_scores.sort(key=lambda x: x.score, reverse=True)
+
+    total_score = 0.0
+    reported_alignments = []
+    spec1_peak_used = set()
+    spec2_peak_used = set()
+
+    for match in all_possible_match_scores:
+        if match.peak1 not in spec1_peak_used and match.peak2 not in spec2_peak_used:
+            spec1_peak_used.add(match.peak1)
+            spec2_peak_used.add(match.peak2)
+            reported_alignments.append(match)
+            total_score += match.score
+
+    return total_score, reported_alignments
+
+
+def sqrt_normalize_spectrum(spectrum):
+    acc_norm = sum([s.intensity for s in spectrum])
+    normed_value = math.sqrt(acc_norm)
+    return [Peak(s.mz, math.sqrt(s.intensity) / normed_value) for s in spectrum]
+
+
+def find_match_peaks_efficient(spec1, spec2, shift, tolerance, spec2_mass_list=None):
+    adj_tolerance = tolerance + 0.000001
+    if spec2_mass_list is None:
+        spec2_mass_list = [peak.mz for peak in spec2]
+    alignment_mapping = []
+
+    for i, peak in enumerate(spec1):
+        left_bound = peak.mz - shift - adj_tolerance
+        right_bound = peak.mz - shift + adj_tolerance
+        left_index = bisect.bisect_left(spec2_mass_list, left_bound)
+        right_index = bisect.bisect_right(spec2_mass_list, right_bound)
+
+        for j in range(left_index, right_index):
+            alignment_mapping.append(Alignment(i, j))
+
+    return alignment_mapping
+
+
+def alignment_to_match(spec1_n, spec2_n, alignment):
+    s1_peak = spec1_n[alignment.peak1].intensity
+    s2_peak = spec2_n[alignment.peak2].intensity
+    match_score = s1_peak * s2_peak
+    return Match(alignment.peak1, alignment.peak2, match_score)
+
+def convert_to_peaks(peak_tuples):
+    return [Peak(*p) for p in peak_tuples]
@@ -0,0 +1,266 @@
+import os
+import re
+import json
+import numpy as np
+
+BUNDLE_ARRAYS = ('mz', 'intensity', 'offsets', 'pepmass', 'charge', 'rt', 'scan')
+
+
+class SpectrumStore:
+    def __init__(self, mz, intensity, offsets, pepmass, charge, rt, scan, title, headers=None, filename=None,
+                 scan_order=None, text_path=None):
+        self.mz = np.asarray(mz, dtype=np.float64)
+        self.intensity = np.asarray(intensity, dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.pepmass = np.asarray(pepmass, dtype=np.float64)
+        self.charge = np.asarray(charge, dtype=np.int32)
+        self.rt = np.asarray(rt, dtype=np.float64)
+        self.scan = np.asarray(scan, dtype=np.int64)
+        self._title = list(title) if title is not None else None
+        self._headers = list(headers) if headers is not None else None
+        self.filename = filename
+        self._scan_order = scan_order
+        # titles and headers of a saved bundle are only read when something asks for them
+        self._text_path = text_path
+
+    @property
+    def title(self):
+        if self._title is None:
+            self._load_text()
+        return self._title
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            self._load_text()
+        return self._headers
+
+    def _load_text(self):
+        text = {}
+        if self._text_path is not None:
+            with open(self._text_path, 'r') as f:
+                text = json.load(f)
+        if self._title is None:
+            self._title = text.get('title', [''] * len(self))
+        if self._headers is None:
+            self._headers = text.get('headers', [''] * len(self))
+
+    @classmethod
+    def from_mgf_file(cls, filename):
+        with open(filename, 'r') as f:
+            return cls.from_lines(f, filename)
+
+    @classmethod
+    def from_mgf_text(cls, text, filename=None):
+        return cls.from_lines(text.splitlines(), filename)
+
+    @classmethod
+    def from_lines(cls, lines, filename=None):
+        mz = []
+        intensity = []
+        offsets = [0]
+        pepmass = []
+        charge = []
+        rt = []
+        scan = []
+        title = []
+        headers = []
+
+        in_spectrum = False
+        header_lines = []
+        current = None
+
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+
+            if line == 'BEGIN IONS':
+                in_spectrum = True
+                header_lines = []
+                current = {'pepmass': 0.0, 'charge': 0, 'rt': 0.0, 'scan': 0, 'title': ''}
+
+            elif line == 'END IONS':
+                if in_spectrum:
+                    offsets.append(len(mz))
+                    pepmass.append(current['pepmass'])
+                    charge.append(current['charge'])
+                    rt.append(current['rt'])
+                    scan.append(current['scan'])
+                    title.append(current['title'])
+                    headers.append('\n'.join(header_lines))
+                in_spectrum = False
+
+            elif not in_spectrum:
+                continue
+
+            elif '=' not in line:
+                parts = line.split(None, 2)
+                try:
+                    peak_mz = float(parts[0])
+                    peak_intensity = float(parts[1]) if len(parts) > 1 else 0.0
+                except ValueError:
+                    continue
+                mz.append(peak_mz)
+                intensity.append(peak_intensity)
+
+            else:
+                if line.startswith('FEATURE_ID='):
+                    line = 'TITLE=' + line[len('FEATURE_ID='):]
+                header_lines.append(line)
+                key, value = line.split('=', 1)
+                key = key.upper()
+                if key == 'PEPMASS':
+                    current['pepmass'] = _parse_float(value.split()[0] if value.split() else '')
+                elif key == 'CHARGE':
+                    current['charge'] = _parse_charge(value)
+                elif key == 'RTINSECONDS':
+                    current['rt'] = _parse_float(value)
+                elif key == 'SCANS':
+                    current['scan'] = _parse_int(value)
+                elif key == 'TITLE':
+                    current['title'] = value.strip()
+
+        return cls(mz, intensity, offsets, pepmass, charge, rt, scan, title, headers, filename)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        arrays = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mmap_mode) for name in BUNDLE_ARRAYS}
+        scan_order = np.load(os.path.join(directory, 'scan_order.npy'), mmap_mode=mmap_mode)
+        text_path = os.path.join(directory, 'text.json')
+        with open(os.path.join(directory, 'bundle.json'), 'r') as f:
+            filename = json.load(f).get('filename')
+        return cls(title=None, filename=filename, scan_order=scan_order, text_path=text_path, **arrays)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name in BUNDLE_ARRAYS:
+            np.save(os.path.join(directory, f'{name}.npy'), getattr(self, name))
+        np.save(os.path.join(directory, 'scan_order.npy'), self.scan_order)
+        with open(os.path.join(directory, 'text.json'), 'w') as f:
+            json.dump({'title': self.title, 'headers': self.headers}, f)
+        with open(os.path.join(directory, 'bundle.json'), 'w') as f:
+            json.dump({'filename': self.filename, 'spectra': len(self)}, f)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def peak_counts(self):
+        return np.diff(self.offsets)
+
+    def spectrum_index(self):
+        return np.repeat(np.arange(len(self)), self.peak_counts)
+
+    def peaks(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.mz[start:end], self.intensity[start:end]
+
+    @property
+    def scan_order(self):
+        if self._scan_order is None:
+            self._scan_order = np.argsort(self.scan, kind='stable')
+        return self._scan_order
+
+    def index_of_scan(self, scan):
+        position = int(np.searchsorted(self.scan, scan, sorter=self.scan_order))
+        if position < len(self) and self.scan[self.scan_order[position]] == scan:
+            return int(self.scan_order[position])
+        return -1
+
+    def subset(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        counts = self.peak_counts[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        starts = self.offsets[indices]
+        peak_positions = np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+
+        return SpectrumStore(
+            self.mz[peak_positions],
+            self.intensity[peak_positions],
+            offsets,
+            self.pepmass[indices],
+            self.charge[indices],
+            self.rt[indices],
+            self.scan[indices],
+            [self.title[i] for i in indices],
+            [self.headers[i] for i in indices],
+            self.filename
+        )
+
+    def nonempty(self):
+        return self.subset(np.flatnonzero(self.peak_counts > 0))
+
+    def write_mgf(self, output):
+        if isinstance(output, str):
+            with open(output, 'w') as f:
+                self.write_mgf(f)
+            return
+
+        for i in range(len(self)):
+            output.write('BEGIN IONS\n')
+            if self.headers[i]:
+                output.write(self.headers[i] + '\n')
+            mz, intensity = self.peaks(i)
+            for peak_mz, peak_intensity in zip(mz.tolist(), intensity.tolist()):
+                output.write(f"{peak_mz} {peak_intensity}\n")
+            output.write('END IONS\n\n')
+
+
+def _parse_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return 0.0
+
+
+def _parse_int(value):
+    try:
+        return int(value.strip())
+    except ValueError:
+        return 0
+
+
+def _parse_charge(value):
+    match = re.search(r'\d+', value)
+    return int(match.group()) if match else 0
+
+
+def normalize_intensities(store):
+    normalized = np.zeros_like(store.intensity)
+    if len(store.intensity) == 0:
+        return normalized
+
+    counts = store.peak_counts
+    nonempty = np.flatnonzero(counts > 0)
+    starts = store.offsets[:-1][nonempty]
+    max_intensity = np.maximum.reduceat(store.intensity, starts)
+    min_intensity = np.minimum.reduceat(store.intensity, starts)
+
+    peak_max = np.repeat(max_intensity, counts[nonempty])
+    peak_min = np.repeat(min_intensity, counts[nonempty])
+    spread = peak_max - peak_min
+    varying = spread != 0
+    normalized[varying] = (store.intensity[varying] - peak_min[varying]) / spread[varying]
+    return normalized
+
+
+def match_within_tolerance(values, sorted_targets, tolerance, inclusive=False):
+    values = np.asarray(values, dtype=np.float64)
+    sorted_targets = np.asarray(sorted_targets, dtype=np.float64)
+    margin = abs(tolerance) * 1e-6 + 1e-9
+
+    lo = np.searchsorted(sorted_targets, values - tolerance - margin, side='left')
+    hi = np.searchsorted(sorted_targets, values + tolerance + margin, side='right')
+    counts = np.maximum(hi - lo, 0)
+    total = int(counts.sum())
+
+    value_idx = np.repeat(np.arange(len(values)), counts)
+    first = np.cumsum(counts) - counts
+    target_idx = np.arange(total) - np.repeat(first, counts) + np.repeat(lo, counts)
+
+    difference = np.abs(values[value_idx] - sorted_targets[target_idx])
+    keep = difference <= tolerance if inclusive else difference < tolerance
+    return value_idx[keep], target_idx[keep]
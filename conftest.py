@@ -0,0 +1,28 @@
+import os
+import tempfile
+import django
+import pytest
+from celery import Celery
+from django.conf import settings
+
+# SMMN is a Django app without a project in this repository, so the tests run against minimal settings
+if not settings.configured:
+    settings.configure(
+        BASE_DIR=os.path.dirname(os.path.abspath(__file__)),
+        MEDIA_ROOT=tempfile.mkdtemp(prefix='smmn-media-'),
+        SECRET_KEY='tests',
+        INSTALLED_APPS=['django.contrib.sessions'],
+        SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies',
+    )
+    django.setup()
+
+
+@pytest.fixture
+def eager_celery():
+    # tasks run eagerly in the test process, with results kept in memory so their states can be polled
+    app = Celery('smmn-tests')
+    app.conf.task_always_eager = True
+    app.conf.task_store_eager_result = True
+    app.conf.result_backend = 'cache+memory://'
+    app.set_default()
+    return app
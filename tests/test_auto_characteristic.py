@@ -0,0 +1,41 @@
+import json
+import numpy as np
+import pytest
+from django.test import RequestFactory
+from SMMN.auto_characteristic import show_feature, quorum_features, intersect_features
+
+
+def features(*molecules):
+    return [(np.array([value for value, _ in peaks], dtype=np.float64),
+             np.array([intensity for _, intensity in peaks], dtype=np.float64)) for peaks in molecules]
+
+
+def test_quorum_features_does_not_chain_past_tolerance():
+    # consecutive values are 0.015 apart, but the first and last are 0.045 apart
+    chained = features([(100.000, 1.0)], [(100.015, 2.0)], [(100.030, 3.0)], [(100.045, 4.0)])
+
+    result = quorum_features(chained, 0.02, 2)
+
+    assert result == {100.0: 3.0, 100.03: 7.0}
+
+
+def test_quorum_features_requires_quorum_molecules():
+    same_molecule = features([(50.0, 1.0), (50.01, 1.0)], [(80.0, 1.0)], [(80.005, 2.0)])
+
+    assert quorum_features(same_molecule, 0.02, 2) == {80.0: 3.0}
+
+
+def test_quorum_features_matches_intersection_when_every_molecule_is_required():
+    molecules = features([(100.0, 1.0), (150.0, 2.0)], [(100.01, 3.0), (150.5, 1.0)], [(99.995, 1.0)])
+
+    assert quorum_features(molecules, 0.02, 3) == intersect_features(molecules, 0.02) == {100.0: 5.0}
+
+
+@pytest.mark.parametrize('quorum', ['two', '0', '-1'])
+def test_show_feature_rejects_an_invalid_quorum(quorum):
+    request = RequestFactory().post('/feature', {'analyze': 'all', 'energyLevel': 'expt', 'quorum': quorum})
+
+    response = show_feature(request)
+
+    assert response.status_code == 400
+    assert json.loads(response.content)['status'] == 'error'
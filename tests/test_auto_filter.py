@@ -0,0 +1,162 @@
+import io
+import os
+import zipfile
+import numpy as np
+import pytest
+from django.test import RequestFactory
+from SMMN import auto_filter
+from SMMN.auto_filter import calculate_ion_scores, calculate_neutral_loss_scores
+from SMMN.utils.spectrum_store import SpectrumStore
+
+
+def reference_selected_mz(mz_array, intensity_array, min_normalized_intensity):
+    # the per-spectrum normalisation of the original loop implementation
+    max_intensity = max(intensity_array)
+    min_intensity = min(intensity_array)
+    if max_intensity == min_intensity:
+        normalized_intensity = np.zeros_like(intensity_array)
+    else:
+        normalized_intensity = (intensity_array - min_intensity) / (max_intensity - min_intensity)
+    return [mz for y, mz in enumerate(mz_array) if normalized_intensity[y] > min_normalized_intensity]
+
+
+def reference_ion_score(mz_array, intensity_array, common_ions, tolerance, min_normalized_intensity):
+    if len(intensity_array) == 0:
+        return 0
+    ion_score = 0
+    matched_ions = set()
+    for mz in reference_selected_mz(mz_array, intensity_array, min_normalized_intensity):
+        for ion in common_ions:
+            if abs(mz - ion) < tolerance and ion not in matched_ions:
+                ion_score += 1
+                matched_ions.add(ion)
+    return ion_score
+
+
+def reference_neutral_loss_score(mz_array, intensity_array, common_neutral_losses, tolerance,
+                                  min_normalized_intensity):
+    if len(intensity_array) == 0:
+        return 0
+    mz_list = reference_selected_mz(mz_array, intensity_array, min_normalized_intensity)
+    neutral_losses = [mz1 - mz2 for i, mz1 in enumerate(mz_list) for j, mz2 in enumerate(mz_list) if i != j]
+    neutral_loss_score = 0
+    matched_losses = set()
+    for nl in neutral_losses:
+        for common_nl in common_neutral_losses:
+            if abs(nl - common_nl) < tolerance and common_nl not in matched_losses:
+                neutral_loss_score += 1
+                matched_losses.add(common_nl)
+    return neutral_loss_score
+
+
+def random_store(rng, spectra, grid):
+    # with grid=True every m/z lies on a 1/64 grid, so differences of exactly the tolerance are common
+    mz, intensity, offsets = [], [], [0]
+    for _ in range(spectra):
+        count = int(rng.integers(0, 25))
+        if grid:
+            peaks = rng.integers(50 * 64, 400 * 64, count) / 64
+        else:
+            peaks = rng.uniform(50, 400, count)
+        mz.extend(peaks.tolist())
+        intensity.extend(rng.choice([5.0, 10.0, 50.0, 100.0], count).tolist() if grid
+                         else rng.uniform(1, 100, count).tolist())
+        offsets.append(len(mz))
+    size = len(offsets) - 1
+    return SpectrumStore(mz, intensity, offsets, np.full(size, 500.0), np.ones(size), np.zeros(size),
+                         np.arange(size), [''] * size)
+
+
+def reference_scores(store, score, targets, tolerance, min_normalized_intensity):
+    scores = []
+    for i in range(len(store)):
+        mz, intensity = store.peaks(i)
+        scores.append(score(mz.tolist(), np.asarray(intensity), targets, tolerance, min_normalized_intensity))
+    return scores
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('grid', [True, False])
+@pytest.mark.parametrize('tolerance', [0.25, 0.02])
+def test_ion_scores_match_the_loop_implementation(seed, grid, tolerance):
+    rng = np.random.default_rng(seed)
+    store = random_store(rng, 40, grid)
+    ions = (rng.integers(50 * 64, 400 * 64, 30) / 64).tolist() + [100.0, 100.0]
+
+    expected = reference_scores(store, reference_ion_score, ions, tolerance, 0.02)
+
+    assert calculate_ion_scores(store, ions, tolerance, 0.02).tolist() == expected
+
+
+def test_ion_scores_exclude_the_tolerance_boundary():
+    store = SpectrumStore([100.0, 100.25, 200.0, 250.0], [10.0, 50.0, 100.0, 1.0], [0, 4], [300.0], [1], [0.0], [1],
+                          [''])
+
+    # 100.25 is exactly one tolerance from 100.5 and does not match, 100.0 lies within tolerance of 99.875
+    assert calculate_ion_scores(store, [100.5, 99.875], 0.25, 0.0).tolist() == [1]
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('grid', [True, False])
+@pytest.mark.parametrize('tolerance', [0.25, 0.02])
+def test_neutral_loss_scores_match_the_loop_implementation(seed, grid, tolerance):
+    rng = np.random.default_rng(seed)
+    store = random_store(rng, 40, grid)
+    losses = (rng.integers(0, 100 * 64, 30) / 64).tolist() + [18.0, 18.0]
+
+    expected = reference_scores(store, reference_neutral_loss_score, losses, tolerance, 0.02)
+
+    assert calculate_neutral_loss_scores(store, losses, tolerance, 0.02).tolist() == expected
+
+
+def test_neutral_loss_scores_exclude_the_tolerance_boundary():
+    store = SpectrumStore([100.0, 118.0, 118.25, 250.0], [50.0, 50.0, 100.0, 1.0], [0, 4], [300.0], [1], [0.0],
+                          [1], [''])
+
+    # 118.25 - 100.0 is exactly one tolerance from 18.5, 118.0 - 100.0 lies within tolerance of 17.875
+    assert calculate_neutral_loss_scores(store, [18.5, 17.875], 0.25, 0.0).tolist() == [1]
+    # a peak is never paired with itself, so a zero loss finds nothing
+    assert calculate_neutral_loss_scores(store, [0.0], 0.25, 0.0).tolist() == [0]
+
+
+def download(user_directory):
+    request = RequestFactory().get('/download')
+    request.session = {'user_directory': str(user_directory)}
+    return auto_filter.download_filter_data(request)
+
+
+def test_download_serves_the_latest_complete_generation(tmp_path):
+    store = SpectrumStore([100.0, 150.0], [10.0, 100.0], [0, 2], [300.0], [1], [12.0], [1], ['1'])
+    filtered_spectra, metadata = auto_filter.process_mgf_file(store, 0, 0, [], [], 0.02, 0.02, 0)
+
+    auto_filter.write_artifacts_in_background(tmp_path, [('metadata.csv', lambda path: open(path, 'w').write('old'))])
+    first = download(tmp_path)
+    auto_filter.write_artifacts_in_background(tmp_path, [
+        ('filtered_spectra.mgf', lambda path: auto_filter.write_filtered_spectra(filtered_spectra, path)),
+        ('metadata.csv', lambda path: auto_filter.write_metadata(metadata, path)),
+    ])
+    second = download(tmp_path)
+
+    assert zipfile.ZipFile(io.BytesIO(first.content)).read('metadata.csv') == b'old'
+    archive = zipfile.ZipFile(io.BytesIO(second.content))
+    assert sorted(archive.namelist()) == ['filtered_spectra.mgf', 'metadata.csv']
+    assert archive.read('metadata.csv').startswith(b'row ID,row m/z')
+    assert b'BEGIN IONS' in archive.read('filtered_spectra.mgf')
+    # the previous generation is removed once the new one is current
+    generations = [name for name in os.listdir(tmp_path) if name.startswith('filter_artifacts_')]
+    assert generations == [auto_filter.read_artifact_manifest(tmp_path)['current']]
+
+
+def test_download_without_results_is_not_found(tmp_path):
+    assert download(tmp_path).status_code == 404
+
+
+def test_failed_writer_keeps_the_previous_generation(tmp_path):
+    def fail(path):
+        raise ValueError('broken')
+
+    auto_filter.write_artifacts_in_background(tmp_path, [('metadata.csv', lambda path: open(path, 'w').write('old'))])
+    download(tmp_path)
+    auto_filter.write_artifacts_in_background(tmp_path, [('metadata.csv', fail)])
+
+    assert zipfile.ZipFile(io.BytesIO(download(tmp_path).content)).read('metadata.csv') == b'old'
@@ -0,0 +1,147 @@
+import os
+import json
+from decimal import Decimal, localcontext
+import numpy as np
+import pytest
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory
+from SMMN.auto_neutral_losses import generate_neutral_losses, cluster_within_tolerance, save_mgf_bundle, \
+    show_nl_spectrum, generate_neutral_loss, load_mgf_bundle
+from SMMN.utils.spectrum_store import SpectrumStore
+
+MGF = """BEGIN IONS
+PEPMASS=400.0
+SCANS=17
+100.0 10
+150.0 20
+END IONS
+BEGIN IONS
+PEPMASS=300.0
+CHARGE=2+
+SCANS=7
+100.0 50
+118.0 100
+136.0 25
+END IONS
+"""
+
+
+def reference_neutral_losses(top_ions, min_neutral_loss, charge=1):
+    # the Decimal loop generate_neutral_losses replaced, at the default precision that common_ion_find's import lowers
+    with localcontext() as context:
+        context.prec = 28
+        return reference_neutral_losses_at_context_precision(top_ions, min_neutral_loss, charge)
+
+
+def reference_neutral_losses_at_context_precision(top_ions, min_neutral_loss, charge):
+    neutral_losses = {}
+    for i in range(len(top_ions)):
+        mz1, intensity1 = top_ions[i]
+        for j in range(len(top_ions)):
+            if i != j:
+                mz2, intensity2 = top_ions[j]
+                neutral_loss = (Decimal(mz1) - Decimal(mz2)) * Decimal(charge)
+                if neutral_loss >= Decimal(min_neutral_loss):
+                    average_intensity = (Decimal(intensity1) + Decimal(intensity2)) / Decimal(2.0)
+                    for nl in neutral_losses.keys():
+                        if abs(neutral_loss - nl) < Decimal('1e-5'):
+                            neutral_losses[nl].append((mz1, mz2, average_intensity))
+                            break
+                    else:
+                        neutral_losses[neutral_loss] = [(mz1, mz2, average_intensity)]
+    return neutral_losses
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('charge', [1, 2])
+def test_generate_neutral_losses_groups_like_the_decimal_loop(seed, charge):
+    rng = np.random.default_rng(seed)
+    # a few ions repeat up to a jitter below the tolerance, so several losses collapse into one group
+    mz = rng.uniform(80, 400, 12)
+    mz = np.concatenate([mz, mz[:4] + rng.uniform(-4e-6, 4e-6, 4)])
+    top_ions = list(zip(mz.tolist(), rng.uniform(1, 100, len(mz)).tolist()))
+
+    expected = reference_neutral_losses(top_ions, 10, charge)
+    result = generate_neutral_losses(top_ions, 10, charge)
+
+    assert [float(nl) for nl in expected] == pytest.approx(list(result), abs=1e-9)
+    for (_, expected_members), members in zip(expected.items(), result.values()):
+        assert [(mz1, mz2) for mz1, mz2, _ in members] == [(mz1, mz2) for mz1, mz2, _ in expected_members]
+        assert [intensity for _, _, intensity in members] == pytest.approx(
+            [float(intensity) for _, _, intensity in expected_members])
+
+
+def test_generate_neutral_losses_needs_two_ions():
+    assert generate_neutral_losses([(100.0, 5.0)], 10) == {}
+
+
+def test_cluster_within_tolerance_joins_the_earliest_key():
+    values = np.array([0.0, 0.6e-5, 1.2e-5, 5.0, 5.0 + 0.4e-5])
+
+    # 1.2e-5 is within tolerance of 0.6e-5 but that is not a key, so it starts its own group
+    assert cluster_within_tolerance(values, 1e-5).tolist() == [0, 0, 2, 3, 3]
+
+
+def nl_spectrum_request(session, molecule_id):
+    request = RequestFactory().get('/nl_spectrum', {'molecule_id': molecule_id})
+    request.session = session
+    return request
+
+
+def test_show_nl_spectrum_looks_up_the_exact_scan(tmp_path):
+    session = {'user_directory': str(tmp_path), 'topN': 10, 'minNeutralLoss': 10}
+    save_mgf_bundle(nl_spectrum_request(session, ''), SpectrumStore.from_mgf_text(MGF))
+
+    response = show_nl_spectrum(nl_spectrum_request(session, 'SCANS-7'))
+
+    data = json.loads(response.content)
+    assert data['pepmass'] == 300.0
+    assert data['spectrum_data'] == [[100.0, 50.0], [118.0, 100.0], [136.0, 25.0]]
+    # charge 2 doubles the losses: 118 - 100 and 136 - 118 fall together at 36
+    assert sorted(float(nl) for nl in data['nl_data']) == [36.0, 72.0]
+    # SCANS=17 must not answer for scan 1
+    assert show_nl_spectrum(nl_spectrum_request(session, 'SCANS-1')).status_code == 404
+
+
+def upload_request(session, text):
+    request = RequestFactory().post('/neutral_loss', {'topN': 10, 'minNeutralLoss': 10,
+                                                      'file': SimpleUploadedFile('input.mgf', text.encode('utf-8'))})
+    request.session = session
+    return request
+
+
+def test_upload_keeps_spectra_in_a_bundle_instead_of_the_session(tmp_path):
+    session = {'user_directory': str(tmp_path), 'mgf_file_content': MGF}
+
+    response = generate_neutral_loss(upload_request(session, MGF))
+
+    assert response.status_code == 200
+    assert session['mgf_bundle'] == os.path.join(str(tmp_path), 'mgf_bundle')
+    assert 'mgf_file_content' not in session
+    assert load_mgf_bundle(nl_spectrum_request(session, '')).scan.tolist() == [17, 7]
+    # a second upload replaces the bundle in place
+    generate_neutral_loss(upload_request(session, MGF[MGF.index('BEGIN IONS', 1):]))
+    assert load_mgf_bundle(nl_spectrum_request(session, '')).scan.tolist() == [7]
+    assert sorted(os.listdir(tmp_path)) == ['mgf_bundle']
+
+
+def test_upload_without_spectra_is_rejected(tmp_path):
+    session = {'user_directory': str(tmp_path)}
+
+    response = generate_neutral_loss(upload_request(session, 'no spectra here\n'))
+
+    assert response.status_code == 400
+    assert 'mgf_bundle' not in session
+
+
+def test_show_nl_spectrum_reads_simulated_spectra_from_the_output_log(tmp_path):
+    (tmp_path / 'output.log').write_text("#ID=Molecule1\n#SMILES=CCO\n#InChiKey=\n#Formula=C2H6O\n#PMass=47.04914\n"
+                                         "energy0\n29.0 10\nenergy1\n31.0 50\n47.0 100\nenergy2\n19.0 40\n\n")
+    session = {'user_directory': str(tmp_path), 'topN': 10, 'minNeutralLoss': 10}
+    request = RequestFactory().get('/nl_spectrum', {'molecule_id': 'Molecule1', 'energy_level': '1'})
+    request.session = session
+
+    data = json.loads(show_nl_spectrum(request).content)
+
+    assert data['spectrum_data'] == [[31.0, 50.0], [47.0, 100.0]]
+    assert [float(nl) for nl in data['nl_data']] == [16.0]
@@ -0,0 +1,80 @@
+import os
+import csv
+from decimal import Decimal
+import pytest
+from SMMN.utils.common_ion_find import CommonIonsAnalyzer
+
+SPECTRA = {
+    'Molecule1': ['100.0 50.0', '118.0 100.0', '200.5 20.0', '250.0 5.0'],
+    'Molecule2': ['100.0 70.0', '118.0 60.0', '210.25 100.0'],
+    'Molecule3': ['100.0 90.0', '118.0 30.0', '200.5 40.0', '310.0 100.0'],
+}
+
+
+def read_files(directory):
+    contents = {}
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name)) as f:
+            contents[name] = f.read()
+    return contents
+
+
+def read_common(path):
+    with open(path) as f:
+        return [float(cell) for row in list(csv.reader(f))[1:] for cell in row]
+
+
+def test_batch_mode_writes_the_same_files_as_the_file_pipeline(tmp_path):
+    file_directory = tmp_path / 'files'
+    batch_directory = tmp_path / 'batch'
+    file_directory.mkdir()
+    batch_directory.mkdir()
+    for molecule, fragments in SPECTRA.items():
+        (file_directory / f"{molecule}.log").write_text('energy0\n' + '\n'.join(fragments) + '\n\n')
+
+    analyzer = CommonIonsAnalyzer(str(file_directory), 'energy0', 10)
+    analyzer.analyze_neutral_losses_for_each_molecule()
+    analyzer.find_common_neutral_losses()
+    analyzer.find_common_ions()
+
+    batch = CommonIonsAnalyzer(str(batch_directory), 'energy0', 10)
+    _, common_neutral_losses, common_ions = batch.analyze_spectra(SPECTRA, write_files=True)
+
+    batch_files = read_files(batch_directory)
+    pipeline_files = {name: text for name, text in read_files(file_directory).items() if name.endswith('.csv')}
+    assert batch_files.keys() == pipeline_files.keys()
+    for name in batch_files:
+        if name.startswith('common_'):
+            # averages are summed in molecule order, which for the file pipeline is the directory listing order
+            assert read_common(batch_directory / name) == pytest.approx(read_common(file_directory / name))
+        else:
+            assert batch_files[name] == pipeline_files[name]
+    assert [value for value, _ in common_ions] == [Decimal('100.0'), Decimal('118.0')]
+    assert [value for value, _ in common_neutral_losses] == [Decimal('18.00000')]
+
+
+def test_batch_mode_writes_nothing_by_default(tmp_path):
+    CommonIonsAnalyzer(str(tmp_path), 'energy0', 10).analyze_spectra(SPECTRA)
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_common_values_groups_values_on_the_tolerance_grid():
+    values_per_molecule = [
+        [(Decimal('100.00001'), Decimal('10')), (Decimal('150.0'), Decimal('40')), (Decimal('60.0'), Decimal('30'))],
+        [(Decimal('100.000006'), Decimal('30')), (Decimal('150.00002'), Decimal('40')),
+         (Decimal('60.0'), Decimal('30'))],
+    ]
+
+    # 100.00001 and 100.000006 share a grid key, 150.0 and 150.00002 are two keys apart
+    assert CommonIonsAnalyzer.common_values(values_per_molecule) == [
+        (Decimal('60.0'), Decimal('30.0')), (Decimal('100.00001'), Decimal('20.0'))]
+
+
+def test_common_values_orders_ties_by_first_appearance():
+    values_per_molecule = [[(Decimal('5'), Decimal('1')), (Decimal('3'), Decimal('1'))],
+                           [(Decimal('3'), Decimal('1')), (Decimal('5'), Decimal('1'))]]
+
+    assert [value for value, _ in CommonIonsAnalyzer.common_values(values_per_molecule)] == [Decimal('5'),
+                                                                                           Decimal('3')]
+    assert CommonIonsAnalyzer.common_values([[], []]) == []
@@ -0,0 +1,113 @@
+import json
+import uuid
+from django.test import RequestFactory, override_settings
+from SMMN import in_silico_msms, tasks
+
+PREAMBLE = "#In-silico ESI-MS/MS [M+H]+ Spectra\n#PREDICTED BY CFM-ID 4.0.7\n"
+OUTPUT_LOG = PREAMBLE + ("#ID=Molecule1\n#SMILES=CCO\n#InChiKey=\n#Formula=C2H6O\n#PMass=47.04914\n"
+                         "energy0\n29.03 10\nenergy1\n31.02 20\n47.05 100\nenergy2\n19.02 40\n\n")
+
+
+def session_request(path, session, **params):
+    request = RequestFactory().get(path, params)
+    request.session = session
+    return request
+
+
+def test_show_spectrum_labels_the_requested_energy(tmp_path):
+    (tmp_path / 'output.log').write_text(OUTPUT_LOG)
+    session = {'user_directory': str(tmp_path)}
+
+    response = in_silico_msms.show_spectrum(session_request('/spectrum', session, molecule_id='Molecule1',
+                                                            energy_level='1'))
+
+    data = json.loads(response.content)
+    assert data['energy_level'] == '20eV'
+    assert data['spectrum_data'] == [[31.02, 20.0], [47.05, 100.0]]
+    assert data['pepmass'] == 47.04914
+
+
+def test_task_result_is_parsed_once_and_served_from_result_json(tmp_path):
+    output_file = tmp_path / 'output.log'
+    output_file.write_text(OUTPUT_LOG)
+
+    first = in_silico_msms.task_result_response('task-1', str(output_file))
+    # later polls serve the stored table without reading output.log again
+    output_file.write_text('')
+    second = in_silico_msms.task_result_response('task-1', str(output_file))
+
+    assert first.content == second.content
+    result = json.loads(second.content)
+    assert result['state'] == 'SUCCESS'
+    assert [(m['id'], m['formula'], m['pepmass']) for m in result['molecules']] == [('Molecule1', 'C2H6O',
+                                                                                    '47.04914')]
+    assert not [path for path in tmp_path.iterdir() if path.name.endswith('.tmp')]
+
+
+def test_unreadable_task_result_is_rebuilt(tmp_path):
+    output_file = tmp_path / 'output.log'
+    output_file.write_text(OUTPUT_LOG)
+    (tmp_path / 'task-1.result.json').write_text('{"state": "SUCC')
+
+    response = in_silico_msms.task_result_response('task-1', str(output_file))
+
+    assert [m['id'] for m in json.loads(response.content)['molecules']] == ['Molecule1']
+    assert json.loads((tmp_path / 'task-1.result.json').read_text()) == json.loads(response.content)
+
+
+def stream(task_id):
+    return (chunk.decode('utf-8') for chunk in in_silico_msms.stream_task_status(None, task_id).streaming_content)
+
+
+def data(chunk):
+    return json.loads(chunk.split('data: ', 1)[1])
+
+
+@override_settings(SMMN_PROGRESS_INTERVAL=0)
+def test_stream_reports_each_state_change_once(eager_celery):
+    task_id = str(uuid.uuid4())
+    events = stream(task_id)
+
+    assert data(next(events)) == {'state': 'PENDING', 'status': 'Pending...'}
+    tasks.write_task_manifest(task_id, 4)
+    assert data(next(events)) == {'state': 'PENDING', 'status': 'Queued...'}
+    assert next(events) == ': keep-alive\n\n'
+    eager_celery.backend.store_result(task_id, {'done': 1, 'total': 4}, 'PROGRESS')
+    assert data(next(events)) == {'state': 'PROGRESS', 'status': 'Processing...', 'done': 1, 'total': 4}
+    eager_celery.backend.store_result(task_id, {'status': 'SUCCESS', 'result': 'output.log'}, 'SUCCESS')
+    assert data(next(events)) == {'state': 'SUCCESS', 'status': 'Completed'}
+    assert list(events) == []
+
+
+@override_settings(SMMN_PROGRESS_INTERVAL=0, SMMN_PROGRESS_STREAM_MAX_PENDING=3)
+def test_stream_gives_up_on_an_unknown_task(eager_celery):
+    events = list(stream(str(uuid.uuid4())))
+
+    assert events[1:3] == [': keep-alive\n\n'] * 2
+    assert events[3].startswith('event: timeout\n')
+    assert data(events[3]) == {'state': 'TIMEOUT', 'status': 'Task not found.'}
+
+
+@override_settings(SMMN_PROGRESS_INTERVAL=0.01, SMMN_PROGRESS_STREAM_MAX_PENDING=3,
+                   SMMN_PROGRESS_STREAM_TIMEOUT=0.2)
+def test_stream_keeps_a_queued_task_open_until_the_stream_timeout(eager_celery):
+    task_id = str(uuid.uuid4())
+    tasks.write_task_manifest(task_id, 4)
+
+    events = list(stream(task_id))
+
+    assert len(events) > 4
+    assert data(events[-1]) == {'state': 'TIMEOUT', 'status': 'Progress stream closed, check the task status again.'}
+
+
+def test_pending_sharded_task_sums_the_shard_counters(eager_celery):
+    task_id = str(uuid.uuid4())
+    shard_ids = [str(uuid.uuid4()) for _ in range(3)]
+    tasks.write_task_manifest(task_id, 10, [{'task_id': shard_id, 'total': total}
+                                            for shard_id, total in zip(shard_ids, [4, 4, 2])])
+    eager_celery.backend.store_result(shard_ids[0], 'output.shard0.log', 'SUCCESS')
+    eager_celery.backend.store_result(shard_ids[1], {'done': 3, 'total': 4}, 'PROGRESS')
+
+    response = in_silico_msms.check_task_status(None, task_id)
+
+    assert json.loads(response.content) == {'state': 'PROGRESS', 'status': 'Processing...', 'done': 7, 'total': 10}
@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+import pytest
+from SMMN.utils import module4net
+from SMMN.utils.spectrum_store import SpectrumStore
+
+
+def synthetic_store(seed=7, families=6, per_family=4):
+    # members of a family share most fragments, shifted by their precursor difference, so many pairs score high
+    rng = np.random.default_rng(seed)
+    mz, intensity, offsets, pepmass = [], [], [0], []
+    for _ in range(families):
+        base_mass = rng.uniform(300, 700)
+        base_peaks = np.sort(rng.uniform(50, base_mass - 20, rng.integers(6, 15)))
+        for _ in range(per_family):
+            shift = rng.choice([0.0, rng.uniform(5, 40)])
+            keep = rng.random(len(base_peaks)) > 0.25
+            peaks = np.sort(np.concatenate([base_peaks[keep] + np.where(rng.random(keep.sum()) > 0.5, shift, 0.0),
+                                            rng.uniform(50, base_mass, 3)]))
+            mz.extend(peaks.tolist())
+            intensity.extend(rng.uniform(1, 100, len(peaks)).tolist())
+            offsets.append(len(mz))
+            pepmass.append(base_mass + shift)
+    size = len(pepmass)
+    return SpectrumStore(mz, intensity, offsets, pepmass, np.ones(size), np.arange(size) * 10.0,
+                         np.arange(1, size + 1), [''] * size, filename='synthetic.mgf')
+
+
+def baseline_pairs(store, tolerance, threshold):
+    pairs = {}
+    for i in range(len(store)):
+        for j in range(i + 1, len(store)):
+            score, matched_peaks = module4net.score_alignment(store, i, j, tolerance)
+            if score >= threshold:
+                pairs[(i, j)] = (score, [tuple(m) for m in matched_peaks])
+    return pairs
+
+
+def scored(pairs):
+    return {(i, j): (score, [tuple(m) for m in matched_peaks]) for i, j, score, matched_peaks in pairs}
+
+
+@pytest.mark.parametrize('prefilter', [None, 'index', 'sparse'])
+@pytest.mark.parametrize('threshold', [0.0, 0.3, 0.7])
+def test_score_all_pairs_matches_the_all_pairs_baseline(prefilter, threshold):
+    store = synthetic_store()
+    expected = baseline_pairs(store, 0.02, threshold)
+
+    result = scored(module4net.score_all_pairs(store, 0.02, threshold, prefilter=prefilter, quiet=True))
+
+    assert result.keys() == expected.keys()
+    for pair, (score, matched_peaks) in expected.items():
+        assert result[pair][0] == pytest.approx(score)
+        assert result[pair][1] == matched_peaks
+
+
+def test_parallel_scoring_matches_serial_scoring():
+    store = synthetic_store(seed=3)
+
+    serial = scored(module4net.score_all_pairs(store, 0.02, 0.3, quiet=True))
+    parallel = scored(module4net.score_all_pairs(store, 0.02, 0.3, workers=2, quiet=True))
+
+    assert parallel.keys() == serial.keys()
+    for pair in serial:
+        assert parallel[pair][0] == pytest.approx(serial[pair][0])
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_generate_all_matches_keeps_the_top_k_neighbours(workers):
+    store = synthetic_store(seed=11)
+    top_k = 3
+    threshold = 0.3
+    expected = baseline_pairs(store, 0.02, threshold)
+
+    neighbours = {i: [] for i in range(len(store))}
+    for (i, j), (score, _) in expected.items():
+        neighbours[i].append((score, j))
+        neighbours[j].append((score, i))
+
+    matches = module4net.generate_all_matches(store, 0.02, threshold, top_k, workers=workers, quiet=True)
+
+    by_scan = {}
+    for match in matches:
+        if match['scan'] is not None:
+            by_scan.setdefault(match['scan'], []).append((match['queryscan'], match['cosine']))
+    for i, candidates in neighbours.items():
+        best = sorted(candidates, reverse=True)[:top_k]
+        found = by_scan.get(int(store.scan[i]), [])
+        assert [int(store.scan[j]) for _, j in best] == [scan for scan, _ in found]
+        assert [score for score, _ in best] == pytest.approx([cosine for _, cosine in found])
+
+
+def match_table(rows):
+    return pd.DataFrame([
+        {'CLUSTERID1': a, 'CLUSTERID2': b, 'Cosine': cosine, 'mz1': 100.0 + a, 'rt1': 1.0, 'mz2': 100.0 + b,
+         'rt2': 2.0, 'DeltaMZ': float(b - a), 'explained_intensity': 0.5, 'source': 'classical_molecular',
+         'Peak-matching Rate': 0.0}
+        for a, b, cosine in rows
+    ])
+
+
+def test_draw_network_prunes_components_from_the_strongest_edge_down(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    table = match_table([(1, 2, 0.9), (2, 3, 0.8), (3, 4, 0.7), (4, 5, 0.95), (2, 1, 0.6), (5, 6, 0.2)])
+
+    G = module4net.draw_network(table, 0.5, component_size=3)
+
+    # 3-4 would merge {1, 2, 3} with {4, 5}, the repeated 1-2 pair is kept once and 5-6 is below the threshold
+    assert sorted(tuple(sorted(edge)) for edge in G.edges()) == [('1', '2'), ('2', '3'), ('4', '5')]
+    assert sorted(G.nodes) == ['1', '2', '3', '4', '5', '6']
+    assert G.edges['1', '2', 0]['cosine_score'] == 0.9
+    assert (tmp_path / 'ClassicalNetwork.graphml').exists()
@@ -0,0 +1,121 @@
+import os
+import json
+from SMMN.utils.output_log import OutputLogIndex, count_new_molecules, merge_output_logs, split_preamble
+from SMMN.utils.prediction_cache import PredictionCache
+
+PREAMBLE = "#In-silico ESI-MS/MS [M+H]+ Spectra\n#PREDICTED BY CFM-ID 4.0.7\n"
+
+
+def block(molecule_id, smiles, peak):
+    return (f"#ID={molecule_id}\n#SMILES={smiles}\n#InChiKey=\n#Formula=C{len(smiles)}\n#PMass={peak + 100}\n"
+            f"energy0\n{peak} 10\n{peak + 1} 20\nenergy1\n{peak + 2} 30\nenergy2\n{peak + 3} 40\n\n")
+
+
+def write_log(path, blocks, per_molecule_preamble=False):
+    with open(path, 'w') as f:
+        for k, text in enumerate(blocks):
+            if k == 0 or per_molecule_preamble:
+                f.write(PREAMBLE)
+            f.write(text)
+    return str(path)
+
+
+def cache(tmp_path):
+    param_file = tmp_path / 'param_output.log'
+    param_file.write_text('model')
+    return PredictionCache(str(tmp_path / 'cache'), [str(param_file)])
+
+
+def test_index_reads_molecules_and_spectra(tmp_path):
+    output_file = write_log(tmp_path / 'output.log', [block('Molecule1', 'CC', 50), block('Molecule2', 'CCO', 60)])
+
+    index = OutputLogIndex.build(output_file)
+
+    assert [m['id'] for m in index.molecules] == ['Molecule1', 'Molecule2']
+    assert index.molecule('Molecule2')['formula'] == 'C3'
+    assert index.molecule('Molecule2')['pmass'] == '160'
+    assert index.spectrum('Molecule1', 'energy0') == [[50.0, 10.0], [51.0, 20.0]]
+    assert index.spectrum('Molecule2', 'energy2') == [[63.0, 40.0]]
+    assert index.spectrum('Molecule3', 'energy0') == []
+    # the run preamble belongs to the first block
+    assert index.molecule_text(index.molecules[0]) == PREAMBLE + block('Molecule1', 'CC', 50)
+    assert index.molecule_text(index.molecules[1]) == block('Molecule2', 'CCO', 60)
+
+
+def test_load_reuses_the_sidecar_until_the_log_changes(tmp_path):
+    output_file = write_log(tmp_path / 'output.log', [block('Molecule1', 'CC', 50)])
+
+    OutputLogIndex.load(output_file)
+    with open(OutputLogIndex.index_path(output_file), 'r') as f:
+        sidecar = json.load(f)
+    sidecar['molecules'][0]['formula'] = 'from sidecar'
+    with open(OutputLogIndex.index_path(output_file), 'w') as f:
+        json.dump(sidecar, f)
+
+    assert OutputLogIndex.load(output_file).molecule('Molecule1')['formula'] == 'from sidecar'
+
+    stat = os.stat(output_file)
+    write_log(output_file, [block('Molecule9', 'CC', 50)])
+    os.utime(output_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    assert [m['id'] for m in OutputLogIndex.load(output_file).molecules] == ['Molecule9']
+
+
+def test_count_new_molecules_leaves_a_partial_line(tmp_path):
+    output_file = tmp_path / 'output.log'
+    output_file.write_text(PREAMBLE + "#ID=Molecule1\nenergy0\n#ID=Mol")
+
+    count, offset = count_new_molecules(str(output_file))
+    with open(output_file, 'a') as f:
+        f.write("ecule2\n")
+
+    assert count == 1
+    assert count_new_molecules(str(output_file), offset) == (1, os.path.getsize(output_file))
+
+
+def test_split_preamble():
+    assert split_preamble(PREAMBLE + block('Molecule1', 'CC', 50)) == (PREAMBLE, block('Molecule1', 'CC', 50))
+    assert split_preamble(block('Molecule1', 'CC', 50)) == ('', block('Molecule1', 'CC', 50))
+
+
+def test_merge_output_logs_orders_blocks_and_writes_one_preamble(tmp_path):
+    first = write_log(tmp_path / 'output.shard0.log', [block('Molecule3', 'CCCN', 70), block('Molecule1', 'CC', 50)],
+                      per_molecule_preamble=True)
+    second = write_log(tmp_path / 'output.shard1.log', [block('Molecule4', 'CCCCN', 80)])
+    molecules = [('Molecule1', 'CC'), ('Molecule2', 'SKIPPED'), ('Molecule3', 'CCCN'), ('Molecule4', 'CCCCN')]
+    output_file = str(tmp_path / 'output.log')
+
+    written = merge_output_logs([first, second], molecules, output_file)
+
+    assert written == 3
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+    with open(output_file, 'r') as f:
+        assert f.read() == (PREAMBLE + block('Molecule1', 'CC', 50) + block('Molecule3', 'CCCN', 70)
+                            + block('Molecule4', 'CCCCN', 80))
+
+
+def test_merge_output_logs_takes_pinned_hits_and_caches_fresh_blocks(tmp_path):
+    prediction_cache = cache(tmp_path)
+    prediction_cache.put('CC', PREAMBLE + block('Earlier', 'CC', 50))
+    molecule_file = tmp_path / 'molecule.txt'
+    molecule_file.write_text("Molecule1 CC\nMolecule2 CCO\n")
+    misses_file = str(tmp_path / 'molecule.misses.txt')
+    hits_file = str(tmp_path / 'output.hits.log')
+
+    assert prediction_cache.write_misses(str(molecule_file), misses_file, hits_file) == 1
+    with open(misses_file, 'r') as f:
+        assert f.read() == "Molecule2 CCO\n"
+
+    # an eviction between computing the misses and merging must not lose the hit
+    os.remove(prediction_cache.path('CC'))
+    part = write_log(tmp_path / 'output.misses.log', [block('Molecule2', 'CCO', 60)])
+    output_file = str(tmp_path / 'output.log')
+
+    written = merge_output_logs([part], [('Molecule1', 'CC'), ('Molecule2', 'CCO')], output_file, prediction_cache,
+                                hits_file)
+
+    assert written == 2
+    with open(output_file, 'r') as f:
+        assert f.read() == PREAMBLE + block('Molecule1', 'CC', 50) + block('Molecule2', 'CCO', 60)
+    with open(prediction_cache.path('CCO'), 'r') as f:
+        assert f.read() == block('Molecule2', 'CCO', 60)
@@ -0,0 +1,75 @@
+import os
+import time
+from SMMN.utils.pair_cache import PairScoreCache
+from SMMN.utils.spectral_alignment import Match
+from SMMN.utils.spectrum_store import SpectrumStore
+
+MGF = """BEGIN IONS
+PEPMASS=300.0
+SCANS=1
+100.0 10
+150.0 20
+END IONS
+BEGIN IONS
+PEPMASS=310.0
+SCANS=2
+100.0 15
+160.0 5
+END IONS
+"""
+
+
+def store():
+    return SpectrumStore.from_mgf_text(MGF)
+
+
+def test_scored_pairs_round_trip(tmp_path):
+    cache = PairScoreCache(str(tmp_path), floor=0.3)
+    scored = [(0, 1, 0.75, [Match(0, 0, 0.5), Match(1, 1, 0.25)]), (1, 2, 0.4, [])]
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return iter(scored)
+
+    first = cache.scored_pairs(store(), 0.02, compute)
+    second = cache.scored_pairs(store(), 0.02, compute)
+
+    assert first == scored
+    assert second == scored
+    assert all(isinstance(m, Match) for m in second[0][3])
+    assert len(calls) == 1
+
+
+def test_key_depends_on_spectra_tolerance_and_floor(tmp_path):
+    cache = PairScoreCache(str(tmp_path), floor=0.3)
+    other = SpectrumStore.from_mgf_text(MGF.replace('160.0 5', '160.0 6'))
+
+    key = cache.key(store(), 0.02)
+
+    assert key == cache.key(store(), 0.02)
+    assert key != cache.key(store(), 0.01)
+    assert key != cache.key(other, 0.02)
+    assert key != PairScoreCache(str(tmp_path), floor=0.2).key(store(), 0.02)
+
+
+def test_evict_keeps_the_most_recently_used_entries(tmp_path):
+    cache = PairScoreCache(str(tmp_path), max_entries=2)
+    for k in range(2):
+        cache.save(f"key{k}", [(0, 1, 0.5, [])])
+        os.utime(cache.path(f"key{k}"), (time.time() - 100 + k, time.time() - 100 + k))
+    # loading refreshes the entry, so key0 outlives key1
+    assert cache.load('key0') is not None
+
+    cache.save('key2', [(0, 1, 0.5, [])])
+
+    assert sorted(os.listdir(tmp_path)) == ['key0.npz', 'key2.npz']
+
+
+def test_unreadable_entries_are_discarded(tmp_path):
+    cache = PairScoreCache(str(tmp_path))
+    with open(cache.path('broken'), 'wb') as f:
+        f.write(b'not an npz file')
+
+    assert cache.load('broken') is None
+    assert not os.path.exists(cache.path('broken'))
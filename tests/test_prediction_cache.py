@@ -0,0 +1,53 @@
+from SMMN.utils.prediction_cache import PredictionCache
+
+
+def cache(tmp_path, options='', model='model'):
+    param_file = tmp_path / 'param_output.log'
+    param_file.write_text(model)
+    return PredictionCache(str(tmp_path / 'cache'), [str(param_file)], options=options)
+
+
+def test_key_ignores_whitespace_in_smiles(tmp_path):
+    prediction_cache = cache(tmp_path)
+
+    assert PredictionCache.normalize_smiles(' C C(=O)O \n') == 'CC(=O)O'
+    assert prediction_cache.key('CC(=O)O') == prediction_cache.key(' CC(=O) O\t')
+    assert prediction_cache.key('CC(=O)O') != prediction_cache.key('CC(=O)N')
+
+
+def test_key_depends_on_options_and_parameter_files(tmp_path):
+    key = cache(tmp_path).key('CCO')
+
+    assert key == cache(tmp_path).key('CCO')
+    assert key != cache(tmp_path, options='docker 0.001 0 0 0').key('CCO')
+    assert key != cache(tmp_path, model='retrained').key('CCO')
+
+
+def test_get_renames_the_cached_block(tmp_path):
+    prediction_cache = cache(tmp_path)
+    prediction_cache.put('CCO', "#In-silico ESI-MS/MS [M+H]+ Spectra\n#ID=Other\n#SMILES=CCO\nenergy0\n1 2\n\n")
+
+    assert prediction_cache.get('C CO', 'Molecule7') == "#ID=Molecule7\n#SMILES=CCO\nenergy0\n1 2\n\n"
+    assert prediction_cache.get('CCN', 'Molecule7') is None
+
+
+def test_evict_keeps_max_entries(tmp_path):
+    prediction_cache = cache(tmp_path)
+    prediction_cache.max_entries = 2
+    for smiles in ('C', 'CC', 'CCC'):
+        prediction_cache.put(smiles, f"#ID=x\n#SMILES={smiles}\n")
+
+    prediction_cache.evict()
+
+    assert sum(prediction_cache.get(smiles, 'x') is not None for smiles in ('C', 'CC', 'CCC')) == 2
+
+
+def test_put_keeps_the_run_preamble_once(tmp_path):
+    prediction_cache = cache(tmp_path)
+    assert prediction_cache.preamble() == ''
+
+    prediction_cache.put('CCO', "#In-silico ESI-MS/MS [M+H]+ Spectra\n#ID=Other\n#SMILES=CCO\n\n")
+    prediction_cache.put('CCN', "#PREDICTED BY ANOTHER RUN\n#ID=Other\n#SMILES=CCN\n\n")
+
+    assert prediction_cache.preamble() == "#In-silico ESI-MS/MS [M+H]+ Spectra\n"
+    assert cache(tmp_path, options='other').preamble() == ''
@@ -0,0 +1,124 @@
+import os
+import json
+import fcntl
+import pytest
+from SMMN.utils.simulation_batch import SimulationSpool
+from SMMN.utils.simulator_backends import FakeBackend
+
+
+def submit(spool, tmp_path, job_id, molecules, mtime):
+    user_directory = tmp_path / job_id
+    user_directory.mkdir()
+    spool.submit(job_id, str(user_directory), molecules, str(user_directory / 'output.misses.log'))
+    os.utime(spool.entry_path(job_id), (mtime, mtime))
+    return str(user_directory)
+
+
+def fake_run(molecule_file, output_file, on_progress=None):
+    with open(molecule_file, 'r') as f, open(output_file, 'w') as out:
+        for done, line in enumerate(f, start=1):
+            molecule_id, smiles = line.split()
+            out.write(FakeBackend.spectrum_text(molecule_id, smiles))
+            out.flush()
+            if on_progress is not None:
+                on_progress(done)
+
+
+def test_claim_takes_the_oldest_entries_up_to_max_molecules(tmp_path):
+    spool = SimulationSpool(str(tmp_path / 'spool'), window=0, max_molecules=3)
+    submit(spool, tmp_path, 'late', [['Molecule1', 'C']], 300)
+    submit(spool, tmp_path, 'early', [['Molecule1', 'CC'], ['Molecule2', 'CCC']], 100)
+    submit(spool, tmp_path, 'middle', [['Molecule1', 'N'], ['Molecule2', 'NN']], 200)
+    batch_directory = tmp_path / 'batch'
+    batch_directory.mkdir()
+
+    entries = spool.claim(str(batch_directory))
+
+    # 'middle' would overflow the batch and is never split, so 'late' waits as well
+    assert [entry['job_id'] for entry in entries] == ['early']
+    assert sorted(os.listdir(batch_directory)) == ['early.json']
+    assert sorted(os.listdir(spool.spool_dir)) == ['late.json', 'middle.json']
+
+
+def test_claim_always_takes_the_first_entry(tmp_path):
+    spool = SimulationSpool(str(tmp_path / 'spool'), window=0, max_molecules=1)
+    submit(spool, tmp_path, 'large', [['Molecule1', 'C'], ['Molecule2', 'CC']], 100)
+    batch_directory = tmp_path / 'batch'
+    batch_directory.mkdir()
+
+    assert [entry['job_id'] for entry in spool.claim(str(batch_directory))] == ['large']
+
+
+def test_withdrawn_entries_are_not_claimed(tmp_path):
+    spool = SimulationSpool(str(tmp_path / 'spool'), window=0)
+    submit(spool, tmp_path, 'kept', [['Molecule1', 'C']], 100)
+    submit(spool, tmp_path, 'withdrawn', [['Molecule1', 'CC']], 200)
+    batch_directory = tmp_path / 'batch'
+    batch_directory.mkdir()
+
+    spool.withdraw('withdrawn')
+    spool.withdraw('never-submitted')
+
+    assert [entry['job_id'] for entry in spool.claim(str(batch_directory))] == ['kept']
+
+
+def test_wait_runs_one_batch_and_splits_it_per_job(tmp_path):
+    spool = SimulationSpool(str(tmp_path / 'spool'), window=0)
+    first = submit(spool, tmp_path, 'first', [['Molecule1', 'CC'], ['Molecule2', 'CCO']], 100)
+    second = submit(spool, tmp_path, 'second', [['Molecule1', 'N']], 200)
+    runs = []
+
+    def run(molecule_file, output_file, on_progress):
+        runs.append(molecule_file)
+        fake_run(molecule_file, output_file, on_progress)
+
+    result = spool.wait('first', first, run, timeout=10)
+
+    assert result == {'status': 'SUCCESS', 'batch_jobs': 2}
+    assert len(runs) == 1
+    with open(os.path.join(first, 'output.misses.log'), 'r') as f:
+        assert f.read() == (FakeBackend.spectrum_text('Molecule1', 'CC')
+                            + FakeBackend.spectrum_text('Molecule2', 'CCO'))
+    with open(SimulationSpool.result_path(second), 'r') as f:
+        assert json.load(f) == {'status': 'SUCCESS', 'batch_jobs': 2}
+    assert spool.wait('second', second, run, timeout=10)['status'] == 'SUCCESS'
+    assert len(runs) == 1
+    assert os.listdir(spool.spool_dir) == []
+
+
+def test_the_leader_reports_only_its_own_molecules(tmp_path):
+    spool = SimulationSpool(str(tmp_path / 'spool'), window=0)
+    leader = submit(spool, tmp_path, 'leader', [['Molecule1', 'CC'], ['Molecule2', 'CCO']], 100)
+    submit(spool, tmp_path, 'other', [['Molecule1', 'N'], ['Molecule2', 'NN'], ['Molecule3', 'NNN']], 200)
+    reported = []
+
+    spool.wait('leader', leader, fake_run, timeout=10, on_progress=reported.append)
+
+    # the batch reaches five molecules, but only the leader's two are its progress
+    assert reported == [1, 2]
+    assert not [name for name in os.listdir(leader) if name.endswith('.tmp')]
+
+
+def test_a_failed_batch_fails_every_job(tmp_path):
+    spool = SimulationSpool(str(tmp_path / 'spool'), window=0)
+    user_directory = submit(spool, tmp_path, 'job', [['Molecule1', 'CC']], 100)
+
+    def run(molecule_file, output_file, on_progress):
+        raise RuntimeError('cfm-predict crashed')
+
+    assert spool.wait('job', user_directory, run, timeout=10) == {'status': 'FAILURE', 'error': 'cfm-predict crashed'}
+
+
+def test_wait_times_out_and_withdraws_the_entry(tmp_path):
+    spool = SimulationSpool(str(tmp_path / 'spool'), window=0)
+    user_directory = submit(spool, tmp_path, 'job', [['Molecule1', 'CC']], 100)
+    lock = open(os.path.join(spool.root, 'leader.lock'), 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        with pytest.raises(TimeoutError):
+            spool.wait('job', user_directory, fake_run, timeout=0.2)
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+    assert not os.path.exists(spool.entry_path('job'))
@@ -0,0 +1,35 @@
+import os
+import sys
+import pytest
+from SMMN.utils.simulator_backends import SubprocessBackend, predict_arguments
+
+
+def run(handle):
+    output = b''.join(handle.logs()).decode()
+    result = handle.wait(timeout=10)
+    handle.remove()
+    return output, result
+
+
+def test_subprocess_backend_passes_the_predict_arguments():
+    backend = SubprocessBackend([sys.executable, '-c', "import sys; print(sys.argv[1:])"])
+
+    output, result = run(backend.start('molecule.txt', 'output.log', 'param_output.log', 'param_config.txt'))
+
+    assert result == {'StatusCode': 0}
+    assert output.strip() == str(predict_arguments('molecule.txt', 'output.log', 'param_output.log',
+                                                   'param_config.txt'))
+    assert backend.identity.startswith(sys.executable)
+
+
+@pytest.mark.skipif(not hasattr(os, 'sched_getaffinity'), reason='needs CPU affinity support')
+def test_subprocess_backend_pins_each_job_to_the_next_cpu():
+    cpus = sorted(os.sched_getaffinity(0))[:2]
+    backend = SubprocessBackend([sys.executable, '-c', "import os; print(sorted(os.sched_getaffinity(0)))"],
+                                cpus=cpus)
+
+    pinned = [run(backend.start('m', 'o', 'p', 'c'))[0].strip() for _ in range(2 * len(cpus))]
+
+    assert sorted(set(pinned)) == sorted(str([cpu]) for cpu in cpus)
+    # the rotation starts at a per-process offset and then alternates
+    assert pinned[:len(cpus)] == pinned[len(cpus):]
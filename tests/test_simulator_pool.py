@@ -0,0 +1,70 @@
+import threading
+from SMMN.utils.simulator_backends import FakeBackend
+from SMMN.utils.simulator_pool import SimulatorPool, BackendWorker, WorkerSlots
+
+
+def write_molecules(path, count):
+    path.write_text(''.join(f"Molecule{k} C{'C' * k}O\n" for k in range(1, count + 1)))
+    return str(path)
+
+
+def wait(job):
+    return b''.join(job.logs())
+
+
+def test_pool_runs_jobs_on_a_reused_worker(tmp_path):
+    started = []
+
+    def worker_factory():
+        started.append(1)
+        return BackendWorker(FakeBackend(), 'param_output.log', 'param_config.txt')
+
+    pool = SimulatorPool(worker_factory, size=1)
+    try:
+        jobs = [pool.submit(write_molecules(tmp_path / f"molecule{k}.txt", k + 1), str(tmp_path / f"output{k}.log"))
+                for k in range(3)]
+        logs = [wait(job) for job in jobs]
+    finally:
+        pool.close()
+
+    assert started == [1]
+    assert [job.status for job in jobs] == ['exited'] * 3
+    assert logs[2] == b"Predicted Molecule1\nPredicted Molecule2\nPredicted Molecule3\n"
+    assert (tmp_path / 'output1.log').read_text() == (FakeBackend.spectrum_text('Molecule1', 'CCO')
+                                                      + FakeBackend.spectrum_text('Molecule2', 'CCCO'))
+
+
+def test_cancelled_job_never_reaches_a_worker(tmp_path):
+    release = threading.Event()
+
+    class BlockingWorker(BackendWorker):
+        def run(self, molecule_file_path, output_file_path, on_output):
+            release.wait()
+            super().run(molecule_file_path, output_file_path, on_output)
+
+    pool = SimulatorPool(lambda: BlockingWorker(FakeBackend(), 'param_output.log', 'param_config.txt'), size=1)
+    try:
+        first = pool.submit(write_molecules(tmp_path / 'first.txt', 1), str(tmp_path / 'first.log'))
+        second = pool.submit(write_molecules(tmp_path / 'second.txt', 1), str(tmp_path / 'second.log'))
+        second.kill()
+        release.set()
+        wait(first)
+        wait(second)
+    finally:
+        pool.close()
+
+    assert second.worker is None
+    assert not (tmp_path / 'second.log').exists()
+    assert (tmp_path / 'first.log').exists()
+
+
+def test_worker_slots_cap_workers_across_pools(tmp_path):
+    slots = WorkerSlots(str(tmp_path / 'slots'), 1, poll_interval=0.01)
+    stop = threading.Event()
+
+    held = slots.acquire(stop)
+    stop.set()
+    assert slots.acquire(stop) is None
+
+    slots.release(held)
+    assert WorkerSlots(str(tmp_path / 'slots'), 1).acquire(threading.Event()) is not None
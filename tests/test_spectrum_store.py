@@ -0,0 +1,99 @@
+import numpy as np
+from SMMN.utils.spectrum_store import SpectrumStore, normalize_intensities, match_within_tolerance
+
+MGF = """BEGIN IONS
+FEATURE_ID=1
+PEPMASS=301.1 1200
+CHARGE=2+
+RTINSECONDS=12.5
+SCANS=12
+100.0 10
+150.5 40
+END IONS
+stray 1 2
+BEGIN IONS
+TITLE=second
+PEPMASS=250.0
+SCANS=1
+END IONS
+BEGIN IONS
+PEPMASS=410.2
+SCANS=7
+90.0 5
+not a peak
+120.0 5
+END IONS
+"""
+
+
+def test_from_lines_parses_headers_and_peaks():
+    store = SpectrumStore.from_lines(MGF.splitlines(), 'input.mgf')
+
+    assert len(store) == 3
+    assert store.filename == 'input.mgf'
+    assert store.offsets.tolist() == [0, 2, 2, 4]
+    assert store.mz.tolist() == [100.0, 150.5, 90.0, 120.0]
+    assert store.intensity.tolist() == [10.0, 40.0, 5.0, 5.0]
+    assert store.pepmass.tolist() == [301.1, 250.0, 410.2]
+    assert store.charge.tolist() == [2, 0, 0]
+    assert store.rt.tolist() == [12.5, 0.0, 0.0]
+    assert store.scan.tolist() == [12, 1, 7]
+    assert store.title == ['1', 'second', '']
+    assert store.headers[0].splitlines()[0] == 'TITLE=1'
+
+
+def test_save_and_load_round_trip(tmp_path):
+    store = SpectrumStore.from_mgf_text(MGF, 'input.mgf')
+    store.save(str(tmp_path / 'bundle'))
+
+    loaded = SpectrumStore.load(str(tmp_path / 'bundle'))
+
+    for name in ('mz', 'intensity', 'offsets', 'pepmass', 'charge', 'rt', 'scan'):
+        assert np.array_equal(getattr(loaded, name), getattr(store, name))
+    assert loaded.filename == 'input.mgf'
+    assert loaded.title == store.title
+    assert loaded.headers == store.headers
+    assert [array.tolist() for array in loaded.peaks(0)] == [[100.0, 150.5], [10.0, 40.0]]
+
+def test_index_of_scan_is_exact():
+    store = SpectrumStore.from_mgf_text(MGF)
+
+    assert store.index_of_scan(12) == 0
+    assert store.index_of_scan(1) == 1
+    assert store.index_of_scan(7) == 2
+    assert store.index_of_scan(2) == -1
+    assert store.index_of_scan(100) == -1
+
+
+def test_nonempty_drops_spectra_without_peaks():
+    store = SpectrumStore.from_mgf_text(MGF).nonempty()
+
+    assert store.scan.tolist() == [12, 7]
+    assert store.offsets.tolist() == [0, 2, 4]
+
+
+def test_normalize_intensities_scales_each_spectrum():
+    store = SpectrumStore.from_mgf_text(MGF)
+
+    # the flat spectrum has no spread and stays at zero, the empty one contributes no peaks
+    assert normalize_intensities(store).tolist() == [0.0, 1.0, 0.0, 0.0]
+
+
+def test_normalize_intensities_of_an_empty_store():
+    store = SpectrumStore.from_mgf_text('')
+
+    assert normalize_intensities(store).tolist() == []
+
+
+def test_match_within_tolerance_pairs_every_close_target():
+    value_idx, target_idx = match_within_tolerance([100.0, 150.0, 200.0], [99.99, 100.005, 150.02, 300.0], 0.02)
+
+    assert list(zip(value_idx.tolist(), target_idx.tolist())) == [(0, 0), (0, 1)]
+
+
+def test_match_within_tolerance_inclusive_bound():
+    exclusive = match_within_tolerance([150.0], [150.5], 0.5)
+    inclusive = match_within_tolerance([150.0], [150.5], 0.5, inclusive=True)
+
+    assert exclusive[0].tolist() == []
+    assert inclusive[0].tolist() == [0]
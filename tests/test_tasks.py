@@ -0,0 +1,98 @@
+import os
+import json
+import pytest
+from django.test import override_settings
+from SMMN import tasks, in_silico_msms
+from SMMN.utils.output_log import OutputLogIndex
+from SMMN.utils.simulator_pool import close_shared_pool
+
+
+@pytest.fixture
+def fake_simulator(tmp_path, monkeypatch, eager_celery):
+    monkeypatch.setattr(tasks, '_simulator_backend', None)
+    with override_settings(MEDIA_ROOT=str(tmp_path / 'media'), SMMN_SIMULATOR_BACKEND='fake',
+                           SMMN_PROGRESS_INTERVAL=0.01):
+        yield
+
+
+def write_molecules(directory, count):
+    directory.mkdir(exist_ok=True)
+    molecule_file = directory / 'molecule.txt'
+    molecule_file.write_text(''.join(f"Molecule{k} C{'C' * k}O\n" for k in range(1, count + 1)))
+    return str(molecule_file)
+
+
+def test_split_molecule_file_uses_the_shard_size(tmp_path):
+    molecule_file = write_molecules(tmp_path, 7)
+
+    with override_settings(SMMN_SIMULATION_SHARD_SIZE=3):
+        shards = tasks.split_molecule_file(molecule_file, str(tmp_path))
+    with override_settings(SMMN_SIMULATION_SHARD_SIZE=7):
+        assert tasks.split_molecule_file(molecule_file, str(tmp_path)) == []
+
+    assert [total for _, _, _, total in shards] == [3, 3, 1]
+    with open(shards[2][0], 'r') as f:
+        assert f.read() == "Molecule7 CCCCCCCCO\n"
+
+
+@override_settings(SMMN_SIMULATION_SHARD_SIZE=2)
+def test_sharded_simulation_merges_every_molecule_in_order(tmp_path, fake_simulator):
+    user_directory = tmp_path / 'job'
+    molecule_file = write_molecules(user_directory, 5)
+
+    task = tasks.start_simulation(molecule_file, str(user_directory))
+
+    assert task.get() == {'status': 'SUCCESS', 'result': str(user_directory / 'output.log')}
+    index = OutputLogIndex.load(str(user_directory / 'output.log'))
+    assert [molecule['id'] for molecule in index.molecules] == [f"Molecule{k}" for k in range(1, 6)]
+    # shard files and the task manifest are removed by the merge
+    assert sorted(os.listdir(user_directory)) == ['molecule.txt', 'output.log', 'output.log.index.json']
+    assert tasks.read_task_manifest(task.id) is None
+    assert json.loads(in_silico_msms.check_task_status(None, task.id).content)['state'] == 'SUCCESS'
+
+
+def test_repeated_molecules_are_served_from_the_prediction_cache(tmp_path, fake_simulator, monkeypatch):
+    first = tmp_path / 'first'
+    tasks.start_simulation(write_molecules(first, 3), str(first)).get()
+
+    def no_simulation(*args):
+        raise AssertionError('cfm-predict should not run for cached molecules')
+
+    monkeypatch.setattr(tasks, 'run_cfm_predict', no_simulation)
+    second = tmp_path / 'second'
+    result = tasks.start_simulation(write_molecules(second, 3), str(second)).get()
+
+    assert result['status'] == 'SUCCESS'
+    assert (second / 'output.log').read_text() == (first / 'output.log').read_text()
+
+
+@override_settings(SMMN_SIMULATOR_POOL_SIZE=1, SMMN_SIMULATOR_POOL_LIMIT=1)
+def test_simulation_dispatches_to_the_warm_pool(tmp_path, fake_simulator):
+    user_directory = tmp_path / 'job'
+    try:
+        result = tasks.start_simulation(write_molecules(user_directory, 3), str(user_directory)).get()
+        # the job ran on a warm worker, which stays up holding the only host-wide slot
+        workers = list(tasks.simulator_pool().workers.values())
+    finally:
+        close_shared_pool()
+
+    assert result['status'] == 'SUCCESS'
+    assert len(workers) == 1 and workers[0] is not None
+    index = OutputLogIndex.load(str(user_directory / 'output.log'))
+    assert [molecule['id'] for molecule in index.molecules] == ['Molecule1', 'Molecule2', 'Molecule3']
+
+
+@override_settings(SMMN_BATCH_WINDOW=0.01)
+def test_batched_simulation_reports_its_own_progress(tmp_path, fake_simulator, monkeypatch):
+    states = []
+    monkeypatch.setattr(tasks.run_batched_simulation_task, 'update_state',
+                        lambda state=None, meta=None, **kwargs: states.append(meta))
+    user_directory = tmp_path / 'job'
+
+    result = tasks.start_simulation(write_molecules(user_directory, 3), str(user_directory)).get()
+
+    assert result['status'] == 'SUCCESS'
+    assert states[0] == {'done': 0, 'total': 3} and states[-1] == {'done': 3, 'total': 3}
+    assert all(meta['total'] == 3 and meta['done'] <= 3 for meta in states)
+    index = OutputLogIndex.load(str(user_directory / 'output.log'))
+    assert [molecule['id'] for molecule in index.molecules] == ['Molecule1', 'Molecule2', 'Molecule3']